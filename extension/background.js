@@ -4,6 +4,9 @@ Background script. This works across all of Google Chrome.
 
 var RAW_DEBUG = false; // Do not save debug requests. We flip this frequently. Perhaps this should be a cookie or browser.storage?
 
+var BATCH_MS = 100;  // Wait this long for more events, so we send them in one websocket frame
+var BATCH_EVENTS = 100;  // Most events in a frame
+
 
 /*
   TODO: FSM
@@ -64,6 +67,14 @@ function websocket_logger(server) {
     /*
        Log to web socket server.
 
+       We send events in batches, each with a sequence number:
+
+         {"seq": 12, "events": [event, event, ...]}
+
+       The server replies {"ack": 12} once it has handled that batch,
+       and everything before it. We keep batches until they're
+       acknowledged, and send them again if we lose the connection.
+
        Optional:
        * We could send queued events on socket open (or on a timeout)
        * Or we could just wait for the next event (what we do now)
@@ -73,10 +84,14 @@ function websocket_logger(server) {
     var socket;
     var state = new Set()
     var queue = [];
+    var seq = 0;  // Sequence number of the last batch we sent
+    var unacknowledged = [];  // Batches we sent, which the server hasn't acknowledged
+    var timer = null;  // Set while we wait to send a batch
 
     function new_websocket() {
 	socket = new WebSocket(server);
 	socket.onopen=prepare_socket;
+	socket.onmessage = receive;
 	socket.onerror = function(event) {
 	    console.log("Could not connect");
 	    var event = { "issue": "Could not connect" };
@@ -86,6 +101,7 @@ function websocket_logger(server) {
 	};
 	socket.onclose = function(event) {
 	    console.log("Lost connection");
+	    requeue_unacknowledged();
 	    var event = { "issue": "Lost connection", "code": event.code };
 	    event = add_event_metadata("warning", event);
 	    event = JSON.stringify(event);
@@ -96,6 +112,31 @@ function websocket_logger(server) {
 
     socket = new_websocket();
 
+    function receive(message) {
+	/*
+	  The server acknowledges batches once it's handled them
+	 */
+	var data = JSON.parse(message.data);
+	if('ack' in data) {
+	    while(unacknowledged.length > 0 && unacknowledged[0].seq <= data.ack) {
+		unacknowledged.shift();
+	    }
+	}
+    }
+
+    function requeue_unacknowledged() {
+	/*
+	  Events the server never acknowledged go back at the front of
+	  the queue, so we send them again when we reconnect.
+	 */
+	var events = [];
+	for(var i=0; i<unacknowledged.length; i++) {
+	    events = events.concat(unacknowledged[i].events);
+	}
+	queue = events.concat(queue);
+	unacknowledged = [];
+    }
+
     function are_we_done() {
 	if (state.has("chrome_identity") &&
 	    state.has("local_storage")) {
@@ -139,9 +180,12 @@ function websocket_logger(server) {
 	    console.log("Event squelched; reconnecting");
 	} else if(socket.readyState === socket.OPEN &&
 	   state.has("ready")) {
-	    while(queue.length > 1) {
-		var event = queue.shift();
-		socket.send(event);  /* TODO: We should do receipt confirmation before dropping events */
+	    while(queue.length > 0) {
+		var events = queue.splice(0, BATCH_EVENTS);
+		seq += 1;
+		unacknowledged.push({"seq": seq, "events": events});
+		/* Events are already JSON, so we build the frame around them */
+		socket.send('{"seq": ' + seq + ', "events": [' + events.join(', ') + ']}');
 	    }
 	} else if((socket.readyState == socket.CLOSED) || (socket.readyState == socket.CLOSING)) {
 	    /*
@@ -163,7 +207,13 @@ function websocket_logger(server) {
 
     return function(data) {
 	queue.push(data);
-	dequeue();
+	/* Events often come in bursts (e.g. typing), so we wait a little to send them together */
+	if(timer === null) {
+	    timer = setTimeout(function() {
+		timer = null;
+		dequeue();
+	    }, BATCH_MS);
+	}
     }
 }
 
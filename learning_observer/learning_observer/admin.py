@@ -13,6 +13,9 @@ import psutil
 import aiohttp
 import aiohttp.web
 
+import learning_observer.incoming_student_event
+import learning_observer.kvs
+import learning_observer.log_event
 import learning_observer.module_loader
 
 from learning_observer.auth.utils import admin
@@ -42,6 +45,7 @@ async def system_status(request):
     - Loaded modules
     - Available URLs
     - System resource usage
+    - Redis connection pool usage
 
     This returns JSON, which renders very nicely in Firefox, but might
     be handled by a client-side app at some point. If that happens, we
@@ -96,6 +100,9 @@ async def system_status(request):
     status = {
         "status": "Alive!",
         "resources": machine_resources(),
+        "kvs_pool": learning_observer.kvs.pool_status(),
+        "event_log": learning_observer.log_event.archive_status(),
+        "ingestion": learning_observer.incoming_student_event.ingestion_status(),
         "modules": {
             "course_aggregators": clean_json(learning_observer.module_loader.course_aggregators()),
             "reducers": clean_json(learning_observer.module_loader.reducers()),
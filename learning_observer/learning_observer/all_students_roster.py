@@ -3,21 +3,18 @@ This creates a roster with all students in Redis
 '''
 
 import asyncio
-import asyncio_redis
+
+import learning_observer.stream_analytics.helpers
 
 
 async def all_students():
     '''
-    This crawls the keys of redis, and creates a list of all
-    student IDs in redis.
+    This reads the index of students with reducer state, and creates a
+    list of all student IDs in redis.
     '''
-    connection = await asyncio_redis.Connection.create()
-    keys = [await k for k in await connection.keys("*")]
-    internal_keys = [k for k in keys if k.startswith("Internal:")]
-    split_keys = [k.split(":") for k in internal_keys]
-    valid_keys = [k for k in split_keys if len(k) > 2]
-    user_ids = sorted(set([k[2] for k in valid_keys]))
+    user_ids = await learning_observer.stream_analytics.helpers.all_students()
     print(user_ids)
+    return user_ids
 
 
 async def all_students_course_list():
@@ -41,4 +38,4 @@ async def all_students_course_list():
 
 if __name__ == '__main__':
     loop = asyncio.get_event_loop()
-    loop.run_until_complete(all_students_roster())
+    loop.run_until_complete(all_students())
@@ -0,0 +1,42 @@
+'''
+Setup for `pytest`.
+
+`learning_observer.settings` reads the settings file named on the
+command line as soon as it's imported, and `pytest`'s command line
+isn't ours. Before any test imports it, we write out a minimal
+settings file for testing, and point it there.
+'''
+
+import os.path
+import sys
+import tempfile
+
+import yaml
+
+TEST_SETTINGS = {
+    'config': {'run_mode': 'dev', 'debug': []},
+    'kvs': {'type': 'stub', 'expiry': 60},
+    'pubsub': {'type': 'stub'},
+    'roster-data': {'source': 'all'},
+    'aio': {'session_secret': 'test', 'session_max_age': 3600},
+    'auth': {},
+    'event_auth': {'guest': {}},
+    # Modules serve static files from git repos. The Writing Observer's
+    # is the one we're in.
+    'repos': {
+        'writing_observer': {
+            'path': os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        }
+    }
+}
+
+settings_file = os.path.join(tempfile.mkdtemp(), "creds.yaml")
+with open(settings_file, "w") as fp:
+    yaml.safe_dump(TEST_SETTINGS, fp)
+
+argv = sys.argv
+sys.argv = [argv[0], '--config-file', settings_file]
+try:
+    import learning_observer.settings  # noqa: F401
+finally:
+    sys.argv = argv
@@ -23,3 +23,17 @@ class SuspiciousOperation(Exception):
 
     These happen when a platform is running, but they are suspicious.
     '''
+
+
+class ReducerErrors(Exception):
+    '''
+    One or more reducers in a pipeline failed. The others still ran,
+    and what they returned is in `result`, so callers don't lose
+    it. The individual exceptions are in `errors`.
+    '''
+    def __init__(self, errors, result):
+        super().__init__("{count} reducer(s) failed: {errors}".format(
+            count=len(errors), errors=repr(errors)
+        ))
+        self.errors = errors
+        self.result = result
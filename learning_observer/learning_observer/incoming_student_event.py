@@ -8,10 +8,35 @@ We:
 * Authenticate (minimally, for now, see docs)
 * Run these through a set of reducers
 * Optionally, notify via a pubsub of new data
+
+Events from one student which arrive while they wait for a worker
+are run through the reducers together, as a microbatch.
+
+Each websocket gets a `StudentSession`, which builds the student's
+pipeline (and reducers) once, when they authenticate, and uses it for
+every event until the socket closes.
+
+Websockets don't run events through the reducers themselves. They put
+them on a bounded queue (see `Ingestion`), drained by a fixed number
+of worker tasks, so a busy server slows down reading sockets (or sheds
+load), rather than taking on more work than it can do. The busier we
+are, the more events each batch holds.
+
+Clients may send one event per websocket frame, or a batch of events
+with a sequence number:
+
+    {"seq": 12, "events": [{...}, {...}, ...]}
+
+Once we've run a batch (and everything before it) through the
+reducers, and the archive writer has written it out, we reply with
+`{"ack": 12}`, so the client knows it can drop those events.
 '''
 
+import asyncio
+import collections
 import datetime
 import json
+import sys
 import time
 import traceback
 import urllib.parse
@@ -25,6 +50,7 @@ import learning_observer.paths as paths
 import learning_observer.auth.utils as authutils               # Encoded / decode user IDs
 import learning_observer.pubsub as pubsub                      # Pluggable pubsub subsystem
 import learning_observer.stream_analytics as stream_analytics  # Individual analytics modules
+import learning_observer.stream_analytics.helpers
 
 import learning_observer.settings as settings
 
@@ -36,6 +62,30 @@ import learning_observer.auth.events
 
 stream_analytics.init()
 
+# Ingestion workers take up to this many of a student's events at a
+# time, and run them through the reducers together.
+MICROBATCH_EVENTS = 20
+
+# Defaults for the ingestion queue, which can be set under `ingestion`
+# in the settings file. `INGESTION_WORKERS` tasks run events through
+# the reducers. At most `INGESTION_QUEUE_SIZE` events wait for them.
+# Past that, we either `wait` (stop reading from the websocket until
+# there's room), or `shed` (archive the event, but don't reduce it).
+INGESTION_WORKERS = 16
+INGESTION_QUEUE_SIZE = 1000
+INGESTION_OVERLOAD = 'wait'
+
+# Marks where a batch of events ends, in a session's queue of events,
+# so we acknowledge it once we get there
+Acknowledgement = collections.namedtuple('Acknowledgement', ['seq'])
+
+_INGESTION = None
+_INGESTION_LOOP = None
+
+if settings.settings.get('ingestion', {}).get('overload', INGESTION_OVERLOAD) not in ['wait', 'shed']:
+    print("ingestion overload in the settings file should be 'wait' or 'shed'")
+    sys.exit(-1)
+
 
 def compile_server_data(request):
     '''
@@ -57,49 +107,49 @@ async def student_event_pipeline(metadata):
     Create an event pipeline, based on header metadata
     '''
     client_source = metadata["source"]
-    print("client_source")
-    print(stream_analytics.student_reducer_modules())
     if client_source not in stream_analytics.student_reducer_modules():
         debug_log("Unknown event source: " + str(client_source))
         debug_log("Known sources: " + repr(stream_analytics.student_reducer_modules().keys()))
         raise learning_observer.exceptions.SuspiciousOperation("Unknown event source")
     analytics_modules = stream_analytics.student_reducer_modules()[client_source]
     # Create an event processor for this user
-    # TODO: This should happen in parallel: https://stackoverflow.com/questions/57263090/async-list-comprehensions-in-python
-    event_processors = [await am['student_event_reducer'](metadata) for am in analytics_modules]
+    event_processors = await asyncio.gather(
+        *[am['student_event_reducer'](metadata) for am in analytics_modules]
+    )
 
     async def pipeline(parsed_message):
         '''
         And this is the pipeline itself. It takes messages, processes them,
         and informs consumers when there is new data.
         '''
-        debug_log("Processing PubSub message {event} from {source}".format(
-            event=parsed_message["client"]["event"], source=client_source
-        ))
-
-        # Try to run a message through all event processors.
-        #
-        # To do: Finer-grained exception handling. Right now, if we break, we don't run
-        # through remaining processors.
-        try:
-            print(event_processors)
-            processed_analytics = [await ep(parsed_message) for ep in event_processors]
-        except Exception as e:
-            traceback.print_exc()
-            filename = paths.logs("critical-error-{ts}-{rnd}.tb".format(
-                ts=datetime.datetime.now().isoformat(),
-                rnd=uuid.uuid4().hex
+        if log_event.DEBUG_LOG:
+            debug_log("Processing PubSub message {event} from {source}".format(
+                event=describe_events(parsed_message), source=client_source
             ))
-            fp = open(filename, "w")
-            fp.write(json.dumps(parsed_message, sort_keys=True, indent=2))
-            fp.write("\nTraceback:\n")
-            fp.write(traceback.format_exc())
-            fp.close()
-            if settings.RUN_MODE == settings.RUN_MODES.DEV:
-                raise
-        if processed_analytics is None:
-            debug_log("No updates")
-            return []
+
+        # Run the message through all event processors at once, so
+        # their KVS calls overlap. If one breaks, the others still
+        # run, and we keep what they return. We log each failure.
+        results = await asyncio.gather(
+            *[ep(parsed_message) for ep in event_processors],
+            return_exceptions=True
+        )
+        processed_analytics = []
+        errors = []
+        for result in results:
+            if isinstance(result, learning_observer.exceptions.ReducerErrors):
+                errors.extend(result.errors)
+                processed_analytics.append(result.result)
+            elif isinstance(result, Exception):
+                errors.append(result)
+            elif isinstance(result, BaseException):
+                raise result  # E.g. we were cancelled
+            else:
+                processed_analytics.append(result)
+        for error in errors:
+            log_reducer_error(parsed_message, error)
+        if errors and settings.RUN_MODE == settings.RUN_MODES.DEV:
+            raise errors[0]
         # Transitional code.
         #
         # We'd eventually like to return only lists of outgoing
@@ -107,9 +157,9 @@ async def student_event_pipeline(metadata):
         # modules return `None` to do nothing, events, or lists of
         # events.
         #
-        # That's a major refactor away. We'd like to pass in lists /
-        # iterators of incoming events so we can handle microbatches,
-        # and generate lists of outgoing events too.
+        # That's a major refactor away. We pass in lists of incoming
+        # events to handle microbatches (see `Ingestion`), but we'd
+        # like to generate lists of outgoing events too.
         if not isinstance(processed_analytics, list):
             print("FIXME: Should return list")
             processed_analytics = [processed_analytics]
@@ -117,6 +167,344 @@ async def student_event_pipeline(metadata):
     return pipeline
 
 
+def log_reducer_error(parsed_message, error):
+    '''
+    A reducer failed. We log the event(s) and the traceback to their own
+    file, so we can reproduce the problem.
+    '''
+    error_traceback = "".join(traceback.format_exception(type(error), error, error.__traceback__))
+    print(error_traceback)
+    filename = paths.logs("critical-error-{ts}-{rnd}.tb".format(
+        ts=datetime.datetime.now().isoformat(),
+        rnd=uuid.uuid4().hex
+    ))
+    fp = open(filename, "w")
+    fp.write(json.dumps(parsed_message, sort_keys=True, indent=2))
+    fp.write("\nTraceback:\n")
+    fp.write(error_traceback)
+    fp.close()
+
+
+def describe_events(events):
+    '''
+    Short description of an event, or of a microbatch of events, for
+    debug logs
+    '''
+    if isinstance(events, list):
+        return "[" + ", ".join(event["client"]["event"] for event in events) + "]"
+    return events["client"]["event"]
+
+
+async def archive_event(event):
+    '''
+    Log an incoming event, to the main log and the websocket log. We
+    encode it once, for both. If the archive writer is behind, this
+    waits for it.
+    '''
+    encoded_event = log_event.encode_json_line(event)
+    await log_event.log_event_async(encoded_event, preencoded=True)
+    await log_event.log_event_async(
+        encoded_event,
+        "incoming_websocket", preencoded=True, timestamp=True)
+    return encoded_event
+
+
+class StudentSession(object):
+    '''
+    One student's websocket connection. Once we know who the student is
+    (`metadata` has `auth`), we build their event pipeline, and keep it
+    until the connection closes. Building a pipeline sets up every
+    reducer, so we don't want to do it per event.
+    '''
+    def __init__(self, metadata, ws=None):
+        self.metadata = metadata
+        self.ws = ws
+        self.pipeline = None
+        # Events waiting in the ingestion queue, oldest first, and
+        # whether a worker will get to them
+        self.pending = collections.deque()
+        self.scheduled = False
+        self.idle = asyncio.Event()
+        self.idle.set()
+        # If a worker fails on one of our events, we raise it on the
+        # websocket
+        self.error = None
+        # Acknowledgements on their way to the client
+        self.sending = set()
+
+    async def open(self):
+        '''
+        Build the pipeline. We call this once, after authentication.
+        '''
+        self.pipeline = await student_event_pipeline(metadata=self.metadata)
+
+    def compile(self, request, client_event, server_data=None):
+        '''
+        Add what we know about the server and the student to an
+        incoming event
+        '''
+        if log_event.DEBUG_LOG:
+            debug_log("Compiling event for reducer: " + client_event["event"])
+        return {
+            "client": client_event,
+            "server": server_data or compile_server_data(request),
+            "metadata": self.metadata
+        }
+
+    async def event(self, request, client_event, server_data=None):
+        '''
+        Compile an incoming event, and archive it
+        '''
+        event = self.compile(request, client_event, server_data)
+        await archive_event(event)
+        return event
+
+    async def handle(self, request, client_event, server_data=None):
+        '''
+        Archive an event, and run it through the pipeline, without going
+        through the ingestion queue
+        '''
+        event = await self.event(request, client_event, server_data)
+        return await self.pipeline(event)
+
+    async def handle_batch(self, events):
+        '''
+        Run a list of events (from `event`, so already archived)
+        through the pipeline together
+        '''
+        return await self.pipeline(events)
+
+    def acknowledge(self, seq):
+        '''
+        Tell the client we've handled everything up to batch `seq`, once
+        the archive writer has written it out, so a crash can't lose
+        events the client has dropped. We don't wait for that here: the
+        writer lets us know, and we send the acknowledgement then.
+        '''
+        if self.ws is None or self.ws.closed:
+            return
+        loop = asyncio.get_running_loop()
+
+        def committed():
+            try:
+                loop.call_soon_threadsafe(self.send_acknowledgement, seq)
+            except RuntimeError:
+                # The event loop is closed, so the websocket is too
+                pass
+        log_event.when_committed(committed)
+
+    def send_acknowledgement(self, seq):
+        '''
+        Send an acknowledgement for batch `seq`. Acknowledgements go
+        out in order, since the writer lets us know in order. If a later
+        batch failed in the meantime, this one was still handled, so we
+        still acknowledge it.
+        '''
+        if self.ws.closed:
+            return
+        task = asyncio.ensure_future(self.send_json({"ack": seq}))
+        self.sending.add(task)
+        task.add_done_callback(self.sending.discard)
+
+    async def send_json(self, message):
+        '''
+        Send a message to the client, if it's still there
+        '''
+        try:
+            await self.ws.send_json(message)
+        except ConnectionError:
+            # The client will send the batch again when it reconnects
+            pass
+
+    async def shed(self, encoded_event):
+        '''
+        Skip the pipeline for an event we've archived (`encoded_event`
+        is what `archive_event` returned). We log it to its own file,
+        so we can replay it later.
+        '''
+        await log_event.log_event_async(encoded_event, "shed_events", preencoded=True, timestamp=True)
+
+    async def close(self):
+        '''
+        Reducers may be holding this student's state in memory, so we
+        have them write it back.
+        '''
+        if self.pipeline is not None:
+            await stream_analytics.helpers.flush_write_behind(self.metadata)
+        self.pipeline = None
+
+
+class Ingestion(object):
+    '''
+    A bounded queue of incoming events, and the worker tasks which run
+    them through the reducers.
+
+    Each session keeps its own events, in order, and is on the queue of
+    sessions with work at most once, so one worker at a time handles a
+    student's events. A worker takes up to `MICROBATCH_EVENTS` events
+    from a session, runs them through the pipeline together, and then
+    puts the session back at the end of the line, so one busy student
+    doesn't hold up everyone else. All reducer work happens in the
+    workers, so there's never more than `workers` batches in flight.
+    Archiving doesn't: we archive events as they come in.
+    '''
+    def __init__(self, workers, queue_size, overload):
+        self.queue_size = queue_size
+        self.overload = overload
+        self.sessions = asyncio.Queue()
+        self.queued = 0
+        self.busy = 0
+        self.space = asyncio.Condition()
+        self.stats = {
+            'received': 0,
+            'processed': 0,
+            'shed': 0,
+            'waited': 0,
+            'errors': 0,
+            'max_queued': 0,
+            'wait_seconds': 0,
+            'max_wait_seconds': 0
+        }
+        self.workers = [asyncio.ensure_future(self.worker()) for i in range(workers)]
+
+    async def put(self, session, request, client_event):
+        '''
+        Archive an event from a session, and queue it up for the
+        reducers. If the queue is full, we wait for room, or shed the
+        event. We return `False` if we shed it.
+        '''
+        # We archive on receipt, so the archive has events in the order
+        # they came in, whether or not we shed them, and a crash doesn't
+        # lose events still in the queue.
+        event = session.compile(request, client_event)
+        encoded_event = await archive_event(event)
+        self.stats['received'] += 1
+        if self.queued >= self.queue_size:
+            if self.overload == 'shed':
+                self.stats['shed'] += 1
+                await session.shed(encoded_event)
+                return False
+            self.stats['waited'] += 1
+            async with self.space:
+                await self.space.wait_for(lambda: self.queued < self.queue_size)
+        self.queued += 1
+        self.stats['max_queued'] = max(self.stats['max_queued'], self.queued)
+        session.pending.append((time.monotonic(), event))
+        session.idle.clear()
+        if not session.scheduled:
+            session.scheduled = True
+            self.sessions.put_nowait(session)
+        return True
+
+    def acknowledge(self, session, seq):
+        '''
+        Acknowledge batch `seq` once the session's events so far have
+        been through the reducers (or shed), and archived. If we're not
+        done with them, a worker acknowledges the batch once it is. We
+        don't acknowledge anything after an error, so the client sends
+        those events again.
+        '''
+        if session.idle.is_set():
+            if session.error is None:
+                session.acknowledge(seq)
+        else:
+            session.pending.append(Acknowledgement(seq))
+
+    async def drain(self, session):
+        '''
+        Wait until a session's events have all been handled
+        '''
+        await session.idle.wait()
+
+    async def worker(self):
+        '''
+        Handle events, one session at a time
+        '''
+        while True:
+            session = await self.sessions.get()
+            # We take events up to the end of a batch from the client,
+            # so we can acknowledge it once they're done
+            events = []
+            while session.pending and len(events) < MICROBATCH_EVENTS and \
+                    not isinstance(session.pending[0], Acknowledgement):
+                queued_at, event = session.pending.popleft()
+                wait = time.monotonic() - queued_at
+                self.stats['wait_seconds'] += wait
+                self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], wait)
+                events.append(event)
+            if events:
+                self.queued -= len(events)
+                async with self.space:
+                    self.space.notify(len(events))
+                self.busy += 1
+                try:
+                    await session.handle_batch(events)
+                except Exception as e:
+                    self.stats['errors'] += 1
+                    traceback.print_exc()
+                    session.error = e
+                finally:
+                    self.busy -= 1
+                    self.stats['processed'] += len(events)
+            while session.pending and isinstance(session.pending[0], Acknowledgement):
+                seq = session.pending.popleft().seq
+                if session.error is None:
+                    session.acknowledge(seq)
+            if session.pending:
+                self.sessions.put_nowait(session)
+            else:
+                session.scheduled = False
+                session.idle.set()
+
+    def status(self):
+        '''
+        Queue statistics, for the status page
+        '''
+        return {
+            'queued': self.queued,
+            'queue_size': self.queue_size,
+            'overload': self.overload,
+            'workers': len(self.workers),
+            'busy': self.busy,
+            'received': self.stats['received'],
+            'processed': self.stats['processed'],
+            'shed': self.stats['shed'],
+            'waited': self.stats['waited'],
+            'errors': self.stats['errors'],
+            'max_queued': self.stats['max_queued'],
+            'mean_wait_seconds': self.stats['wait_seconds'] / max(1, self.stats['processed']),
+            'max_wait_seconds': self.stats['max_wait_seconds']
+        }
+
+
+def ingestion():
+    '''
+    The ingestion queue for this process. Like the KVS connection pool,
+    it belongs to an event loop, so we make a new one if that changes.
+    '''
+    global _INGESTION, _INGESTION_LOOP
+    loop = asyncio.get_running_loop()
+    if _INGESTION is None or _INGESTION_LOOP is not loop:
+        config = settings.settings.get('ingestion', {})
+        _INGESTION = Ingestion(
+            workers=config.get('workers', INGESTION_WORKERS),
+            queue_size=config.get('queue_size', INGESTION_QUEUE_SIZE),
+            overload=config.get('overload', INGESTION_OVERLOAD)
+        )
+        _INGESTION_LOOP = loop
+    return _INGESTION
+
+
+def ingestion_status():
+    '''
+    Statistics for the ingestion queue, or `None` if we haven't had
+    any events yet.
+    '''
+    if _INGESTION is None:
+        return None
+    return _INGESTION.status()
+
+
 async def ajax_event_request(request):
     '''
     This is the original HTTP AJAX logging API. It is deprecated in
@@ -158,18 +546,16 @@ async def handle_incoming_client_event(metadata):
 
     pipeline = await student_event_pipeline(metadata=metadata)
 
-    async def handler(request, client_event):
-        debug_log("Compiling event for reducer: " + client_event["event"])
+    async def handler(request, client_event, server_data=None):
+        if log_event.DEBUG_LOG:
+            debug_log("Compiling event for reducer: " + client_event["event"])
         event = {
             "client": client_event,
-            "server": compile_server_data(request),
+            "server": server_data or compile_server_data(request),
             "metadata": metadata
         }
 
-        log_event.log_event(event)
-        log_event.log_event(
-            json.dumps(event, sort_keys=True),
-            "incoming_websocket", preencoded=True, timestamp=True)
+        await archive_event(event)
         if PUBSUB:
             print(pubsub_client)
         outgoing = await pipeline(event)
@@ -217,47 +603,67 @@ async def incoming_websocket_handler(request):
                 break
         # print(event_metadata)
 
-    event_handler = None
-    AUTHENTICATED = False
-
-    async for msg in ws:
-        # If web socket closed, we're done.
-        if msg.type == aiohttp.WSMsgType.ERROR:
-            print('ws connection closed with exception %s' %
-                  ws.exception())
-            return
+    session = StudentSession(event_metadata, ws=ws)
 
-        # If we receive an unknown event type, we keep going, but we
-        # print an error to the console. If we got some kind of e.g.
-        # wonky ping or keep-alive or something we're unaware of, we'd
-        # like to handle that gracefully.
-        if msg.type != aiohttp.WSMsgType.TEXT:
-            print("!!!!!! Unknown event type !!!!!!!")
-            print(msg.type)
-            debug_log("Unknown event type: " + msg.type)
-
-        debug_log("Web socket message received")
-        client_event = json.loads(msg.data)
-
-        # We set up metadata based on the first event, plus any headers
-        if not AUTHENTICATED:
-            # E.g. is this from Writing Observer? Some math assessment? Etc. We dispatch on this
-            if 'source' in json_msg:
-                event_metadata['source'] = json_msg['source']
-            event_metadata['auth'] = await learning_observer.auth.events.authenticate(
-                request=request,
-                headers=header_events,
-                first_event=client_event,
-                source=json_msg['source']
-            )
-            AUTHENTICATED = True
-
-        event_handler = await handle_incoming_client_event(metadata=event_metadata)
-
-        debug_log(
-            "Dispatch incoming ws event: " + client_event['event']
-        )
-        await event_handler(request, client_event)
+    try:
+        async for msg in ws:
+            # If web socket closed, we're done.
+            if msg.type == aiohttp.WSMsgType.ERROR:
+                print('ws connection closed with exception %s' %
+                      ws.exception())
+                return
+
+            # If we receive an unknown event type, we keep going, but we
+            # print an error to the console. If we got some kind of e.g.
+            # wonky ping or keep-alive or something we're unaware of, we'd
+            # like to handle that gracefully.
+            if msg.type != aiohttp.WSMsgType.TEXT:
+                print("!!!!!! Unknown event type !!!!!!!")
+                print(msg.type)
+                debug_log("Unknown event type: " + msg.type)
+
+            debug_log("Web socket message received")
+            frame = json.loads(msg.data)
+            # A batch of events, which we acknowledge, or (from older
+            # clients) a single event, which we don't
+            if 'events' in frame:
+                client_events = frame['events']
+                seq = frame.get('seq')
+            else:
+                client_events = [frame]
+                seq = None
+
+            for client_event in client_events:
+                # We set up metadata based on the first event, plus any
+                # headers, and then the pipeline for this student.
+                if session.pipeline is None:
+                    # E.g. is this from Writing Observer? Some math assessment? Etc. We dispatch on this
+                    if 'source' in json_msg:
+                        event_metadata['source'] = json_msg['source']
+                    event_metadata['auth'] = await learning_observer.auth.events.authenticate(
+                        request=request,
+                        headers=header_events,
+                        first_event=client_event,
+                        source=json_msg['source']
+                    )
+                    await session.open()
+
+                if log_event.DEBUG_LOG:
+                    debug_log(
+                        "Dispatch incoming ws event: " + client_event['event']
+                    )
+                # This waits if the server is busy, so we stop reading
+                # from the socket.
+                await ingestion().put(session, request, client_event)
+                if session.error is not None:
+                    raise session.error
+
+            if seq is not None:
+                ingestion().acknowledge(session, seq)
+    finally:
+        if session.pipeline is not None:
+            await ingestion().drain(session)
+        await session.close()
 
     debug_log('Websocket connection closed')
     return ws
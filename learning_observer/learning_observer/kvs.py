@@ -10,31 +10,187 @@ Keys are strings. Values are JSON objects.
 
 To read objects:
 
+We also support append-only lists of JSON objects (`append`,
+`get_list`, and `trim_list`). These are helpful for logs of changes,
+where we'd rather not rewrite a large object on every update.
+
+To work with many keys at once, use `mget` and `mset`, or queue up
+several operations in a pipeline, which goes to redis in one round
+trip:
+
+    async with kvs.pipeline() as pipeline:
+        pipeline.set('a', 1)
+        b = pipeline.get('b')
+    print(b.result())
+
+Rather than walking through every key (`keys`), use `scan`, which
+takes a pattern, and doesn't block redis:
+
+    async for key in kvs.scan('Internal:*'):
+        ...
+
+We also support sets of strings (`add_to_set` and `get_set`), which
+we use for indexes (e.g. of which students have data). Lists and sets
+aren't values, so `mget` gives `None` for them; `key_type` says which
+kind of thing is in a key.
+
+Reducers read one key, and write two (their internal and external
+state). `get_versioned` and `set_pair` do this in one round trip
+each. Every `set_pair` bumps a version number on the first key, and
+`set_pair` can be told to only write if the version hasn't changed
+since we read it (optimistic concurrency).
+
+The in-memory store keeps its own copy of what we write, and hands out
+copies on read, so callers can't change stored data behind its back
+(as with redis). Since JSON strings and numbers are immutable, copies
+share them, and only copy dictionaries and lists. Making the copy also
+checks we were given JSON.
+
+In redis, values are encoded by `kvs_codec` (a fast serializer, and
+compression for large values), as configured under `kvs` / `codec`.
 '''
 
 import asyncio
-import copy
+import collections
+import contextlib
+import fnmatch
 import json
 import sys
+import time
 
 import asyncio_redis
+import asyncio_redis.encoders
 
+import learning_observer.kvs_codec
 import learning_observer.settings
 
 OBJECT_STORE = dict()
 
+# Lists (see `append`) and sets (see `add_to_set`). We keep these
+# apart from `OBJECT_STORE`, so reading one as a value gives `None`, as
+# `mget` does in redis, and so `key_type` can tell them apart.
+LIST_STORE = dict()
+SET_STORE = dict()
+
+
+def _set_value(key, value):
+    '''
+    Write a value to the in-memory store. As in redis, this replaces a
+    list or set in the same key.
+    '''
+    OBJECT_STORE[key] = value
+    LIST_STORE.pop(key, None)
+    SET_STORE.pop(key, None)
+
+
+# Versions of keys written with `set_pair`
+VERSIONS = dict()
+
+
+def _json_copy(value):
+    '''
+    Copy a JSON object, as if we had gone through `json.dumps` and
+    `json.loads`, but without serializing: Tuples come back as lists,
+    and dictionary keys as strings. Like `json.dumps`, we raise a
+    `TypeError` if we're not given JSON.
+    '''
+    if isinstance(value, (str, int, float)) or value is None:
+        return value
+    if isinstance(value, dict):
+        copied = {}
+        for key, item in value.items():
+            if not isinstance(key, str):
+                if not isinstance(key, (int, float)) and key is not None:
+                    raise TypeError("keys must be str, int, float, bool or None, not " + type(key).__name__)
+                key = json.dumps(key)
+            copied[key] = _json_copy(item)
+        return copied
+    if isinstance(value, (list, tuple)):
+        return [_json_copy(item) for item in value]
+    raise TypeError("Object of type {type} is not JSON serializable".format(
+        type=type(value).__name__
+    ))
+
+
+def version_key(key):
+    '''
+    Where we keep the version of `key`, in stores which need a key for
+    it.
+    '''
+    return "Version:" + key
+
+
+class _Pipeline():
+    '''
+    KVS operations, queued up to run together (see `pipeline` in the
+    KVS classes). Each returns a future, which has its result once we
+    leave the `async with` block.
+    '''
+    def __init__(self):
+        self.operations = []
+
+    def queue(self, method, *args):
+        '''
+        Queue a call to a KVS method
+        '''
+        future = asyncio.get_event_loop().create_future()
+        self.operations.append((method, args, future))
+        return future
+
+    def get(self, key):
+        return self.queue('__getitem__', key)
+
+    def set(self, key, value):
+        return self.queue('set', key, value)
+
+    def append(self, key, value):
+        return self.queue('append', key, value)
+
+    def get_list(self, key):
+        return self.queue('get_list', key)
+
+    def trim_list(self, key, count):
+        return self.queue('trim_list', key, count)
+
+    def add_to_set(self, key, members):
+        return self.queue('add_to_set', key, members)
+
+    def get_set(self, key):
+        return self.queue('get_set', key)
+
+    async def run(self, kvs):
+        '''
+        Run everything we queued (all at once, so it can be pipelined),
+        and hand out the results.
+        '''
+        results = await asyncio.gather(
+            *[getattr(kvs, method)(*args) for method, args, future in self.operations],
+            return_exceptions=True
+        )
+        for (method, args, future), result in zip(self.operations, results):
+            if isinstance(result, BaseException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
 
 class InMemoryKVS():
     '''
     Stores items in-memory. Items expire on system restart.
     '''
+    # Nothing expires while we're running (see `_RedisKVS`)
+    expire = None
+
     async def __getitem__(self, key):
         '''
         Syntax:
 
         >> await kvs['item']
         '''
-        return copy.deepcopy(OBJECT_STORE.get(key, None))
+        return _json_copy(OBJECT_STORE.get(key, None))
 
     async def set(self, key, value):
         '''
@@ -49,9 +205,77 @@ class InMemoryKVS():
 
         So we use an explict set function.
         '''
-        json.dumps(value)  # Fail early if we're not JSON
         assert isinstance(key, str), "KVS keys must be strings"
-        OBJECT_STORE[key] = value
+        _set_value(key, _json_copy(value))
+
+    async def get_versioned(self, key):
+        '''
+        Syntax:
+        >> value, version = await get_versioned('key')
+
+        Read `key`, along with its version (see `set_pair`).
+        '''
+        return await self[key], VERSIONS.get(key, 0)
+
+    async def set_pair(self, key, value, other_key, other_value, version=None, other_unchanged=False):
+        '''
+        Syntax:
+        >> await set_pair('internal', state, 'external', summary)
+
+        Write two keys at once, and bump the version of the first. If
+        we're given a `version`, we only write if the version of `key`
+        still matches (e.g. no one else wrote it since our
+        `get_versioned`). Returns whether we wrote.
+
+        If `other_key` is `None`, we only write the first key. If
+        `other_unchanged`, `other_value` is what we last wrote to
+        `other_key`: we only write it if it's gone.
+        '''
+        assert isinstance(key, str), "KVS keys must be strings"
+        value = _json_copy(value)
+        other_value = _json_copy(other_value)
+        if version is not None and VERSIONS.get(key, 0) != version:
+            return False
+        _set_value(key, value)
+        if other_key is not None and not (other_unchanged and other_key in OBJECT_STORE):
+            assert isinstance(other_key, str), "KVS keys must be strings"
+            _set_value(other_key, other_value)
+        VERSIONS[key] = VERSIONS.get(key, 0) + 1
+        return True
+
+    async def mget(self, keys):
+        '''
+        Syntax:
+        >> await mget(['key1', 'key2'])
+
+        Read several keys. Returns a list of values (`None` where
+        there's nothing).
+        '''
+        return [_json_copy(OBJECT_STORE.get(key, None)) for key in keys]
+
+    async def mset(self, mapping):
+        '''
+        Syntax:
+        >> await mset({'key1': value1, 'key2': value2})
+
+        Write several keys.
+        '''
+        for key, value in mapping.items():
+            await self.set(key, value)
+
+    @contextlib.asynccontextmanager
+    async def pipeline(self):
+        '''
+        Syntax:
+        >> async with kvs.pipeline() as pipeline:
+        >>     pipeline.set('key', value)
+
+        Queue up operations, and run them together (see `_Pipeline`).
+        In memory, this is just for compatibility with redis.
+        '''
+        pipeline = _Pipeline()
+        yield pipeline
+        await pipeline.run(self)
 
     async def keys(self):
         '''
@@ -59,24 +283,332 @@ class InMemoryKVS():
 
         Eventually, this might support wildcards.
         '''
-        return list(OBJECT_STORE.keys())
+        return list(OBJECT_STORE) + list(LIST_STORE) + list(SET_STORE)
+
+    async def key_type(self, key):
+        '''
+        What's stored in `key`: `'value'`, `'list'`, `'set'`, or `None`
+        if there's nothing there.
+        '''
+        for key_type, store in [('value', OBJECT_STORE), ('list', LIST_STORE), ('set', SET_STORE)]:
+            if key in store:
+                return key_type
+        return None
+
+    async def append(self, key, value):
+        '''
+        Syntax:
+        >> await append('key', value)
+
+        Append `value` (a json object) to the list stored in `key`.
+        Returns the new length of the list.
+        '''
+        assert isinstance(key, str), "KVS keys must be strings"
+        OBJECT_STORE.pop(key, None)
+        LIST_STORE.setdefault(key, []).append(_json_copy(value))
+        return len(LIST_STORE[key])
+
+    async def get_list(self, key):
+        '''
+        Return the list stored in `key`, or an empty list.
+        '''
+        return _json_copy(LIST_STORE.get(key, []))
+
+    async def trim_list(self, key, count):
+        '''
+        Remove the first `count` items from the list stored in `key`.
+        '''
+        del LIST_STORE.get(key, [])[:count]
+        if key in LIST_STORE and not LIST_STORE[key]:
+            del LIST_STORE[key]
+
+    async def scan(self, match='*'):
+        '''
+        Syntax:
+        >> async for key in kvs.scan('Internal:*'):
+
+        Iterate through keys matching a (glob-style) pattern.
+        '''
+        for key in fnmatch.filter(await self.keys(), match):
+            yield key
+
+    async def add_to_set(self, key, members):
+        '''
+        Syntax:
+        >> await add_to_set('key', ['a', 'b'])
+
+        Add strings to the set stored in `key`.
+        '''
+        assert isinstance(key, str), "KVS keys must be strings"
+        assert all(isinstance(member, str) for member in members), "Set members must be strings"
+        OBJECT_STORE.pop(key, None)
+        SET_STORE.setdefault(key, set()).update(members)
+
+    async def get_set(self, key):
+        '''
+        Return the set stored in `key`, as a sorted list (empty if
+        there's nothing there).
+        '''
+        return sorted(SET_STORE.get(key, set()))
+
+
+# Redis connections come from a pool shared by the whole process (see
+# `_RedisPool`). These are the defaults for its size, and for how long
+# a connection may sit idle before we check it's alive. They can be
+# set under `kvs` / `pool` in the settings file.
+POOL_MINSIZE = 1
+POOL_MAXSIZE = 20
+POOL_HEALTH_CHECK_SECONDS = 30
+
+_POOL = None
+_POOL_LOOP = None
+
+# Once we've loaded `SET_PAIR_SCRIPT` into redis, we call it by hash
+_SET_PAIR_SHA = None
+
+# Write one or two keys, and bump the version of the first, in one
+# round trip. KEYS are the first key, its version key, and (optionally)
+# the second key. ARGV are the version we expect (or '' to write
+# regardless), the expiry (or '' for none), the values, and whether
+# the second value is unchanged. If it is, we don't send it: we only
+# refresh the second key's expiry. We return 2 if it's gone, so the
+# caller can write it again.
+SET_PAIR_SCRIPT = '''
+if ARGV[1] ~= '' and (redis.call('GET', KEYS[2]) or '0') ~= ARGV[1] then
+    return 0
+end
+local expire = {}
+if ARGV[2] ~= '' then
+    expire = {'EX', ARGV[2]}
+end
+local result = 1
+redis.call('SET', KEYS[1], ARGV[3], unpack(expire))
+if #KEYS == 3 then
+    if ARGV[5] ~= 'unchanged' then
+        redis.call('SET', KEYS[3], ARGV[4], unpack(expire))
+    elseif redis.call('EXISTS', KEYS[3]) == 0 then
+        result = 2
+    elseif ARGV[2] ~= '' then
+        redis.call('EXPIRE', KEYS[3], ARGV[2])
+    end
+end
+redis.call('INCR', KEYS[2])
+if ARGV[2] ~= '' then
+    redis.call('EXPIRE', KEYS[2], ARGV[2])
+end
+return result
+'''
+
+
+class _Encoder(asyncio_redis.encoders.BaseEncoder):
+    '''
+    We send keys to redis as text, and values as bytes (see
+    `kvs_codec`), so we take either. Everything comes back as bytes.
+    '''
+    native_type = (str, bytes)
+
+    def encode_from_native(self, data):
+        if isinstance(data, str):
+            return data.encode('utf-8')
+        return data
+
+    def decode_to_native(self, data):
+        return data
+
+
+class _RedisPool():
+    '''
+    A pool of redis connections, shared by every `_RedisKVS` in the
+    process. We open `minsize` connections up front, and more as
+    needed, up to `maxsize`. Past that, callers wait for a connection
+    to free up.
+
+    Before handing out a connection which has sat idle for more than
+    `health_check_seconds`, we ping it, and replace it if it's dead.
+    '''
+    def __init__(self, minsize, maxsize, health_check_seconds):
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.health_check_seconds = health_check_seconds
+        self.idle = collections.deque()  # (connection, when it was released)
+        self.size = 0
+        self.in_use = 0
+        self.waiters = 0
+        self.freed = asyncio.Condition()
+        self.stats = collections.Counter()
+
+    async def open(self):
+        '''
+        Open a new connection
+        '''
+        self.size += 1
+        try:
+            connection = await asyncio_redis.Connection.create(encoder=_Encoder())
+        except Exception:
+            self.size -= 1
+            raise
+        self.stats['opened'] += 1
+        return connection
+
+    def close(self, connection):
+        '''
+        Close a connection, and forget it
+        '''
+        self.size -= 1
+        self.stats['closed'] += 1
+        connection.close()
+
+    async def healthy(self, connection, released):
+        '''
+        Check a connection we're about to hand out still works
+        '''
+        if not connection.protocol.is_connected:
+            return False
+        if time.monotonic() - released < self.health_check_seconds:
+            return True
+        try:
+            await asyncio.wait_for(connection.ping(), self.health_check_seconds)
+            return True
+        except (asyncio.TimeoutError, asyncio_redis.Error):
+            return False
+
+    async def acquire(self):
+        '''
+        Get a connection, waiting for one if the pool is at `maxsize`
+        '''
+        while self.size < self.minsize:
+            self.idle.append((await self.open(), time.monotonic()))
+        start = time.monotonic()
+        waited = False
+        while True:
+            while self.idle:
+                connection, released = self.idle.popleft()
+                if await self.healthy(connection, released):
+                    break
+                self.stats['health_check_failures'] += 1
+                self.close(connection)
+            else:
+                if self.size < self.maxsize:
+                    connection = await self.open()
+                else:
+                    waited = True
+                    self.waiters += 1
+                    try:
+                        async with self.freed:
+                            await self.freed.wait()
+                    finally:
+                        self.waiters -= 1
+                    continue
+            break
+        self.in_use += 1
+        self.stats['acquired'] += 1
+        if waited:
+            wait = time.monotonic() - start
+            self.stats['waited'] += 1
+            self.stats['wait_seconds'] += wait
+            self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], wait)
+        return connection
+
+    async def release(self, connection):
+        '''
+        Give a connection back to the pool
+        '''
+        self.in_use -= 1
+        self.idle.append((connection, time.monotonic()))
+        async with self.freed:
+            self.freed.notify()
+
+    @contextlib.asynccontextmanager
+    async def connection(self):
+        '''
+        Syntax:
+        >> async with pool.connection() as redis:
+        >>     await redis.get('key')
+        '''
+        connection = await self.acquire()
+        try:
+            yield connection
+        finally:
+            await self.release(connection)
+
+    def status(self):
+        '''
+        Pool statistics, for the status page
+        '''
+        return {
+            'size': self.size,
+            'in_use': self.in_use,
+            'idle': len(self.idle),
+            'waiters': self.waiters,
+            'minsize': self.minsize,
+            'maxsize': self.maxsize,
+            'opened': self.stats['opened'],
+            'closed': self.stats['closed'],
+            'health_check_failures': self.stats['health_check_failures'],
+            'acquired': self.stats['acquired'],
+            'waited': self.stats['waited'],
+            'mean_wait_seconds': self.stats['wait_seconds'] / max(1, self.stats['waited']),
+            'max_wait_seconds': self.stats['max_wait_seconds']
+        }
+
+
+def _pool():
+    '''
+    The process-wide connection pool, created on first use. We make a
+    new one if the event loop changes (as it does between test runs),
+    since connections belong to a loop.
+    '''
+    global _POOL, _POOL_LOOP
+    loop = asyncio.get_event_loop()
+    if _POOL is None or _POOL_LOOP is not loop:
+        config = learning_observer.settings.settings['kvs'].get('pool', {})
+        _POOL = _RedisPool(
+            minsize=config.get('minsize', POOL_MINSIZE),
+            maxsize=config.get('maxsize', POOL_MAXSIZE),
+            health_check_seconds=config.get('health_check_seconds', POOL_HEALTH_CHECK_SECONDS)
+        )
+        _POOL_LOOP = loop
+    return _POOL
+
+
+def pool_status():
+    '''
+    Statistics for the redis connection pool, or `None` if we're not
+    using one.
+    '''
+    if _POOL is None:
+        return None
+    return _POOL.status()
+
+
+# What redis `TYPE` calls the kinds of keys we store (see `key_type`)
+REDIS_TYPES = {
+    'string': 'value',
+    'list': 'list',
+    'set': 'set'
+}
 
 
 class _RedisKVS():
     '''
-    Stores items in redis.
+    Stores items in redis. All instances share one pool of
+    connections.
     '''
     def __init__(self, expire):
-        self.connection = None
         self.expire = expire
+        self.pipelined = None
 
-    async def connect(self):
+    @contextlib.asynccontextmanager
+    async def connection(self):
         '''
-        asyncio_redis auto-reconnects. We can't do async in __init__. So
-        we connect on the first get / set.
+        A connection from the pool. While a pipeline runs, everything
+        goes through its connection.
         '''
-        if self.connection is None:
-            self.connection = await asyncio_redis.Connection.create()
+        if self.pipelined is not None:
+            yield self.pipelined
+        else:
+            async with _pool().connection() as redis:
+                yield redis
 
     async def __getitem__(self, key):
         '''
@@ -84,10 +616,10 @@ class _RedisKVS():
 
         >> await kvs['item']
         '''
-        await self.connect()
-        item = await self.connection.get(key)
+        async with self.connection() as redis:
+            item = await redis.get(key)
         if item is not None:
-            return json.loads(item)
+            return CODEC.decode(item)
         return None
 
     async def set(self, key, value):
@@ -103,20 +635,209 @@ class _RedisKVS():
 
         So we use an explict set function.
         '''
-        await self.connect()
-        json.dumps(value)  # Fail early if we're not JSON
         assert isinstance(key, str), "KVS keys must be strings"
-        await self.connection.set(key, json.dumps(value), expire=self.expire)
+        value = CODEC.encode(value)  # This also fails early if we're not JSON
+        async with self.connection() as redis:
+            await redis.set(key, value, expire=self.expire)
         return
 
+    async def get_versioned(self, key):
+        '''
+        Syntax:
+        >> value, version = await get_versioned('key')
+
+        Read `key`, along with its version (see `set_pair`), in one
+        round trip.
+        '''
+        async with self.connection() as redis:
+            item, version = await (await redis.mget([key, version_key(key)])).aslist()
+        return (
+            CODEC.decode(item) if item is not None else None,
+            int(version) if version is not None else 0
+        )
+
+    async def set_pair(self, key, value, other_key, other_value, version=None, other_unchanged=False):
+        '''
+        Syntax:
+        >> await set_pair('internal', state, 'external', summary)
+
+        Write two keys, and bump the version of the first, in one round
+        trip (as a Lua script, so it's atomic, too). If we're given a
+        `version`, we only write if the version of `key` still matches.
+        Returns whether we wrote.
+
+        If `other_key` is `None`, we only write the first key. If
+        `other_unchanged`, `other_value` is what we last wrote to
+        `other_key`: we don't send it, but refresh its expiry, and
+        write it again (in a second round trip) only if it's gone.
+        '''
+        global _SET_PAIR_SHA
+        assert isinstance(key, str), "KVS keys must be strings"
+        keys = [key, version_key(key)]
+        args = [
+            str(version) if version is not None else '',
+            str(self.expire) if self.expire is not None else '',
+            CODEC.encode(value)
+        ]
+        if other_key is not None:
+            assert isinstance(other_key, str), "KVS keys must be strings"
+            keys.append(other_key)
+            if other_unchanged:
+                args.extend(['', 'unchanged'])
+            else:
+                args.extend([CODEC.encode(other_value), ''])
+        async with self.connection() as redis:
+            if _SET_PAIR_SHA is None:
+                _SET_PAIR_SHA = await redis.script_load(SET_PAIR_SCRIPT)
+            try:
+                reply = await redis.evalsha(_SET_PAIR_SHA, keys=keys, args=args)
+            except asyncio_redis.exceptions.ErrorReply as e:
+                # redis restarted, and forgot our script
+                if 'NOSCRIPT' not in str(e):
+                    raise
+                _SET_PAIR_SHA = await redis.script_load(SET_PAIR_SCRIPT)
+                reply = await redis.evalsha(_SET_PAIR_SHA, keys=keys, args=args)
+            result = await reply.return_value()
+        if result == 2:
+            # We thought `other_key` was up-to-date, but it expired, or
+            # redis lost it
+            await self.set(other_key, other_value)
+        return result != 0
+
+    async def mget(self, keys):
+        '''
+        Syntax:
+        >> await mget(['key1', 'key2'])
+
+        Read several keys, in one MGET. Returns a list of values
+        (`None` where there's nothing).
+        '''
+        if not keys:
+            return []
+        async with self.connection() as redis:
+            items = await (await redis.mget(list(keys))).aslist()
+        return [CODEC.decode(item) if item is not None else None for item in items]
+
+    async def mset(self, mapping):
+        '''
+        Syntax:
+        >> await mset({'key1': value1, 'key2': value2})
+
+        Write several keys, pipelined on one connection. (We don't use
+        MSET, since it can't set an expiry.)
+        '''
+        async with self.pipeline() as pipeline:
+            for key, value in mapping.items():
+                pipeline.set(key, value)
+
+    @contextlib.asynccontextmanager
+    async def pipeline(self):
+        '''
+        Syntax:
+        >> async with kvs.pipeline() as pipeline:
+        >>     pipeline.set('key', value)
+
+        Queue up operations, and send them all down one connection
+        without waiting for replies in between (see `_Pipeline`).
+        '''
+        pipeline = _Pipeline()
+        yield pipeline
+        if self.pipelined is not None:
+            await pipeline.run(self)
+            return
+        async with _pool().connection() as redis:
+            self.pipelined = redis
+            try:
+                await pipeline.run(self)
+            finally:
+                self.pipelined = None
+
     async def keys(self):
         '''
         Return all the keys in the KVS.
 
-        This is obviously not very performant for large-scale dpeloys.
+        This is obviously not very performant for large-scale dpeloys,
+        and blocks redis while it runs. Use `scan` instead.
+        '''
+        async with self.connection() as redis:
+            return [(await k).decode('utf-8') for k in await redis.keys("*")]
+
+    async def key_type(self, key):
+        '''
+        What's stored in `key`: `'value'`, `'list'`, `'set'`, or `None`
+        if there's nothing there (or something we don't use).
+        '''
+        async with self.connection() as redis:
+            reply = await redis.type(key)
+        return REDIS_TYPES.get(reply.status)
+
+    async def append(self, key, value):
+        '''
+        Syntax:
+        >> await append('key', value)
+
+        Append `value` (a json object) to the list stored in `key`.
+        Returns the new length of the list.
+        '''
+        assert isinstance(key, str), "KVS keys must be strings"
+        async with self.connection() as redis:
+            length = await redis.rpush(key, [CODEC.encode(value)])
+            if self.expire is not None:
+                await redis.expire(key, self.expire)
+        return length
+
+    async def get_list(self, key):
+        '''
+        Return the list stored in `key`, or an empty list.
+        '''
+        async with self.connection() as redis:
+            items = await (await redis.lrange(key, 0, -1)).aslist()
+        return [CODEC.decode(item) for item in items]
+
+    async def trim_list(self, key, count):
+        '''
+        Remove the first `count` items from the list stored in `key`.
+        '''
+        async with self.connection() as redis:
+            await redis.ltrim(key, count, -1)
+
+    async def scan(self, match='*'):
+        '''
+        Syntax:
+        >> async for key in kvs.scan('Internal:*'):
+
+        Iterate through keys matching a (glob-style) pattern, with
+        SCAN, a batch at a time. We hold on to a connection until
+        we're done.
         '''
-        await self.connect()
-        return [await k for k in await self.connection.keys("*")]
+        async with self.connection() as redis:
+            cursor = await redis.scan(match=match)
+            while True:
+                key = await cursor.fetchone()
+                if key is None:
+                    break
+                yield key.decode('utf-8')
+
+    async def add_to_set(self, key, members):
+        '''
+        Syntax:
+        >> await add_to_set('key', ['a', 'b'])
+
+        Add strings to the set stored in `key`.
+        '''
+        assert isinstance(key, str), "KVS keys must be strings"
+        async with self.connection() as redis:
+            await redis.sadd(key, list(members))
+            if self.expire is not None:
+                await redis.expire(key, self.expire)
+
+    async def get_set(self, key):
+        '''
+        Return the set stored in `key`, as a sorted list (empty if
+        there's nothing there).
+        '''
+        async with self.connection() as redis:
+            return sorted(member.decode('utf-8') for member in await (await redis.smembers(key)).asset())
 
 
 class EphemeralRedisKVS(_RedisKVS):
@@ -165,6 +886,49 @@ except KeyError:
     print()
     sys.exit(-1)
 
+# How we encode values for redis (see `kvs_codec`)
+try:
+    CODEC = learning_observer.kvs_codec.Codec(
+        **learning_observer.settings.settings['kvs'].get('codec', {})
+    )
+except (TypeError, ValueError) as e:
+    print("Invalid setting kvs/codec:", e)
+    print("KVS config is currently ", end='')
+    print(learning_observer.settings.settings["kvs"])
+    print()
+    sys.exit(-1)
+
+# Where redis keeps the headers (see `kvs_codec.readable`) of every
+# kind of value anyone has written. This doesn't expire.
+CODEC_KEY = "Codec:Headers"
+
+
+async def check_codec():
+    '''
+    Make sure we can read everything in redis. Servers sharing a redis
+    may be set up to write values we can't decode (e.g. they have
+    `zstd`, and we don't). We add what we write to `CODEC_KEY`, and
+    stop if it has anything we can't read, rather than failing on
+    reads later on.
+    '''
+    kvs = KVS()
+    if not isinstance(kvs, _RedisKVS):
+        return
+    async with kvs.connection() as redis:
+        await redis.sadd(CODEC_KEY, CODEC.headers())
+        headers = await (await redis.smembers(CODEC_KEY)).asset()
+    unreadable = sorted(
+        header.decode('utf-8') for header in headers
+        if not learning_observer.kvs_codec.readable(header.decode('utf-8'))
+    )
+    if unreadable:
+        print("Redis has values we can't decode here:", ", ".join(unreadable))
+        print("Another server may be writing them. Install the same")
+        print("serializers and compression (zstandard, msgpack), or set")
+        print("kvs/codec the same everywhere.")
+        print()
+        sys.exit(-1)
+
 
 async def test():
     '''
@@ -175,18 +939,89 @@ async def test():
     mk2 = InMemoryKVS()
     ek1 = EphemeralRedisKVS()
     ek2 = EphemeralRedisKVS()
-    assert(await mk1["hi"]) is None
+    assert await mk1["hi"] is None
     print(await ek1["hi"])
-    assert(await ek1["hi"]) is None
+    assert await ek1["hi"] is None
     await mk1.set("hi", 5)
     await mk2.set("hi", 7)
     await ek1.set("hi", 8)
     await ek2.set("hi", 9)
-    assert(await mk1["hi"]) == 7
+    assert await mk1["hi"] == 7
+    for kvs in [mk1, ek1]:
+        await kvs.mset({"m1": 1, "m2": [2]})
+        assert await kvs.mget(["m1", "nothing", "m2"]) == [1, None, [2]]
+        async with kvs.pipeline() as pipeline:
+            pipeline.set("m1", 3)
+            first = pipeline.get("m1")
+            second = pipeline.get("m2")
+        assert first.result() == 3
+        assert second.result() == [2]
+        await kvs.add_to_set("set", ["b", "a"])
+        await kvs.add_to_set("set", ["b"])
+        assert await kvs.get_set("set") == ["a", "b"]
+        assert await kvs.get_set("no set") == []
+        # Sets aren't values: reading one gives nothing, as in redis
+        assert await kvs.mget(["set", "m1"]) == [None, 3]
+        assert "set" in await kvs.keys()
+        assert sorted([key async for key in kvs.scan("m*")]) == ["m1", "m2"]
+
+    # The in-memory store should act like redis: What we read or wrote
+    # shouldn't change if we change the objects we passed in or got
+    # back, and we should only take JSON.
+    state = {"text": "essay", "history": [1, 2], "meta": {"n": (1, 2)}}
+    await mk1.set("state", state)
+    state["history"].append(3)
+    state["meta"]["n"] = 5
+    read = await mk1["state"]
+    assert read == {"text": "essay", "history": [1, 2], "meta": {"n": [1, 2]}}
+    read["history"].append(4)
+    del read["meta"]
+    assert await mk2["state"] == {"text": "essay", "history": [1, 2], "meta": {"n": [1, 2]}}
+    assert await mk1["state"] is not await mk1["state"]
+    await mk1.set("keys", {1: True, None: 2.5})
+    assert await mk1["keys"] == json.loads(json.dumps({1: True, None: 2.5}))
+    item = {"a": [1]}
+    await mk1.append("items", item)
+    item["a"].append(2)
+    (await mk1.get_list("items"))[0]["a"].append(3)
+    assert await mk1.get_list("items") == [{"a": [1]}]
+    for bad in [{"a": set()}, [object()], {(1, 2): 3}]:
+        try:
+            await mk1.set("bad", bad)
+            assert False, "Stored non-JSON"
+        except TypeError:
+            pass
+    assert await mk1.append("log", 1) == 1
+    assert await mk2.append("log", 2) == 2
+    assert await ek1.append("log", 3) == 1
+    assert await ek2.append("log", 4) == 2
+    await mk1.trim_list("log", 1)
+    await ek1.trim_list("log", 1)
+    assert await mk2.get_list("log") == [2]
+    assert await ek2.get_list("log") == [4]
+    for kvs in [mk1, ek1]:
+        assert await kvs.mget(["log"]) == [None]
+        assert [await kvs.key_type(key) for key in ["m1", "log", "set", "nothing"]] == ["value", "list", "set", None]
+    for kvs in [mk1, ek1]:
+        value, version = await kvs.get_versioned("pair")
+        assert value is None
+        assert await kvs.set_pair("pair", 1, "other", 2, version)
+        assert not (await kvs.set_pair("pair", 3, "other", 4, version))
+        assert await kvs.get_versioned("pair") == (1, version + 1)
+        assert await kvs.set_pair("pair", 5, "other", 6)
+        assert await kvs["other"] == 6
+        assert await kvs.set_pair("pair", 7, None, None)
+        assert await kvs.get_versioned("pair") == (7, version + 3)
+        assert await kvs["other"] == 6
+        # An unchanged second value isn't written again, unless it's gone
+        assert await kvs.set_pair("pair", 8, "other", 6, other_unchanged=True)
+        assert await kvs["other"] == 6
+        assert await kvs.set_pair("pair", 9, "lost", 10, other_unchanged=True)
+        assert await kvs["lost"] == 10
     print(await ek1["hi"])
     print(type(await ek1["hi"]))
     print((await ek1["hi"]) == 9)
-    assert(await ek1["hi"]) == 9
+    assert await ek1["hi"] == 9
     print(await mk1.keys())
     print(await ek1.keys())
     print("Test successful")
@@ -0,0 +1,262 @@
+'''
+Encoding KVS values
+===================
+
+Redis stores bytes. We turn JSON objects into bytes with a serializer
+(the standard library's `json`, or `orjson` or `msgpack`, if they're
+installed), and compress large values (with `zstd` if it's installed,
+or `zlib`).
+
+Values from before we did this are plain JSON text. So are small
+values we write as JSON, so they stay readable with `redis-cli`.
+Everything else starts with a three-byte header:
+
+    b'\\x00' + serializer + compression
+
+For example, `b'\\x00jz'` is zlib-compressed JSON. JSON text never
+starts with a zero byte, so we can tell the two apart, and read any
+mix of old and new values, whatever we're set up to write, as long as
+we have the libraries they need: a server without `zstd` can't read
+zstd-compressed values, and one without `msgpack` can't read msgpack.
+`learning_observer.kvs.check_codec` checks this at startup.
+
+Whichever serializer we use, values come back as they would from
+JSON: dictionary keys are strings, and tuples are lists.
+
+This module doesn't read the settings file; `learning_observer.kvs`
+creates a `Codec` from the `codec` section under `kvs`:
+
+    kvs:
+        codec:
+            serializer: orjson    # json, orjson, or msgpack
+            compression: zstd     # zlib, zstd, or none
+            compress_above: 4096  # Only compress values bigger than this (in bytes)
+            level: 3              # Compression level
+
+By default, we use `orjson` and `zstd` if they're installed, and
+`json` and `zlib` if not.
+'''
+
+import json
+import zlib
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Header: a zero byte, then one byte each for the serializer and the
+# compression
+HEADER = b'\x00'
+
+JSON = b'j'
+MSGPACK = b'm'
+
+NO_COMPRESSION = b'-'
+ZLIB = b'z'
+ZSTD = b's'
+
+# Values smaller than this (once serialized) aren't worth compressing
+COMPRESS_ABOVE = 4096
+
+# Default compression levels. We favor speed: these run on every write.
+LEVELS = {
+    ZLIB: 1,
+    ZSTD: 3
+}
+
+
+def available():
+    '''
+    The serializers and compression methods we can use here
+    '''
+    serializers = ['json']
+    if orjson is not None:
+        serializers.append('orjson')
+    if msgpack is not None:
+        serializers.append('msgpack')
+    compressions = ['none', 'zlib']
+    if zstandard is not None:
+        compressions.append('zstd')
+    return serializers, compressions
+
+
+def readable(header):
+    '''
+    Can we decode values with this header (serializer and compression
+    codes, e.g. `'jz'`)?
+    '''
+    if len(header) != 2:
+        return False
+    serializer, compression = header[:1].encode('utf-8'), header[1:].encode('utf-8')
+    serializers = {JSON: True, MSGPACK: msgpack is not None}
+    compressions = {NO_COMPRESSION: True, ZLIB: True, ZSTD: zstandard is not None}
+    return serializers.get(serializer, False) and compressions.get(compression, False)
+
+
+def _string_keys(value):
+    '''
+    Turn dictionary keys into strings, as `json.dumps` does. msgpack
+    would keep them as they are, so reducer state would change shape
+    with the serializer.
+    '''
+    if isinstance(value, dict):
+        copied = {}
+        for key, item in value.items():
+            if not isinstance(key, str):
+                if not isinstance(key, (int, float)) and key is not None:
+                    raise TypeError("keys must be str, int, float, bool or None, not " + type(key).__name__)
+                key = json.dumps(key)
+            copied[key] = _string_keys(item)
+        return copied
+    if isinstance(value, (list, tuple)):
+        return [_string_keys(item) for item in value]
+    return value
+
+
+def _json_loads(data):
+    '''
+    Parse JSON (text or bytes), as fast as we can
+    '''
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class Codec(object):
+    '''
+    Turns JSON objects into bytes for the KVS, and back.
+    '''
+    def __init__(self, serializer=None, compression=None, compress_above=COMPRESS_ABOVE, level=None):
+        if serializer is None:
+            serializer = 'orjson' if orjson is not None else 'json'
+        if compression is None:
+            compression = 'zstd' if zstandard is not None else 'zlib'
+        serializers, compressions = available()
+        if serializer not in serializers or compression not in compressions:
+            raise ValueError(
+                "KVS codec {serializer} / {compression} isn't available. We can use "
+                "serializers {serializers}, and compression {compressions}".format(
+                    serializer=serializer,
+                    compression=compression,
+                    serializers=", ".join(serializers),
+                    compressions=", ".join(compressions)
+                )
+            )
+        self.serializer = serializer
+        self.serializer_code = MSGPACK if serializer == 'msgpack' else JSON
+        self.compression = {'none': NO_COMPRESSION, 'zlib': ZLIB, 'zstd': ZSTD}[compression]
+        self.compress_above = compress_above
+        self.level = level if level is not None else LEVELS.get(self.compression)
+        if self.compression == ZSTD:
+            self.compressor = zstandard.ZstdCompressor(level=self.level)
+
+    def headers(self):
+        '''
+        The serializer and compression codes of values we write (see
+        `readable`)
+        '''
+        codes = {self.serializer_code + NO_COMPRESSION, self.serializer_code + self.compression}
+        return sorted(code.decode('utf-8') for code in codes)
+
+    def serialize(self, value):
+        '''
+        Serialize a value, returning (serializer code, bytes). This
+        raises a `TypeError` if `value` isn't JSON.
+        '''
+        if self.serializer == 'orjson':
+            return JSON, orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS)
+        if self.serializer == 'msgpack':
+            return MSGPACK, msgpack.packb(_string_keys(value), use_bin_type=True)
+        return JSON, json.dumps(value).encode('utf-8')
+
+    def encode(self, value):
+        '''
+        Encode a JSON object as bytes for the KVS
+        '''
+        serializer, data = self.serialize(value)
+        if len(data) > self.compress_above and self.compression != NO_COMPRESSION:
+            if self.compression == ZSTD:
+                data = self.compressor.compress(data)
+            else:
+                data = zlib.compress(data, self.level)
+            return HEADER + serializer + self.compression + data
+        if serializer == JSON:
+            return data
+        return HEADER + serializer + NO_COMPRESSION + data
+
+    def decode(self, data):
+        '''
+        Decode bytes (or text) from the KVS, whichever way they were
+        encoded
+        '''
+        if isinstance(data, str) or data[:1] != HEADER:
+            return _json_loads(data)
+        serializer, compression, data = data[1:2], data[2:3], data[3:]
+        if compression == ZLIB:
+            data = zlib.decompress(data)
+        elif compression == ZSTD:
+            if zstandard is None:
+                raise ValueError("KVS value is zstd-compressed, but zstandard isn't installed")
+            data = zstandard.ZstdDecompressor().decompress(data)
+        elif compression != NO_COMPRESSION:
+            raise ValueError("Unknown KVS value compression: " + repr(compression))
+        if serializer == MSGPACK:
+            if msgpack is None:
+                raise ValueError("KVS value is msgpack, but msgpack isn't installed")
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        if serializer != JSON:
+            raise ValueError("Unknown KVS value serializer: " + repr(serializer))
+        return _json_loads(data)
+
+
+def test():
+    '''
+    Round-trip some values through every codec we have, and check
+    each codec reads what the others wrote.
+    '''
+    values = [
+        None, 5, "hi", [1, 2, {"a": "b"}], {"text": "essay " * 5000, "n": [1.5, -2]},
+        {1: {None: (1, 2), 2.5: True}}
+    ]
+    serializers, compressions = available()
+    codecs = [Codec(s, c) for s in serializers for c in compressions]
+    for writer in codecs:
+        for value in values:
+            encoded = writer.encode(value)
+            assert isinstance(encoded, bytes)
+            for reader in codecs:
+                assert reader.decode(encoded) == json.loads(json.dumps(value))
+        for header in writer.headers():
+            assert readable(header)
+    assert Codec('json', 'zlib').encode({"a": 1}) == b'{"a": 1}'
+    assert Codec('json', 'zlib').encode("x" * 10000)[:3] == HEADER + JSON + ZLIB
+    assert Codec('json', 'none').decode('{"old": "value"}') == {"old": "value"}
+    assert Codec('json', 'zlib').headers() == ['j-', 'jz']
+    assert not readable('xz')
+    try:
+        Codec('json', 'zlib').encode({"a": set()})
+        assert False, "Encoded non-JSON"
+    except TypeError:
+        pass
+    if msgpack is not None:
+        try:
+            Codec('msgpack', 'zlib').encode({(1, 2): "a"})
+            assert False, "Encoded a tuple key"
+        except TypeError:
+            pass
+    print("Test successful")
+
+
+if __name__ == '__main__':
+    test()
@@ -46,12 +46,25 @@ We might also have missing intermediate files. For example, if we do
 a dozen analyses, we'll want to know those happened and what those
 were, but we might not keep terabytes of data around (just enough to
 redo those analyses).
+
+Events are written by a background thread (see `_ArchiveWriter`), so
+logging an event doesn't wait on the disk. It commits events in
+groups, and we can set how often, and whether it `fsync`s, under
+`event_log` in the settings file.
 '''
 
+import asyncio
+import atexit
+import collections
 import datetime
-import inspect
 import json
 import hashlib
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
 
 import learning_observer.filesystem_state
 
@@ -59,14 +72,51 @@ import learning_observer.paths as paths
 import learning_observer.settings as settings
 
 
-mainlog = open(paths.logs("main_log.json"), "ab", 0)
-files = {}
+# Defaults for the event archive writer. We write events out in
+# groups: everything logged within `BATCH_SECONDS` of the first event
+# in a group, or `BATCH_BYTES`, whichever comes first. At most
+# `QUEUE_SIZE` lines wait to be written. Past that, `log_event_async`
+# waits (without blocking the event loop) until the disk catches up,
+# and `log_event` drops the line, and counts it.
+#
+# `FSYNC` can be 'none' (the OS writes to disk when it likes),
+# 'batch' (we `fsync` every group), or a number of seconds between
+# `fsync`s.
+QUEUE_SIZE = 10000
+BATCH_SECONDS = 0.05
+BATCH_BYTES = 256 * 1024
+FSYNC = 'none'
+
+_WRITER = None
+
+if settings.settings.get('event_log', {}).get('fsync', FSYNC) not in ['none', 'batch'] and \
+   not isinstance(settings.settings['event_log']['fsync'], (int, float)):
+    print("event_log fsync in the settings file should be 'none', 'batch', or a number of seconds")
+    sys.exit(-1)
 
 # Do we make files for exceptions? Do we print extra stuff on the console?
 #
 # On deployed systems, this can make a mess. On dev systems, this is super-helpful
 DEBUG = settings.RUN_MODE == settings.RUN_MODES.DEV or 'logging' in settings.settings['config']['debug']
 
+# How much `debug_log` records, set with `debug_log` under `config` in
+# the settings file:
+#
+# * 'none': nothing. `debug_log` returns straight away.
+# * 'messages': a time stamp, the calling function, and the message
+# * 'trace': the two functions above the caller, too
+#
+# By default, we trace if `DEBUG` is on, and record nothing if not.
+# Callers on hot paths check `DEBUG_LOG` first, so they don't build
+# messages we'd throw away.
+DEBUG_LOG_LEVELS = ['none', 'messages', 'trace']
+DEBUG_LOG_NONE, DEBUG_LOG_MESSAGES, DEBUG_LOG_TRACE = range(3)
+
+if settings.settings['config'].get('debug_log', 'trace' if DEBUG else 'none') not in DEBUG_LOG_LEVELS:
+    print("config debug_log in the settings file should be one of: " + ", ".join(DEBUG_LOG_LEVELS))
+    sys.exit(-1)
+DEBUG_LOG = DEBUG_LOG_LEVELS.index(settings.settings['config'].get('debug_log', 'trace' if DEBUG else 'none'))
+
 
 def encode_json_line(line):
     '''
@@ -139,26 +189,329 @@ with open(STARTUP_FILENAME, "w") as sfp:
     sfp.write(startup_state)
 
 
+class _ArchiveWriter(object):
+    '''
+    Writes log lines from a thread. Lines wait in a queue, and we write
+    them out in groups, with one `write` per file per group.
+
+    Each line in the queue holds one of `queue_size` slots, until it's
+    written. Coroutines waiting for a slot wait on a future in their
+    own event loop, which the writer thread resolves when it frees
+    one.
+
+    We count lines as they're queued, and as they're written. Callers
+    who want to know when what they've logged is on disk (see
+    `when_committed`) leave a callback with the count so far, which the
+    writer calls after the group that gets it there. This doesn't cut a
+    group short, so many callers can share one write and `fsync`.
+    '''
+    def __init__(self, queue_size, batch_seconds, batch_bytes, fsync):
+        self.queue = queue.Queue()
+        self.queue_size = queue_size
+        # Free slots, and `(loop, future)` for coroutines waiting for
+        # one, in order
+        self.lock = threading.Lock()
+        self.free = queue_size
+        self.waiters = collections.deque()
+        # Lines queued and written so far, and `(queued, callback)` for
+        # callers waiting for them to be written, in order
+        self.queued = 0
+        self.written = 0
+        self.callbacks = collections.deque()
+        self.batch_seconds = batch_seconds
+        self.batch_bytes = batch_bytes
+        self.fsync = fsync
+        self.files = {}
+        self.unsynced = set()
+        self.last_fsync = time.monotonic()
+        self.pid = os.getpid()
+        self.stats = {
+            'lines': 0,
+            'batches': 0,
+            'bytes': 0,
+            'fsyncs': 0,
+            'waited': 0,
+            'dropped': 0,
+            'errors': 0
+        }
+        self.thread = threading.Thread(target=self.run, name="event-log-writer", daemon=True)
+        self.thread.start()
+
+    def put(self, filename, line):
+        '''
+        Queue up a line (text, without the newline) for a log file. If
+        the queue is full, we drop the line, and return `False`.
+        '''
+        with self.lock:
+            if self.free == 0:
+                if self.stats['dropped'] == 0:
+                    print("Event log queue is full. Dropping lines.")
+                self.stats['dropped'] += 1
+                return False
+            self.free -= 1
+            self.queued += 1
+            self.queue.put((filename, line))
+        return True
+
+    async def put_async(self, filename, line):
+        '''
+        Queue up a line for a log file. If the queue is full, we wait
+        for a slot (see `release`), without blocking the event loop. If
+        we're cancelled, we don't keep a slot.
+        '''
+        with self.lock:
+            if self.free > 0:
+                self.free -= 1
+                future = None
+            else:
+                self.stats['waited'] += 1
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                self.waiters.append((loop, future))
+        if future is not None:
+            try:
+                await future
+            except asyncio.CancelledError:
+                with self.lock:
+                    if (loop, future) in self.waiters:
+                        self.waiters.remove((loop, future))
+                # If we were handed a slot before we were cancelled, we
+                # give it back. (If the future itself was cancelled,
+                # `grant` does.)
+                if future.done() and not future.cancelled():
+                    self.release(1)
+                raise
+        with self.lock:
+            self.queued += 1
+            self.queue.put((filename, line))
+
+    def release(self, count):
+        '''
+        Free up `count` slots, handing them to waiting coroutines first.
+        We may be called from any thread.
+        '''
+        with self.lock:
+            self.free += count
+            while self.free > 0 and self.waiters:
+                self.free -= 1
+                loop, future = self.waiters.popleft()
+                try:
+                    loop.call_soon_threadsafe(self.grant, future)
+                except RuntimeError:
+                    # Its event loop is closed
+                    self.free += 1
+
+    def grant(self, future):
+        '''
+        Hand a slot to a waiting coroutine, in its event loop. If it was
+        cancelled in the meantime, the slot goes back.
+        '''
+        if future.cancelled():
+            self.release(1)
+        else:
+            future.set_result(None)
+
+    def when_committed(self, callback):
+        '''
+        Call `callback` once everything logged so far is written. If it
+        already is, we call it right away; otherwise, the writer thread
+        calls it.
+        '''
+        with self.lock:
+            if self.written < self.queued:
+                self.callbacks.append((self.queued, callback))
+                return
+        callback()
+
+    def flush(self):
+        '''
+        Wait until everything logged so far is written
+        '''
+        done = threading.Event()
+        self.when_committed(done.set)
+        done.wait()
+
+    async def committed(self):
+        '''
+        Wait, without blocking the event loop, until everything logged
+        so far is written
+        '''
+        loop = asyncio.get_running_loop()
+        done = loop.create_future()
+
+        def commit():
+            loop.call_soon_threadsafe(lambda: done.done() or done.set_result(None))
+        self.when_committed(commit)
+        await done
+
+    def run(self):
+        '''
+        The writer thread
+        '''
+        while True:
+            batch = [self.queue.get()]
+            size = 0
+            deadline = time.monotonic() + self.batch_seconds
+            while size < self.batch_bytes:
+                size += len(batch[-1][1])
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            try:
+                self.commit(batch)
+            except OSError as e:
+                # We don't want one bad write to stop us logging
+                self.stats['errors'] += 1
+                print("Error writing event log:", e)
+            self.release(len(batch))
+            callbacks = []
+            with self.lock:
+                self.written += len(batch)
+                while self.callbacks and self.callbacks[0][0] <= self.written:
+                    callbacks.append(self.callbacks.popleft()[1])
+            for callback in callbacks:
+                try:
+                    callback()
+                except Exception:
+                    traceback.print_exc()
+
+    def commit(self, batch):
+        '''
+        Write a group of lines, in order, and `fsync` if it's time
+        '''
+        lines = {}
+        for filename, line in batch:
+            lines.setdefault(filename, []).append(line)
+        for filename in lines:
+            data = ("\n".join(lines[filename]) + "\n").encode('utf-8')
+            log_file_fp = self.file(filename)
+            log_file_fp.write(data)
+            log_file_fp.flush()
+            self.unsynced.add(log_file_fp)
+            self.stats['bytes'] += len(data)
+        self.stats['lines'] += len(batch)
+        self.stats['batches'] += 1
+        if self.fsync == 'none':
+            self.unsynced.clear()
+        elif self.fsync == 'batch' or time.monotonic() - self.last_fsync >= self.fsync:
+            for log_file_fp in self.unsynced:
+                os.fsync(log_file_fp.fileno())
+                self.stats['fsyncs'] += 1
+            self.unsynced.clear()
+            self.last_fsync = time.monotonic()
+
+    def file(self, filename):
+        '''
+        The open file for a log. `None` is the main log.
+        '''
+        if filename not in self.files:
+            if filename is None:
+                path = paths.logs("main_log.json")
+            else:
+                path = paths.logs("" + filename + ".log")
+            self.files[filename] = open(path, "ab")
+        return self.files[filename]
+
+    def status(self):
+        '''
+        Writer statistics, for the status page
+        '''
+        status = dict(self.stats)
+        status['queued'] = self.queue.qsize()
+        status['queue_size'] = self.queue_size
+        status['fsync'] = self.fsync
+        return status
+
+
+def _writer():
+    '''
+    The archive writer. We start it on first use (and again in a
+    forked process, since threads don't survive a fork).
+    '''
+    global _WRITER
+    if _WRITER is None or _WRITER.pid != os.getpid():
+        config = settings.settings.get('event_log', {})
+        _WRITER = _ArchiveWriter(
+            queue_size=config.get('queue_size', QUEUE_SIZE),
+            batch_seconds=config.get('batch_ms', BATCH_SECONDS * 1000) / 1000,
+            batch_bytes=config.get('batch_kb', BATCH_BYTES // 1024) * 1024,
+            fsync=config.get('fsync', FSYNC)
+        )
+    return _WRITER
+
+
 def log_event(event, filename=None, preencoded=False, timestamp=False):
     '''
     This isn't done, but it's how we log events for now.
+
+    This queues the event up for the archive writer, and returns
+    without waiting for it to be written. If the writer is that far
+    behind, we drop the event; use `log_event_async` where we can wait.
+    Pass in `preencoded` text (e.g. from `encode_json_line`) to log the
+    same event to several files without encoding it again.
     '''
-    if filename is None:
-        log_file_fp = mainlog
-    elif filename in files:
-        log_file_fp = files[filename]
-    else:
-        log_file_fp = open(paths.logs("" + filename + ".log"), "ab", 0)
-        files[filename] = log_file_fp
+    if not preencoded:
+        event = encode_json_line(event)
+    if timestamp:
+        event = event + "\t" + datetime.datetime.utcnow().isoformat()
+    _writer().put(filename, event)
+
 
+async def log_event_async(event, filename=None, preencoded=False, timestamp=False):
+    '''
+    Like `log_event`, but if the writer's queue is full, we wait for
+    room, rather than drop the event.
+    '''
     if not preencoded:
-        event = json.dumps(event, sort_keys=True)
-    log_file_fp.write(event.encode('utf-8'))
+        event = encode_json_line(event)
     if timestamp:
-        log_file_fp.write("\t".encode('utf-8'))
-        log_file_fp.write(datetime.datetime.utcnow().isoformat().encode('utf-8'))
-    log_file_fp.write("\n".encode('utf-8'))
-    log_file_fp.flush()
+        event = event + "\t" + datetime.datetime.utcnow().isoformat()
+    await _writer().put_async(filename, event)
+
+
+def when_committed(callback):
+    '''
+    Call `callback` once every event logged so far is written. This
+    may be right away, or from the writer thread, so don't touch the
+    event loop from it except with `call_soon_threadsafe`.
+    '''
+    _writer().when_committed(callback)
+
+
+async def committed():
+    '''
+    Wait until every event logged so far is written (and `fsync`ed,
+    if we do that every group)
+    '''
+    await _writer().committed()
+
+
+def flush():
+    '''
+    Wait until every event logged so far is written. This blocks, so
+    don't call it from the event loop.
+    '''
+    if _WRITER is not None and _WRITER.pid == os.getpid():
+        _WRITER.flush()
+
+
+# The writer thread doesn't keep the process alive, so we write out
+# whatever is left when we exit.
+atexit.register(flush)
+
+
+def archive_status():
+    '''
+    Statistics for the event archive writer, or `None` if we haven't
+    logged anything yet.
+    '''
+    if _WRITER is None:
+        return None
+    return _WRITER.status()
 
 
 def debug_log(text):
@@ -166,38 +519,36 @@ def debug_log(text):
     Helper function to help us trace our code.
 
     We print a time stamp, a stack trace, and a /short/ summary of
-    what's going on.
+    what's going on, depending on `DEBUG_LOG`.
 
     This is not intended for programmatic debugging. We do change
     format regularly (and you should feel free to do so too -- for
     example, on narrower terminals, a `\n\t` can help)
     '''
-    stack = inspect.stack()
-    stack_trace = "{s1}/{s2}/{s3}".format(
-        s1=stack[1].function,
-        s2=stack[2].function,
-        s3=stack[3].function,
-    )
+    if not DEBUG_LOG:
+        return
+
+    # `inspect.stack()` would read the source of every frame. We only
+    # want function names.
+    frame = sys._getframe(1)
+    functions = []
+    while frame is not None and len(functions) < (3 if DEBUG_LOG == DEBUG_LOG_TRACE else 1):
+        functions.append(frame.f_code.co_name)
+        frame = frame.f_back
 
     message = "{time}: {st:60}\t{body}".format(
         time=datetime.datetime.utcnow().isoformat(),
-        st=stack_trace,
+        st="/".join(functions),
         body=text
     )
-
-    # Flip here to print / not print debug messages
-    if DEBUG:
-        print(message)
-
-    # Flip here to save / not save debug messages
-    # Ideally, we'd like to log these somewhere which won't cause cascading failures.
-    # If we e.g. have errors every 100ms, we don't want to create millions of debug files.
-    # There are services which handle this pretty well, I believe
-    if DEBUG:
-        debug_fp = open(paths.logs("debug.log"), "a")
-        debug_fp.write(message)
-        debug_fp.write("\n")
-        debug_fp.close()
+    print(message)
+
+    # We save debug messages through the archive writer, so we don't
+    # wait on the disk. Ideally, we'd like to log these somewhere which
+    # won't cause cascading failures. If we e.g. have errors every
+    # 100ms, we don't want to create millions of debug files. There
+    # are services which handle this pretty well, I believe
+    _writer().put("debug", message)
 
 
 AJAX_FILENAME_TEMPLATE = "{directory}/{time}-{payload_hash}.json"
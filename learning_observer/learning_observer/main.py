@@ -34,8 +34,10 @@ import learning_observer.auth.http_basic
 import learning_observer.client_config
 import learning_observer.incoming_student_event as incoming_student_event
 import learning_observer.dashboard
+import learning_observer.kvs
 import learning_observer.rosters as rosters
 import learning_observer.module_loader
+import learning_observer.stream_analytics.helpers
 
 import learning_observer.paths as paths
 import learning_observer.settings as settings
@@ -405,5 +407,27 @@ async def add_nocache(request, response):
 
 app.on_response_prepare.append(add_nocache)
 
+
+async def check_kvs_codec(app):
+    '''
+    Make sure we can read what other servers write to the KVS (see
+    `kvs.check_codec`)
+    '''
+    await learning_observer.kvs.check_codec()
+
+
+app.on_startup.append(check_kvs_codec)
+
+
+async def flush_reducer_state(app):
+    '''
+    Reducers may be holding state in memory (see `write_behind` in
+    `kvs_pipeline`). Write it back before we go.
+    '''
+    await learning_observer.stream_analytics.helpers.flush_write_behind()
+
+
+app.on_shutdown.append(flush_reducer_state)
+
 print("Running!")
 aiohttp.web.run_app(app, port=8888)
@@ -28,6 +28,7 @@ THIRD_PARTY = {}
 STATIC_REPOS = {}
 STUDENT_DASHBOARDS = []
 COURSE_DASHBOARDS = []
+EXTRA_VIEWS = collections.OrderedDict()
 
 
 def extra_views():
@@ -37,9 +38,13 @@ def extra_views():
     act as a place for things which aren't dashboards. Modules ought
     to be able to define random views.
 
-    To Be Implemented
+    Modules define these in `EXTRA_VIEWS`, as a dictionary of
+    `{'url': ..., 'function': ...}`. URLs are relative to the module,
+    so `wobserver`'s `deane/student/{student_id}` is served from
+    `/views/wobserver/deane/student/{student_id}`.
     '''
-    return []
+    load_modules()
+    return EXTRA_VIEWS
 
 
 def student_dashboards():
@@ -221,6 +226,21 @@ def load_modules():
         else:
             print("Module has no reducers")
 
+        # Load any views (e.g. JSON APIs) the module serves
+        if hasattr(module, "EXTRA_VIEWS"):
+            for view in module.EXTRA_VIEWS:
+                view_id = "{module}.{view}".format(
+                    module=entrypoint.name,
+                    view=view
+                )
+                EXTRA_VIEWS[view_id] = {
+                    'url': "{module}/{url}".format(
+                        module=entrypoint.name,
+                        url=module.EXTRA_VIEWS[view]['url']
+                    ),
+                    'function': module.EXTRA_VIEWS[view]['function']
+                }
+
         # Load a list of static files our server will serve
         #
         # There's a lot to think through in terms of absolute paths,
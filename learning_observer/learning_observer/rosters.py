@@ -48,7 +48,7 @@ import pathvalidate
 
 import learning_observer.settings as settings
 
-import learning_observer.kvs
+import learning_observer.stream_analytics.helpers
 import learning_observer.log_event as log_event
 import learning_observer.paths as paths
 
@@ -91,16 +91,11 @@ def clean_google_ajax_data(resp_json, key, sort_key, default=None):
 
 async def all_students():
     '''
-    This crawls all of the keys in the KVS, and creates a list of all
-    student IDs in redis. This should not be used in any form of
-    large-scale production.
+    A list of all student IDs with data in the KVS. We read these from
+    the index reducers keep, so this doesn't walk through the whole
+    KVS, but it's still not meant for large-scale production.
     '''
-    keys = await learning_observer.kvs.KVS().keys()
-    internal_keys = [k for k in keys if k.startswith("Internal:")]
-    split_keys = [k.split(":") for k in internal_keys]
-    valid_keys = [k for k in split_keys if len(k) > 2]
-    user_ids = sorted(set([k[2] for k in valid_keys]))
-    return user_ids
+    return await learning_observer.stream_analytics.helpers.all_students()
 
 
 async def all_ajax(
@@ -30,14 +30,131 @@ We create reducers with the `kvs_pipeline` decorator. In the longer
 term, we'll want to be able to plug together different aggregators,
 state types, etc. We'll also want different keys for reducers
 (per-student, per-resource, etc.). For now, though, this works.
+
+Reducers with large state can opt into op-log storage. Rather than
+rewriting the whole state on every event, we append a small delta to
+a per-student log, and only periodically fold the log into a snapshot
+of the state. See `kvs_pipeline`.
+
+Reducers which work on documents can also opt into keeping their
+state per document, rather than per student, so a student switching
+between two documents doesn't have them overwrite each other.
+
+Reducers which sometimes do a lot of computation (e.g. replaying a
+long document history) can ask to run in a process pool, so they
+don't stall the event loop for every other student on the server.
+
+Small reducers which run on every keystroke can opt into write-behind
+caching: we keep their state in memory while a student is connected,
+and only write it back to the KVS every so often.
+
+Pipelines take either one event, or a list of events which arrived
+together (a microbatch). For a microbatch, we read and write each
+reducer's state once. Reducers can take the whole list at once
+(`batch=True`), or one event at a time.
+
+We write a reducer's internal and external state together, in one
+KVS call. Reducers which might see the same student from two places
+at once can opt into optimistic concurrency: we note the version of
+the state we read, and if someone else wrote it before we were done,
+we read it again and redo the reduction.
+
+We only write the external state when it changes. Many reducers
+(e.g. document reconstruction) return the same object for both
+states. In that case, rather than store it twice, the external state
+is a reference to the internal one. Use `get_external` to read
+external states.
+
+We keep indexes of which students have state, in which reducers, and
+under which keys (see `index_key`), so we never need to walk through
+every key in the KVS to find them.
 '''
+import asyncio
+import collections
+import concurrent.futures
 import enum
 import functools
+import importlib
+import os
+import traceback
+import weakref
 
 import learning_observer.kvs
+import learning_observer.settings
+
+
+KeyStateType = enum.Enum("KeyStateType", "INTERNAL EXTERNAL OPLOG DOCUMENTS")
+
+# Indexes we keep (as sets in the KVS):
+# * STUDENTS: Every student with reducer state
+# * REDUCER: Every student with state in a given reducer
+# * USER: Every key we've written for a given student
+IndexType = enum.Enum("IndexType", "STUDENTS REDUCER USER")
+
+# Defaults for op-log reducers: We compact the log into a snapshot
+# every this many deltas, or this many seconds after the first
+# uncompacted delta, whichever comes first.
+COMPACT_OPS = 100
+COMPACT_SECONDS = 5
 
+# Op-log compactions which are scheduled to run, by log key. We keep
+# these process-wide, so we don't schedule one per pipeline.
+_COMPACTION_TASKS = {}
 
-KeyStateType = enum.Enum("KeyStateType", "INTERNAL EXTERNAL")
+# And locks, so we don't compact the same log twice at the same time
+# (or run a CPU-bound reducer twice on the same state).
+_COMPACTION_LOCKS = weakref.WeakValueDictionary()
+
+# Per-document reducers keep the state of recently active documents
+# (and each student's document index) in memory, so a student flipping
+# between documents doesn't cost a KVS read each time. This is
+# write-through: the KVS always has the latest state. It assumes a
+# student's events are handled by one process at a time, as they are
+# with one websocket per student.
+HOT_STATES = 1000
+_HOT_STATE = collections.OrderedDict()
+
+# CPU-bound reducers run in a process pool (see `kvs_pipeline`). We
+# create the pool on first use. The number of processes, and the
+# number of jobs we allow queued or running at once, are configurable
+# under `cpu_pool` in the settings file. Past that, events wait in the
+# event loop rather than piling up in the pool.
+_CPU_POOL = None
+_CPU_POOL_SLOTS = None
+
+# Defaults for write-behind reducers: We write state back to the KVS
+# every this many events, or this many seconds after it changed,
+# whichever comes first, and when the student disconnects.
+FLUSH_EVENTS = 50
+FLUSH_SECONDS = 5
+
+# Write-behind state, by internal key. We keep clean states around too
+# (so we don't need to read them back), up to `WRITE_BEHIND_STATES`,
+# until every connection using them closes.
+WRITE_BEHIND_STATES = 10000
+_WRITE_BEHIND = collections.OrderedDict()
+
+# Reducers which may run in the pool, by name. Decorated reducers
+# aren't picklable (the module-level name is the wrapper), so we send
+# the name across, and look the reducer up on the other side.
+_CPU_BOUND_REDUCERS = {}
+
+# Optimistic reducers retry this many times if someone else keeps
+# writing their state under them. After that, we write anyway.
+OPTIMISTIC_RETRIES = 3
+
+# When a reducer returns its internal state as its external state, we
+# store this in the external key, rather than a second copy:
+#
+#   {"__reference__": "Internal:writing_observer.writing_analysis.reconstruct:..."}
+REFERENCE = '__reference__'
+
+# What we last wrote to each external key (a copy, or the reference),
+# so we don't send the same thing again. This is only a hint: the KVS
+# still refreshes the key's expiry, and writes it again if it's gone
+# (see `set_pair`).
+LAST_EXTERNALS = 10000
+_LAST_EXTERNAL = collections.OrderedDict()
 
 
 def fully_qualified_function_name(func):
@@ -58,13 +175,14 @@ def fully_qualified_function_name(func):
     )
 
 
-def make_key(func, safe_user_id, state_type):
+def make_key(func, safe_user_id, state_type, doc_id=None):
     '''
     Create a KVS key
 
     This joins a stream module ID, a sanitized user ID, and
     whether this is the internal state of the module or the
-    external state.
+    external state. For per-document state, we add the document
+    ID.
     '''
     # pylint: disable=isinstance-second-argument-not-valid-type
     assert isinstance(state_type, KeyStateType)
@@ -72,15 +190,359 @@ def make_key(func, safe_user_id, state_type):
 
     streammodule = fully_qualified_function_name(func)
 
-    return "{state_type}:{streammodule}:{user}".format(
+    key = "{state_type}:{streammodule}:{user}".format(
         state_type=state_type.name.capitalize(),
         streammodule=streammodule,
         user=safe_user_id
     )
+    if doc_id is not None:
+        key = "{key}:{doc_id}".format(key=key, doc_id=doc_id)
+    return key
+
+
+def index_key(index_type, name=None):
+    '''
+    Create a KVS key for an index: of all students (no `name`), of
+    students in a reducer (`name` is the reducer), or of one student's
+    keys (`name` is the safe user ID). E.g.:
+
+        Index:Reducer:writing_observer.writing_analysis.reconstruct
+    '''
+    # pylint: disable=isinstance-second-argument-not-valid-type
+    assert isinstance(index_type, IndexType)
+    key = "Index:{index_type}".format(index_type=index_type.name.capitalize())
+    if name is not None:
+        key = "{key}:{name}".format(
+            key=key,
+            name=fully_qualified_function_name(name) if callable(name) else name
+        )
+    return key
+
+
+def backfilled_key(index):
+    '''
+    The KVS key which marks that we've added everything from before
+    we kept `index` to it (see `all_students`). E.g.:
+
+        Backfilled:Index:Students
+    '''
+    return "Backfilled:{index}".format(index=index)
+
+
+async def all_students(kvs=None, func=None):
+    '''
+    The (safe) user IDs of all students with reducer state, or with
+    state in the reducer `func`, sorted.
+
+    The index only has students whose reducers ran since we started
+    keeping it. The first time we read it, we backfill it from a scan
+    of the internal state keys, and set a flag (`backfilled_key`) so
+    we don't scan again. Until the flag is set, we merge the scan with
+    the index. If the KVS expires keys, the flag expires too, and we
+    scan again; reducers refresh the indexes as they write, so the
+    indexes outlast the flag.
+    '''
+    if kvs is None:
+        kvs = learning_observer.kvs.KVS()
+    if func is None:
+        index = index_key(IndexType.STUDENTS)
+        pattern = "Internal:*"
+    else:
+        index = index_key(IndexType.REDUCER, func)
+        pattern = "Internal:{reducer}:*".format(reducer=fully_qualified_function_name(func))
+    students = await kvs.get_set(index)
+    if await kvs[backfilled_key(index)]:
+        return students
+    split_keys = [key.split(":") async for key in kvs.scan(pattern)]
+    scanned = sorted(set(key[2] for key in split_keys if len(key) > 2))
+    if scanned:
+        await kvs.add_to_set(index, scanned)
+    # Students who show up after the scan add themselves to the index,
+    # so from here on, the index is complete.
+    await kvs.set(backfilled_key(index), True)
+    return sorted(set(students) | set(scanned))
+
+
+async def user_keys(safe_user_id, kvs=None):
+    '''
+    All the keys reducers have written for a student, sorted
+    '''
+    if kvs is None:
+        kvs = learning_observer.kvs.KVS()
+    return await kvs.get_set(index_key(IndexType.USER, safe_user_id))
+
+
+def event_doc_id(event):
+    '''
+    The document an event is about, or `None`
+    '''
+    return event.get('client', {}).get('doc_id')
+
+
+def _remember(key, value):
+    '''
+    Put a state in the in-memory cache of hot states
+    '''
+    _HOT_STATE[key] = value
+    _HOT_STATE.move_to_end(key)
+    while len(_HOT_STATE) > HOT_STATES:
+        _HOT_STATE.popitem(last=False)
+
+
+async def _hot_get(kvs, key):
+    '''
+    Read a state, from memory if we have it
+    '''
+    if key in _HOT_STATE:
+        _HOT_STATE.move_to_end(key)
+        return _HOT_STATE[key]
+    value = await kvs[key]
+    # Someone may have written a newer state while we were waiting
+    if key not in _HOT_STATE:
+        _remember(key, value)
+    return _HOT_STATE[key]
+
+
+async def _hot_set(kvs, key, value):
+    '''
+    Write a state, both to memory and to the KVS
+    '''
+    _remember(key, value)
+    await kvs.set(key, value)
+
+
+def _is_reference(value):
+    '''
+    Is a stored external state a reference to an internal state?
+    '''
+    return isinstance(value, dict) and REFERENCE in value
+
+
+async def get_external(kvs, key):
+    '''
+    Read an external state, following it to the internal state if it
+    is a reference.
+    '''
+    return (await get_externals(kvs, [key]))[0]
+
+
+async def get_externals(kvs, keys):
+    '''
+    Read several external states (see `get_external`): one `mget` for
+    the states, and one more for any references.
+    '''
+    values = await kvs.mget(keys)
+    references = [value[REFERENCE] for value in values if _is_reference(value)]
+    if references:
+        resolved = dict(zip(references, await kvs.mget(references)))
+        values = [resolved[value[REFERENCE]] if _is_reference(value) else value for value in values]
+    return values
+
+
+async def _write_states(kvs, internal_key, internal_state, external_key, external_state, version=None):
+    '''
+    Write a reducer's internal and external state, in one KVS call. We
+    store the external state as a reference if it's the internal state,
+    and don't send it if it's what we wrote last time. Returns whether
+    we wrote (see `set_pair`).
+    '''
+    if external_state is internal_state:
+        external_state = {REFERENCE: internal_key}
+    # Comparing dictionaries stops at the first difference, and doesn't
+    # serialize anything
+    unchanged = _LAST_EXTERNAL.get(external_key) == external_state
+    written = await kvs.set_pair(
+        internal_key, internal_state, external_key, external_state, version,
+        other_unchanged=unchanged
+    )
+    if written and not unchanged:
+        # A copy, in case the reducer changes its state in place
+        _LAST_EXTERNAL[external_key] = learning_observer.kvs._json_copy(external_state)
+    if external_key in _LAST_EXTERNAL:
+        _LAST_EXTERNAL.move_to_end(external_key)
+        while len(_LAST_EXTERNAL) > LAST_EXTERNALS:
+            _LAST_EXTERNAL.popitem(last=False)
+    return written
+
+
+async def user_documents(func, safe_user_id):
+    '''
+    The documents a student has worked on, for a per-document
+    reducer. We return a dictionary:
+
+        {
+            'current': doc_id,           # Document the student is on now
+            'documents': {doc_id: time}  # When they last switched to each
+        }
+    '''
+    index = await _hot_get(
+        learning_observer.kvs.KVS(),
+        make_key(func, safe_user_id, KeyStateType.DOCUMENTS)
+    )
+    return index or {'current': None, 'documents': {}}
+
+
+def _cpu_pool():
+    '''
+    The process pool for CPU-bound reducers, and a semaphore capping
+    how many jobs we have in it at once.
+    '''
+    global _CPU_POOL, _CPU_POOL_SLOTS
+    if _CPU_POOL is None:
+        config = learning_observer.settings.settings.get('cpu_pool', {})
+        processes = config.get('processes', os.cpu_count() or 1)
+        _CPU_POOL = concurrent.futures.ProcessPoolExecutor(max_workers=processes)
+        _CPU_POOL_SLOTS = asyncio.Semaphore(config.get('max_in_flight', 2 * processes))
+    return _CPU_POOL, _CPU_POOL_SLOTS
+
+
+def _run_reducer(module, name, events, internal_state):
+    '''
+    Run a CPU-bound reducer. This runs in a worker process. We import
+    the reducer's module, in case this process hasn't, so the reducer
+    is registered.
+    '''
+    importlib.import_module(module)
+    return asyncio.run(_CPU_BOUND_REDUCERS[name](events, internal_state))
+
+
+async def _offload(func, events, internal_state):
+    '''
+    Run a reducer in the process pool. State and events are pickled on
+    the way in, and the new states on the way out.
+    '''
+    pool, slots = _cpu_pool()
+    async with slots:
+        return await asyncio.get_running_loop().run_in_executor(
+            pool,
+            _run_reducer,
+            func.__module__,
+            fully_qualified_function_name(func),
+            events,
+            internal_state
+        )
+
+
+class _WriteBehind(object):
+    '''
+    A reducer's state, held in memory for a connected student, and how
+    much of it has yet to make it to the KVS. A student with two tabs
+    open has two pipelines on the same state; `owners` are the ones
+    using it (see `flush_write_behind`).
+    '''
+    def __init__(self, kvs, internal_key, external_key, internal_state):
+        self.kvs = kvs
+        self.owners = set()
+        self.internal_key = internal_key
+        self.external_key = external_key
+        self.internal_state = internal_state
+        self.external_state = None
+        self.pending = 0
+        self.timer = None
+
+    def update(self, internal_state, external_state, events=1):
+        '''
+        Record a new state (after `events` events), which we'll write
+        later
+        '''
+        self.internal_state = internal_state
+        self.external_state = external_state
+        self.pending += events
+
+    async def flush(self):
+        '''
+        Write the state back to the KVS, if it changed
+        '''
+        if self.timer is not None and self.timer is not asyncio.current_task():
+            self.timer.cancel()
+        self.timer = None
+        if not self.pending:
+            return
+        self.pending = 0
+        # Don't let the per-document cache hold on to an older state
+        _HOT_STATE.pop(self.internal_key, None)
+        await _write_states(
+            self.kvs,
+            self.internal_key, self.internal_state,
+            self.external_key, self.external_state
+        )
+
+    async def flush_later(self, seconds):
+        '''
+        Flush after a delay (unless something flushes us first)
+        '''
+        await asyncio.sleep(seconds)
+        await self.flush()
+
+
+def _compaction_done(log_key, task):
+    '''
+    A delayed compaction finished. Nothing awaits these, so we log any
+    error here, and let the next delta schedule a new one.
+    '''
+    if _COMPACTION_TASKS.get(log_key) is task:
+        del _COMPACTION_TASKS[log_key]
+    if not task.cancelled() and task.exception() is not None:
+        error = task.exception()
+        print("Compaction failed:", log_key)
+        traceback.print_exception(type(error), error, error.__traceback__)
+
+
+def _owner(metadata):
+    '''
+    Who holds write-behind state (see `_WriteBehind`). Each connection
+    has its own metadata, which every pipeline it builds is given, so
+    we go by that. It lives as long as the connection does, so its
+    `id` is unique while we care.
+    '''
+    return id(metadata)
+
+
+async def flush_write_behind(metadata=None):
+    '''
+    Write back the state of write-behind reducers. We do this for the
+    pipelines built with `metadata` when their connection closes, or
+    for everyone (`metadata=None`) on shutdown. Once the flush is done,
+    we stop holding states no other connection is using, so nothing
+    reads an older state from the KVS in between.
+    '''
+    owner = None if metadata is None else _owner(metadata)
+    for key, entry in list(_WRITE_BEHIND.items()):
+        if owner is not None and owner not in entry.owners:
+            continue
+        await entry.flush()
+        entry.owners.discard(owner)
+        if owner is None or not entry.owners:
+            if not entry.pending and _WRITE_BEHIND.get(key) is entry:
+                del _WRITE_BEHIND[key]
+
+
+def _remember_write_behind(entry):
+    '''
+    Start holding a state in memory. If we're holding too many, we let
+    go of the least recently used clean ones.
+    '''
+    _WRITE_BEHIND[entry.internal_key] = entry
+    if len(_WRITE_BEHIND) > WRITE_BEHIND_STATES:
+        for key in list(_WRITE_BEHIND):
+            if len(_WRITE_BEHIND) <= WRITE_BEHIND_STATES:
+                break
+            if not _WRITE_BEHIND[key].pending:
+                del _WRITE_BEHIND[key]
 
 
 def kvs_pipeline(
-        null_state=None
+        null_state=None,
+        op_log=None,
+        compact_ops=COMPACT_OPS,
+        compact_seconds=COMPACT_SECONDS,
+        per_document=False,
+        cpu_bound=False,
+        write_behind=False,
+        flush_events=FLUSH_EVENTS,
+        flush_seconds=FLUSH_SECONDS,
+        batch=False,
+        optimistic=False
 ):
     '''
     Closures, anyone?
@@ -93,11 +555,82 @@ def kvs_pipeline(
     * `null_state` tells us the empty state, before any reduce operations have
       happened. This can be important for the aggregator. We're documenting the
       code before we've written it, so please make sure this works before using.
+    * `op_log` switches the reducer to append-only storage. It is a function
+      which takes an event, and returns a (JSON) delta to log, or `None` if
+      the event doesn't change the state. In this mode, the reducer is not
+      called on every event. Instead, every `compact_ops` deltas (or
+      `compact_seconds` after an uncompacted delta), it is called with the
+      *list* of deltas logged since the last snapshot, and the snapshot:
+
+      `internal_state, external_state = await func(deltas, internal_state)`
+
+      Between compactions, the stored states lag the log by up to
+      `compact_seconds`.
+    * `per_document` keeps the internal state (and op-log) per document
+      (the `doc_id` the extension sends), rather than per student. The
+      external state stays per student, and follows whichever document
+      the student is working on now, so dashboards don't change. We
+      keep an index of each student's documents (see `user_documents`),
+      and keep recently active documents in memory.
+    * `cpu_bound` runs the reducer in a process pool, rather than in the
+      event loop. This may be `True`, or a function which takes the
+      event (or, for op-log reducers, the deltas), and tells us whether
+      this particular call is worth the trip (pickling the state both
+      ways isn't free). Calls for the same student are serialized.
+    * `write_behind` keeps the state in memory while the student is
+      connected. Rather than a read and two writes per event, we write
+      the state back every `flush_events` events, `flush_seconds`
+      after it changes, and when the student disconnects (see
+      `flush_write_behind`). Dashboards lag by up to `flush_seconds`.
+      This relies on a student's events going to one process, and
+      isn't for op-log reducers (which don't write on every event
+      anyway).
+    * `batch` means the reducer takes a list of events, rather than one
+      event:
+
+      `internal_state, external_state = await func(events, internal_state)`
+
+      The pipeline we return takes either an event or a list of events
+      either way. For reducers which take one event at a time, we run
+      through the list, passing the state along in memory.
+    * `optimistic` checks that no one else wrote the internal state
+      between our read and our write (e.g. the same student, typing on
+      two computers at once, connected to two servers). If they did,
+      we re-read, and run the reducer again, up to `OPTIMISTIC_RETRIES`
+      times. This costs nothing extra in round trips, but reducers
+      shouldn't have side effects. It doesn't apply to op-log or
+      write-behind reducers.
     '''
+    assert not (write_behind and op_log), "Write-behind doesn't apply to op-log reducers"
+    assert not (optimistic and (write_behind or op_log)), \
+        "Optimistic concurrency doesn't apply to op-log or write-behind reducers"
+
     def decorator(func):
         '''
         The decorator itself
         '''
+        if cpu_bound:
+            _CPU_BOUND_REDUCERS[fully_qualified_function_name(func)] = func
+
+        async def reduce(events, internal_state):
+            '''
+            Call the reducer, in the process pool if it's worth it.
+            '''
+            if cpu_bound is True or (cpu_bound and cpu_bound(events)):
+                return await _offload(func, events, internal_state)
+            return await func(events, internal_state)
+
+        async def reduce_batch(events, internal_state):
+            '''
+            Reduce a list of events, whether or not the reducer takes
+            lists itself.
+            '''
+            if batch:
+                return await reduce(events, internal_state)
+            for event in events:
+                internal_state, external_state = await reduce(event, internal_state)
+            return internal_state, external_state
+
         @functools.wraps(func)
         def wrapper_closure(metadata):
             '''
@@ -116,9 +649,190 @@ def kvs_pipeline(
                 safe_user_id = '[guest]'
                 # TODO: raise an exception.
 
-            internal_key = make_key(func, safe_user_id, KeyStateType.INTERNAL)
             external_key = make_key(func, safe_user_id, KeyStateType.EXTERNAL)
+            documents_key = make_key(func, safe_user_id, KeyStateType.DOCUMENTS)
             taskkvs = learning_observer.kvs.KVS()
+            # Keys this pipeline has put in the indexes
+            indexed = set()
+
+            async def update_indexes(*keys):
+                '''
+                Add this student, and any keys we haven't seen yet, to
+                the indexes (see `index_key`). This only costs a write
+                the first time this pipeline sees a key.
+
+                If the KVS expires keys, each write of state resets its
+                expiry, so we add ourselves to the indexes (which
+                resets theirs) on every run, too. Otherwise, an index
+                could expire before the states in it, or before the
+                flag which says it's complete (see `all_students`).
+                '''
+                keys = [key for key in keys if key is not None]
+                if taskkvs.expire is None:
+                    keys = [key for key in keys if key not in indexed]
+                    if not keys:
+                        return
+                async with taskkvs.pipeline() as pipeline:
+                    if not indexed or taskkvs.expire is not None:
+                        pipeline.add_to_set(index_key(IndexType.STUDENTS), [safe_user_id])
+                        pipeline.add_to_set(index_key(IndexType.REDUCER, func), [safe_user_id])
+                    pipeline.add_to_set(index_key(IndexType.USER, safe_user_id), keys)
+                indexed.update(keys)
+
+            def keys(event):
+                '''
+                The document an event goes to (`None` unless we're per
+                document), and the internal and op-log keys for it.
+                '''
+                doc_id = event_doc_id(event) if per_document else None
+                return (
+                    doc_id,
+                    make_key(func, safe_user_id, KeyStateType.INTERNAL, doc_id),
+                    make_key(func, safe_user_id, KeyStateType.OPLOG, doc_id)
+                )
+
+            async def get_state(key):
+                '''
+                Read a state. Per-document states may be in memory.
+                '''
+                if per_document:
+                    return await _hot_get(taskkvs, key)
+                return await taskkvs[key]
+
+            async def set_state(key, value):
+                '''
+                Write a state (and keep it in memory, if per-document)
+                '''
+                if per_document:
+                    await _hot_set(taskkvs, key, value)
+                else:
+                    await taskkvs.set(key, value)
+
+            async def set_states(internal_key, internal_state, external_state, version=None):
+                '''
+                Write the internal and external state in one go (see
+                `_write_states`). Returns whether we wrote.
+                '''
+                written = await _write_states(
+                    taskkvs,
+                    internal_key, internal_state,
+                    external_key, external_state,
+                    version
+                )
+                if per_document:
+                    if written:
+                        _remember(internal_key, internal_state)
+                    else:
+                        _HOT_STATE.pop(internal_key, None)
+                return written
+
+            async def switch_document(event, doc_id):
+                '''
+                Record which document the student is working on, if it
+                changed.
+                '''
+                if doc_id is None:
+                    return
+                index = await get_state(documents_key)
+                if index is not None and index['current'] == doc_id:
+                    return
+                index = {
+                    'current': doc_id,
+                    'documents': dict(index['documents']) if index else {}
+                }
+                index['documents'][doc_id] = event.get('server', {}).get('time')
+                await set_state(documents_key, index)
+
+            async def is_current(doc_id):
+                '''
+                Should this document's state go to the dashboard? Only if
+                the student is still working on it.
+                '''
+                if doc_id is None:
+                    return True
+                index = await get_state(documents_key)
+                return index is None or index['current'] == doc_id
+
+            async def compact(doc_id, internal_key, log_key):
+                '''
+                Fold the op-log into the snapshot: Read the snapshot and
+                the log, run the reducer over the deltas, write the new
+                state, and drop the deltas we used. Deltas appended while
+                we were working stay in the log for next time.
+
+                The same caveats on concurrency apply as in `process_event`,
+                below. We serialize compactions within a process.
+                '''
+                lock = _COMPACTION_LOCKS.setdefault(log_key, asyncio.Lock())
+                async with lock:
+                    deltas = await taskkvs.get_list(log_key)
+                    if not deltas:
+                        return None
+                    internal_state = await get_state(internal_key)
+                    internal_state, external_state = await reduce(
+                        deltas, internal_state
+                    )
+                    if await is_current(doc_id):
+                        await set_states(internal_key, internal_state, external_state)
+                    else:
+                        await set_state(internal_key, internal_state)
+                    await taskkvs.trim_list(log_key, len(deltas))
+                    return external_state
+
+            async def delayed_compaction(doc_id, internal_key, log_key):
+                '''
+                Make sure deltas don't sit in the log for more than
+                `compact_seconds`, even if the student stops typing.
+                '''
+                await asyncio.sleep(compact_seconds)
+                await compact(doc_id, internal_key, log_key)
+
+            def by_document(events):
+                '''
+                Split a microbatch into runs of events for the same
+                document (which, unless we're per-document, is all of
+                them).
+                '''
+                if not isinstance(events, list):
+                    events = [events]
+                runs = []
+                for event in events:
+                    if runs and keys(runs[-1][0]) == keys(event):
+                        runs[-1].append(event)
+                    else:
+                        runs.append([event])
+                return runs
+
+            async def process_logged_event(events):
+                '''
+                Op-log version of `process_event`, below. Appending is
+                O(delta) rather than O(state). We return the external
+                state if we compacted, and an empty one otherwise.
+                For a microbatch, we append each document's deltas in
+                one pipeline.
+                '''
+                external_state = {}
+                for run in by_document(events):
+                    deltas = [delta for delta in map(op_log, run) if delta is not None]
+                    if not deltas:
+                        continue
+                    doc_id, internal_key, log_key = keys(run[0])
+                    await update_indexes(
+                        external_key, internal_key, log_key,
+                        documents_key if per_document else None
+                    )
+                    await switch_document(run[-1], doc_id)
+                    async with taskkvs.pipeline() as pipeline:
+                        lengths = [pipeline.append(log_key, delta) for delta in deltas]
+                    if lengths[-1].result() >= compact_ops:
+                        external_state = await compact(doc_id, internal_key, log_key) or {}
+                    elif log_key not in _COMPACTION_TASKS:
+                        task = asyncio.ensure_future(
+                            delayed_compaction(doc_id, internal_key, log_key)
+                        )
+                        task.add_done_callback(functools.partial(_compaction_done, log_key))
+                        _COMPACTION_TASKS[log_key] = task
+                return external_state
 
             async def process_event(events):
                 '''
@@ -167,14 +881,82 @@ def kvs_pipeline(
                 #   enough and probably the right long-term solution
                 # * We could have modules explicitly indicate where they need
                 #   thread safety and transactions. That'd be easy enough.
+                #   (Modules can now ask for optimistic concurrency; see
+                #   `optimistic`, above.)
                 #
-                internal_state = await taskkvs[internal_key]
-                internal_state, external_state = await func(
-                    events, internal_state
+                external_state = {}
+                for run in by_document(events):
+                    doc_id, internal_key, _ = keys(run[0])
+                    await update_indexes(
+                        external_key, internal_key,
+                        documents_key if per_document else None
+                    )
+                    if write_behind:
+                        external_state = await update_write_behind(run, doc_id, internal_key)
+                    elif not cpu_bound:
+                        external_state = await update_state(run, doc_id, internal_key)
+                    else:
+                        # With the reducer off in another process, the
+                        # window for two events to race is much bigger.
+                        lock = _COMPACTION_LOCKS.setdefault(internal_key, asyncio.Lock())
+                        async with lock:
+                            external_state = await update_state(run, doc_id, internal_key)
+                return external_state
+
+            async def update_write_behind(events, doc_id, internal_key):
+                '''
+                Write-behind version of `update_state`, below
+                '''
+                await switch_document(events[-1], doc_id)
+                entry = _WRITE_BEHIND.get(internal_key)
+                if entry is None:
+                    internal_state = await get_state(internal_key)
+                    # Another event may have beaten us to it
+                    entry = _WRITE_BEHIND.get(internal_key)
+                    if entry is None:
+                        entry = _WriteBehind(
+                            taskkvs, internal_key, external_key, internal_state
+                        )
+                        _remember_write_behind(entry)
+                entry.owners.add(_owner(metadata))
+                _WRITE_BEHIND.move_to_end(internal_key)
+                internal_state, external_state = await reduce_batch(
+                    events, entry.internal_state
                 )
-                await taskkvs.set(internal_key, internal_state)
-                await taskkvs.set(external_key, external_state)
+                entry.update(internal_state, external_state, len(events))
+                if entry.pending >= flush_events:
+                    await entry.flush()
+                elif entry.timer is None:
+                    entry.timer = asyncio.ensure_future(entry.flush_later(flush_seconds))
+                return external_state
+
+            async def update_state(events, doc_id, internal_key):
+                '''
+                Read the state, reduce a run of events for one document,
+                and write the new state
+                '''
+                await switch_document(events[-1], doc_id)
+                if not optimistic:
+                    internal_state = await get_state(internal_key)
+                    internal_state, external_state = await reduce_batch(
+                        events, internal_state
+                    )
+                    await set_states(internal_key, internal_state, external_state)
+                    return external_state
+
+                # We need the version, so we skip the in-memory cache
+                for attempt in range(OPTIMISTIC_RETRIES + 1):
+                    internal_state, version = await taskkvs.get_versioned(internal_key)
+                    internal_state, external_state = await reduce_batch(
+                        events, internal_state
+                    )
+                    if await set_states(internal_key, internal_state, external_state, version):
+                        return external_state
+                print("State kept changing under us. Writing anyway:", internal_key)
+                await set_states(internal_key, internal_state, external_state)
                 return external_state
+            if op_log is not None:
+                return process_logged_event
             return process_event
         return wrapper_closure
     return decorator
@@ -0,0 +1,143 @@
+'''
+Tests for `kvs_pipeline`, in each of its modes, against the in-memory
+KVS. Run with `pytest`.
+'''
+
+import asyncio
+
+import pytest
+
+import learning_observer.kvs
+import learning_observer.stream_analytics.helpers as helpers
+
+
+async def typed(event, internal_state):
+    '''
+    A reducer which keeps track of what the student typed
+    '''
+    internal_state = internal_state or {'count': 0, 'text': ''}
+    state = {
+        'count': internal_state['count'] + 1,
+        'text': internal_state['text'] + event['client']['text']
+    }
+    return state, state
+
+
+async def typed_batch(events, internal_state):
+    '''
+    `typed`, taking a list of events
+    '''
+    for event in events:
+        internal_state, external_state = await typed(event, internal_state)
+    return internal_state, external_state
+
+
+def typed_delta(event):
+    '''
+    The op-log delta for `typed_log`
+    '''
+    return event['client']['text']
+
+
+async def typed_log(deltas, internal_state):
+    '''
+    `typed`, for an op-log: we get the deltas since the last snapshot
+    '''
+    internal_state = internal_state or {'count': 0, 'text': ''}
+    state = {
+        'count': internal_state['count'] + len(deltas),
+        'text': internal_state['text'] + "".join(deltas)
+    }
+    return state, state
+
+
+# Reducers, and how we set up `kvs_pipeline` for them
+MODES = {
+    'plain': (typed, {}),
+    'batch': (typed_batch, {'batch': True}),
+    'per_document': (typed, {'per_document': True}),
+    'write_behind': (typed, {'write_behind': True, 'flush_events': 7}),
+    'optimistic': (typed, {'optimistic': True}),
+    'op_log': (typed_log, {'op_log': typed_delta, 'compact_ops': 7, 'compact_seconds': 0}),
+    'cpu_bound': (typed, {'cpu_bound': True})
+}
+
+
+def events(text):
+    '''
+    One event per character of `text`
+    '''
+    return [
+        {'client': {'event': 'test', 'text': character, 'doc_id': 'test-doc'}, 'server': {}}
+        for character in text
+    ]
+
+
+async def settle(metadata):
+    '''
+    Write out everything reducers have in memory, or waiting in an
+    op-log
+    '''
+    await helpers.flush_write_behind(metadata)
+    await asyncio.gather(*list(helpers._COMPACTION_TASKS.values()))
+
+
+@pytest.mark.parametrize("mode", sorted(MODES))
+def test_modes(mode):
+    '''
+    Whichever way we store the state, the reducer should see every
+    event, once, in order, whether they come one at a time or in
+    microbatches, and dashboards should see the result.
+    '''
+    func, options = MODES[mode]
+    user = "test-modes-{mode}".format(mode=mode)
+    metadata = {'auth': {'safe_user_id': user}}
+
+    async def run():
+        pipeline = helpers.kvs_pipeline(**options)(func)(metadata)
+        for event in events("Hello"):
+            await pipeline(event)
+        await pipeline(events(", world"))
+        await pipeline(events("!"))
+        await settle(metadata)
+        kvs = learning_observer.kvs.KVS()
+        external = await helpers.get_external(kvs, helpers.make_key(func, user, helpers.KeyStateType.EXTERNAL))
+        assert external == {'count': 13, 'text': 'Hello, world!'}
+        assert user in await helpers.all_students(kvs, func)
+        assert user in await helpers.all_students(kvs)
+    asyncio.run(run())
+    if helpers._CPU_POOL is not None:
+        # The pool (and its semaphore) belong to this test's event loop
+        helpers._CPU_POOL.shutdown()
+        helpers._CPU_POOL = None
+
+
+def test_index_expiry(monkeypatch):
+    '''
+    If the KVS expires keys, an index can expire while the flag which
+    says it's complete is still there. Reducers add students back as
+    they write, so we still find them.
+    '''
+    monkeypatch.setattr(learning_observer.kvs.InMemoryKVS, 'expire', 60)
+    user = "test-index-expiry"
+    metadata = {'auth': {'safe_user_id': user}}
+    indexes = [
+        helpers.index_key(helpers.IndexType.STUDENTS),
+        helpers.index_key(helpers.IndexType.REDUCER, typed),
+        helpers.index_key(helpers.IndexType.USER, user)
+    ]
+
+    async def run():
+        kvs = learning_observer.kvs.KVS()
+        pipeline = helpers.kvs_pipeline()(typed)(metadata)
+        await pipeline(events("a"))
+        assert user in await helpers.all_students(kvs, typed)
+        assert await kvs[helpers.backfilled_key(indexes[1])]
+        # The indexes expire, but the flag hasn't yet
+        for index in indexes:
+            learning_observer.kvs.SET_STORE.pop(index, None)
+        await pipeline(events("b"))
+        assert user in await helpers.all_students(kvs, typed)
+        assert user in await helpers.all_students(kvs)
+        assert helpers.make_key(typed, user, helpers.KeyStateType.INTERNAL) in await helpers.user_keys(user, kvs)
+    asyncio.run(run())
@@ -0,0 +1,89 @@
+'''
+Tests for the ingestion queue in `incoming_student_event`. Run with
+`pytest`.
+'''
+
+import asyncio
+
+import learning_observer.incoming_student_event as incoming_student_event
+
+
+class Request(object):
+    '''
+    Just enough of an `aiohttp` request for `compile_server_data`
+    '''
+    headers = {}
+
+
+class Session(incoming_student_event.StudentSession):
+    '''
+    A student session with a stand-in for the reducers, which notes
+    what it saw, and can be held up with `gate`
+    '''
+    def __init__(self, name, gate=None):
+        super().__init__({'headers': {}, 'auth': {'safe_user_id': name}})
+        self.gate = gate
+        self.reduced = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def handle_batch(self, events):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            if self.gate is not None:
+                await self.gate.wait()
+            await asyncio.sleep(0.001)
+            self.reduced.extend(event['client']['n'] for event in events)
+        finally:
+            self.in_flight -= 1
+
+
+def test_wait():
+    '''
+    When the queue is full, `put` waits for room. Every event gets
+    through, in order, one batch per student at a time.
+    '''
+    async def run():
+        queue = incoming_student_event.Ingestion(workers=4, queue_size=10, overload='wait')
+        sessions = [Session("wait-{i}".format(i=i)) for i in range(3)]
+
+        async def client(session):
+            for n in range(100):
+                assert await queue.put(session, Request(), {'event': 'test', 'n': n})
+            await queue.drain(session)
+
+        await asyncio.gather(*[client(session) for session in sessions])
+        for session in sessions:
+            assert session.reduced == list(range(100))
+            assert session.max_in_flight == 1
+        status = queue.status()
+        assert status['processed'] == 300
+        assert status['shed'] == 0
+        assert status['waited'] > 0
+        assert status['max_queued'] <= 10
+        assert status['queued'] == 0
+    asyncio.run(run())
+
+
+def test_shed():
+    '''
+    When the queue is full, and we're set to shed, `put` skips the
+    reducers for new events, and says so.
+    '''
+    async def run():
+        gate = asyncio.Event()
+        queue = incoming_student_event.Ingestion(workers=1, queue_size=5, overload='shed')
+        session = Session("shed", gate)
+        results = [await queue.put(session, Request(), {'event': 'test', 'n': 0})]
+        # The worker takes the first event, and waits on the gate
+        await asyncio.sleep(0.01)
+        for n in range(1, 20):
+            results.append(await queue.put(session, Request(), {'event': 'test', 'n': n}))
+        assert results == [True] * 6 + [False] * 14
+        assert queue.status()['shed'] == 14
+        gate.set()
+        await queue.drain(session)
+        assert session.reduced == list(range(6))
+        assert queue.status()['processed'] == 6
+    asyncio.run(run())
@@ -0,0 +1,75 @@
+'''
+Tests for `kvs_codec`. Run with `pytest`.
+'''
+
+import json
+
+import pytest
+
+import learning_observer.kvs_codec as kvs_codec
+
+VALUES = [
+    None, 5, "hi", [1, 2, {"a": "b"}], {"text": "essay " * 5000, "n": [1.5, -2]},
+    {1: {None: (1, 2), 2.5: True}}
+]
+
+SERIALIZERS, COMPRESSIONS = kvs_codec.available()
+CODECS = [(serializer, compression) for serializer in SERIALIZERS for compression in COMPRESSIONS]
+
+
+@pytest.mark.parametrize("writer", CODECS)
+@pytest.mark.parametrize("reader", CODECS)
+def test_round_trip(writer, reader):
+    '''
+    Every codec reads what every other codec wrote, and values come
+    back as they would from JSON.
+    '''
+    writer = kvs_codec.Codec(*writer)
+    reader = kvs_codec.Codec(*reader)
+    for value in VALUES:
+        encoded = writer.encode(value)
+        assert isinstance(encoded, bytes)
+        assert reader.decode(encoded) == json.loads(json.dumps(value))
+
+
+@pytest.mark.parametrize("codec", CODECS)
+def test_headers(codec):
+    codec = kvs_codec.Codec(*codec)
+    for header in codec.headers():
+        assert kvs_codec.readable(header)
+    assert not kvs_codec.readable('xz')
+
+
+def test_formats():
+    '''
+    Small JSON values stay plain JSON; big ones are compressed, and we
+    still read values from before we had codecs.
+    '''
+    codec = kvs_codec.Codec('json', 'zlib')
+    assert codec.headers() == ['j-', 'jz']
+    assert codec.encode({"a": 1}) == b'{"a": 1}'
+    assert codec.encode("x" * 10000)[:3] == kvs_codec.HEADER + kvs_codec.JSON + kvs_codec.ZLIB
+    assert kvs_codec.Codec('json', 'none').decode('{"old": "value"}') == {"old": "value"}
+    assert codec.decode(b'{"old": "value"}') == {"old": "value"}
+
+
+def test_unknown_header():
+    with pytest.raises(ValueError):
+        kvs_codec.Codec('json', 'zlib').decode(kvs_codec.HEADER + b'jx' + b'{}')
+
+
+@pytest.mark.parametrize("serializer", SERIALIZERS)
+def test_not_json(serializer):
+    '''
+    Whichever serializer we use, we only take what JSON would
+    '''
+    codec = kvs_codec.Codec(serializer, 'zlib')
+    with pytest.raises(TypeError):
+        codec.encode({"a": set()})
+    with pytest.raises(TypeError):
+        codec.encode({(1, 2): "a"})
+
+
+def test_unavailable():
+    with pytest.raises(ValueError):
+        kvs_codec.Codec('pickle', 'zlib')
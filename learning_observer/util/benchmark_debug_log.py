@@ -0,0 +1,151 @@
+'''
+Benchmark ingestion with debug logging on and off
+
+Usage:
+    benchmark_debug_log.py [--students=n] [--events=n] [--seed=n] [--config-file=filename] [--output=filename]
+
+Options:
+    --students=n             Students sending events at once [default: 10]
+    --events=n               Events per student [default: 500]
+    --seed=n                 Random seed, so runs are comparable [default: 0]
+    --config-file=filename   Learning Observer settings file, if not the usual one
+    --output=filename        Where to write results [default: benchmark_debug_log.json]
+
+Overview:
+    Send Google Docs keystroke events (as in `benchmark_reconstruct.py`)
+    through the Writing Observer reducers, with a `StudentSession` per
+    student, as the websocket handler does. We do this at each
+    `debug_log` level (`none`, `messages`, and `trace`; see
+    `log_event.DEBUG_LOG`), and report events per second, and p50 /
+    p99 latency per event.
+
+    Debug messages are printed as well as saved. We send the console
+    output to /dev/null while we time, so the terminal doesn't slow
+    things down.
+
+    This needs `writing_observer` installed (e.g. `pip install -e` in
+    `modules/writing_observer`), and a settings file (as the server
+    uses).
+'''
+
+import asyncio
+import contextlib
+import datetime
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+import docopt
+
+ARGS = docopt.docopt(__doc__)
+
+# `learning_observer.settings` reads the command line, so we hand it
+# only what it understands.
+sys.argv = sys.argv[:1]
+if ARGS['--config-file']:
+    sys.argv.extend(['--config-file', ARGS['--config-file']])
+
+import benchmark_reconstruct  # noqa: E402
+import learning_observer.incoming_student_event as incoming_student_event  # noqa: E402
+import learning_observer.log_event as log_event  # noqa: E402
+
+SOURCE = "org.mitros.writing-analytics"
+
+
+class Request(object):
+    '''
+    Just enough of an `aiohttp` request for `compile_server_data`
+    '''
+    headers = {
+        'Origin': 'chrome-extension://benchmark',
+        'User-Agent': 'benchmark_debug_log.py',
+        'X-Real-IP': '127.0.0.1'
+    }
+
+
+async def student(level, number, events, latencies):
+    '''
+    One student's events, one after another
+    '''
+    request = Request()
+    session = incoming_student_event.StudentSession({
+        'headers': {},
+        'source': SOURCE,
+        'auth': {
+            'safe_user_id': "bench-{level}-{number}".format(level=level, number=number),
+            'providence': 'benchmark'
+        }
+    })
+    await session.open()
+    try:
+        for event in events:
+            start = time.perf_counter()
+            await session.handle(request, event)
+            latencies.append(time.perf_counter() - start)
+    finally:
+        await session.close()
+
+
+def percentile(values, fraction):
+    '''
+    The `fraction` percentile of a sorted list
+    '''
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def benchmark(level, students, events):
+    '''
+    Run all the students at once, at one debug log level
+    '''
+    log_event.DEBUG_LOG = log_event.DEBUG_LOG_LEVELS.index(level)
+    latencies = []
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            student(level, number, events, latencies) for number in range(students)
+        ])
+        seconds = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'events_per_second': students * len(events) / seconds,
+        'p50_us': percentile(latencies, 0.5) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6,
+        'mean_us': statistics.mean(latencies) * 1e6
+    }
+
+
+async def main():
+    students = int(ARGS['--students'])
+    seed = int(ARGS['--seed'])
+    events = benchmark_reconstruct.keystrokes(10 * 1024, seed)[:int(ARGS['--events'])]
+
+    results = {
+        'time': datetime.datetime.utcnow().isoformat(),
+        'commit': benchmark_reconstruct.git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'students': students,
+        'events': len(events),
+        'seed': seed,
+        'levels': {}
+    }
+    for level in log_event.DEBUG_LOG_LEVELS:
+        result = await benchmark(level, students, events)
+        results['levels'][level] = result
+        print("{level:>8}: {rate:>9.0f} events/s, p50 {p50:.0f}us, p99 {p99:.0f}us".format(
+            level=level,
+            rate=result['events_per_second'],
+            p50=result['p50_us'],
+            p99=result['p99_us']
+        ))
+
+    with open(ARGS['--output'], "w") as fp:
+        json.dump(results, fp, indent=2)
+    print("Results written to", ARGS['--output'])
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,117 @@
+'''
+Benchmark KVS value encoding
+
+Usage:
+    benchmark_kvs_codec.py [--sizes=kb,kb] [--seed=n] [--output=filename]
+
+Options:
+    --sizes=kb,kb        Essay lengths to test, in kilobytes [default: 1,10,50,200]
+    --seed=n             Random seed, so runs are comparable [default: 0]
+    --output=filename    Where to write results [default: benchmark_kvs_codec.json]
+
+Overview:
+    Build the state of the `reconstruct` reducer for synthetic essays
+    (as in `benchmark_reconstruct.py`), and time encoding and decoding
+    it with every codec we have installed (see `kvs_codec`): each
+    serializer, with and without compression. We also report the
+    encoded size, relative to plain `json.dumps`, which is what we
+    used to store.
+
+    This needs `writing_observer` installed (e.g. `pip install -e` in
+    `modules/writing_observer`). Install `orjson`, `msgpack`, and
+    `zstandard` to compare them, too.
+'''
+
+import datetime
+import json
+import platform
+import time
+
+import docopt
+
+import benchmark_reconstruct
+import learning_observer.kvs_codec as kvs_codec
+import writing_observer.reconstruct_doc as reconstruct_doc
+
+# How long to spend timing each codec on each state, in seconds
+SECONDS = 0.5
+
+
+def state(size, seed):
+    '''
+    The internal state of the `reconstruct` reducer for an essay of
+    about `size` bytes
+    '''
+    events = benchmark_reconstruct.keystrokes(size, seed)
+    commands = [
+        command for event in events for command in benchmark_reconstruct.commands(event)
+    ]
+    return reconstruct_doc.batch_command_list(reconstruct_doc.google_text(), commands).json
+
+
+def timed(function):
+    '''
+    Mean time to run `function`, in microseconds
+    '''
+    count = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < SECONDS:
+        function()
+        count += 1
+    return (time.perf_counter() - start) / count * 1e6
+
+
+def benchmark(value):
+    '''
+    Time every codec on `value`
+    '''
+    baseline = len(json.dumps(value).encode('utf-8'))
+    serializers, compressions = kvs_codec.available()
+    results = {}
+    for serializer in serializers:
+        for compression in compressions:
+            # Compress everything, so we see the cost at every size
+            codec = kvs_codec.Codec(serializer, compression, compress_above=0)
+            encoded = codec.encode(value)
+            assert codec.decode(encoded) == value
+            results["{serializer}/{compression}".format(
+                serializer=serializer, compression=compression
+            )] = {
+                'encode_us': timed(lambda: codec.encode(value)),
+                'decode_us': timed(lambda: codec.decode(encoded)),
+                'bytes': len(encoded),
+                'relative_size': len(encoded) / baseline
+            }
+    return results
+
+
+if __name__ == '__main__':
+    ARGS = docopt.docopt(__doc__)
+    SIZES = [int(size) for size in ARGS['--sizes'].split(",")]
+    SEED = int(ARGS['--seed'])
+
+    results = {
+        'time': datetime.datetime.utcnow().isoformat(),
+        'commit': benchmark_reconstruct.git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': SEED,
+        'sizes': {}
+    }
+    for size in SIZES:
+        result = benchmark(state(size * 1024, SEED))
+        results['sizes'][size] = result
+        for codec, timing in result.items():
+            print("{size:>4} KB {codec:>15}: encode {encode:>9.1f}us, decode {decode:>9.1f}us, "
+                  "{bytes:>8} bytes ({relative:.0%} of json)".format(
+                      size=size,
+                      codec=codec,
+                      encode=timing['encode_us'],
+                      decode=timing['decode_us'],
+                      bytes=timing['bytes'],
+                      relative=timing['relative_size']
+                  ))
+
+    with open(ARGS['--output'], "w") as fp:
+        json.dump(results, fp, indent=2)
+    print("Results written to", ARGS['--output'])
@@ -0,0 +1,160 @@
+'''
+Benchmark reducer state exchange with redis
+
+Usage:
+    benchmark_kvs_exchange.py [--students=n] [--events=n] [--state-kb=kb] [--config-file=filename] [--output=filename]
+
+Options:
+    --students=n             Students sending events at once [default: 30]
+    --events=n               Events per student [default: 200]
+    --state-kb=kb            Size of the internal state, in kilobytes [default: 1]
+    --config-file=filename   Learning Observer settings file, if not the usual one
+    --output=filename        Where to write results [default: benchmark_kvs_exchange.json]
+
+Overview:
+    For every event, a reducer reads its internal state, and writes
+    its internal and external state. We time this against a running
+    redis, two ways:
+
+    * `three-call`: a GET and two SETs, as reducers did originally
+    * `exchange`: `get_versioned` (one MGET) and `set_pair` (one Lua
+      script call), with a version check
+
+    Each simulated student has its own connection, as each websocket
+    does. We report events per second, and p50 / p99 latency per
+    event. On localhost, round trips are cheap; the gap grows with
+    the network latency to redis.
+
+    This needs a redis server, and a settings file (as the server
+    uses).
+'''
+
+import asyncio
+import datetime
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import time
+
+import docopt
+
+ARGS = docopt.docopt(__doc__)
+
+# `learning_observer.settings` reads the command line, so we hand it
+# only what it understands.
+sys.argv = sys.argv[:1]
+if ARGS['--config-file']:
+    sys.argv.extend(['--config-file', ARGS['--config-file']])
+
+import learning_observer.kvs  # noqa: E402
+
+# Keys expire, so we don't leave junk behind
+EXPIRE = 300
+
+
+def percentile(values, fraction):
+    '''
+    The `fraction` percentile of a sorted list
+    '''
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def three_call(kvs, internal_key, external_key, state):
+    '''
+    The original path: GET, SET, SET
+    '''
+    internal_state = await kvs[internal_key]
+    await kvs.set(internal_key, state)
+    await kvs.set(external_key, {'count': len(internal_state or {})})
+
+
+async def exchange(kvs, internal_key, external_key, state):
+    '''
+    The new path: MGET, then one script call
+    '''
+    internal_state, version = await kvs.get_versioned(internal_key)
+    await kvs.set_pair(
+        internal_key, state,
+        external_key, {'count': len(internal_state or {})},
+        version
+    )
+
+
+async def student(method, number, events, state, latencies):
+    '''
+    One student's events, one after another
+    '''
+    kvs = learning_observer.kvs._RedisKVS(expire=EXPIRE)
+    internal_key = "Benchmark:{method}:{number}:internal".format(method=method.__name__, number=number)
+    external_key = "Benchmark:{method}:{number}:external".format(method=method.__name__, number=number)
+    for i in range(events):
+        start = time.perf_counter()
+        await method(kvs, internal_key, external_key, state)
+        latencies.append(time.perf_counter() - start)
+
+
+async def benchmark(method, students, events, state):
+    '''
+    Run all the students at once
+    '''
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        student(method, number, events, state, latencies) for number in range(students)
+    ])
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'events_per_second': students * events / seconds,
+        'p50_us': percentile(latencies, 0.5) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6,
+        'mean_us': statistics.mean(latencies) * 1e6
+    }
+
+
+def git_commit():
+    '''
+    The commit we're benchmarking, if we can tell
+    '''
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main():
+    students = int(ARGS['--students'])
+    events = int(ARGS['--events'])
+    state = {'text': 'x' * (int(ARGS['--state-kb']) * 1024)}
+
+    results = {
+        'time': datetime.datetime.utcnow().isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'students': students,
+        'events': events,
+        'state_kb': int(ARGS['--state-kb']),
+        'methods': {}
+    }
+    for method in [three_call, exchange]:
+        result = await benchmark(method, students, events, state)
+        results['methods'][method.__name__] = result
+        print("{method:>10}: {rate:>9.0f} events/s, p50 {p50:.0f}us, p99 {p99:.0f}us".format(
+            method=method.__name__,
+            rate=result['events_per_second'],
+            p50=result['p50_us'],
+            p99=result['p99_us']
+        ))
+
+    with open(ARGS['--output'], "w") as fp:
+        json.dump(results, fp, indent=2)
+    print("Results written to", ARGS['--output'])
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
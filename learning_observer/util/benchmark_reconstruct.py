@@ -0,0 +1,272 @@
+'''
+Benchmark document reconstruction
+
+Usage:
+    benchmark_reconstruct.py [--sizes=kb,kb] [--seed=n] [--output=filename]
+
+Options:
+    --sizes=kb,kb        Essay lengths to test, in kilobytes [default: 1,10,50,200]
+    --seed=n             Random seed, so runs are comparable [default: 0]
+    --output=filename    Where to write results [default: benchmark_reconstruct.json]
+
+Overview:
+    Generate synthetic keystroke streams (typing, typos and backspaces,
+    going back to revise, and pastes) of various essay lengths, using
+    the same events as `stream_writing.py`. Time `reconstruct_doc` on
+    them:
+
+    * `command_list`, one event at a time (as events arrive), with
+      p50 / p99 latency per event and per command type
+    * `batch_command_list`, over the whole stream (as when replaying
+      a history or compacting an op-log)
+    * `google_text.json` and `google_text.from_json` on the final
+      document (as the reducer does to store state)
+
+    We also measure peak memory for each (in a separate pass, since
+    `tracemalloc` slows things down). Results are printed, and written
+    to a JSON file, so we can compare across changes.
+
+    This needs `writing_observer` installed (e.g. `pip install -e` in
+    `modules/writing_observer`).
+'''
+
+import datetime
+import json
+import platform
+import random
+import statistics
+import subprocess
+import time
+import tracemalloc
+
+import docopt
+
+import stream_writing
+import writing_observer.reconstruct_doc as reconstruct_doc
+
+DOC_ID = "benchmark-doc"
+
+# A vocabulary to type, so words have realistic lengths
+WORDS = (
+    "the of and to in is that for it as was with be by on not he this are "
+    "or his from at which but have an they you were her all she there would "
+    "their we him been has when who will more no if out so said what up its "
+    "about into than them can only other new some could time these two may "
+    "then do first any my now such like our over man me even most made after "
+    "also did many before must through back years where much your way well "
+    "down should because each just those people how too little state good "
+    "very make world still own see men work long get here between both life "
+    "being under never day same another know while last might us great old "
+    "year off come since against go came right used take three essay argument "
+    "evidence however therefore paragraph conclusion reasoning author claim"
+).split()
+
+# Per word, how likely the writer is to...
+TYPO = 0.05       # ... make a typo, and backspace over it
+REWORD = 0.01     # ... backspace over the whole word, and retype it
+REVISE = 0.01     # ... go back somewhere earlier, and add a few words
+PASTE = 0.002     # ... paste in a paragraph
+PARAGRAPH = 0.02  # ... start a new paragraph
+
+
+def sentence(rng, words):
+    '''
+    Some words, as typed text
+    '''
+    return " ".join(rng.choice(WORDS) for i in range(words)) + " "
+
+
+def keystrokes(size, seed):
+    '''
+    A list of Google Docs save events which type an essay of about `size`
+    characters.
+    '''
+    rng = random.Random(seed)
+    events = []
+    length = 0
+
+    def type_text(text, cursor):
+        '''
+        Type `text` at `cursor` (0-based), one keystroke per character.
+        '''
+        for offset, char in enumerate(text):
+            events.append(stream_writing.insert(cursor + offset + 1, char, DOC_ID))
+        return len(text)
+
+    while length < size:
+        roll = rng.random()
+        if roll < PASTE:
+            text = sentence(rng, rng.randint(50, 250))
+            events.append(stream_writing.insert(length + 1, text, DOC_ID))
+            length += len(text)
+        elif roll < PASTE + REVISE and length > 0:
+            cursor = rng.randint(0, length)
+            length += type_text(sentence(rng, rng.randint(1, 5)), cursor)
+        elif roll < PASTE + REVISE + REWORD:
+            word = sentence(rng, 1)
+            length += type_text(word, length)
+            for i in range(len(word)):
+                events.append(stream_writing.delete(length, length, DOC_ID))
+                length -= 1
+            length += type_text(word, length)
+        elif roll < PASTE + REVISE + REWORD + TYPO:
+            length += type_text(rng.choice("qxzj"), length)
+            events.append(stream_writing.delete(length, length, DOC_ID))
+            length -= 1
+        elif roll < PASTE + REVISE + REWORD + TYPO + PARAGRAPH:
+            length += type_text("\n", length)
+        else:
+            length += type_text(sentence(rng, 1), length)
+    return events
+
+
+def commands(event):
+    '''
+    The Google Docs commands in an event
+    '''
+    return [command for bundle in event['bundles'] for command in bundle['commands']]
+
+
+def percentile(values, fraction):
+    '''
+    The `fraction` percentile of a sorted list
+    '''
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def latency_summary(latencies):
+    '''
+    Summarize a list of latencies (in seconds) in microseconds
+    '''
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'p50_us': percentile(latencies, 0.5) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6,
+        'mean_us': statistics.mean(latencies) * 1e6
+    }
+
+
+def peak_memory(function):
+    '''
+    Peak memory allocated while running `function`, in bytes
+    '''
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+def benchmark(events):
+    '''
+    Run our benchmarks over a stream of events
+    '''
+    command_lists = [commands(event) for event in events]
+    all_commands = [command for command_list in command_lists for command in command_list]
+
+    # One event at a time
+    latencies = []
+    by_type = {}
+    doc = reconstruct_doc.google_text()
+    start = time.perf_counter()
+    for command_list in command_lists:
+        event_start = time.perf_counter()
+        doc = reconstruct_doc.command_list(doc, command_list)
+        latency = time.perf_counter() - event_start
+        latencies.append(latency)
+        by_type.setdefault(command_list[0]['ty'], []).append(latency)
+    sequential_seconds = time.perf_counter() - start
+
+    # All at once
+    start = time.perf_counter()
+    batch_doc = reconstruct_doc.batch_command_list(reconstruct_doc.google_text(), all_commands)
+    batch_seconds = time.perf_counter() - start
+    assert str(batch_doc) == str(doc)
+
+    # Serialization
+    start = time.perf_counter()
+    state = doc.json
+    to_json_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    reconstruct_doc.google_text.from_json(state)
+    from_json_seconds = time.perf_counter() - start
+
+    def sequential():
+        replay = reconstruct_doc.google_text()
+        for command_list in command_lists:
+            replay = reconstruct_doc.command_list(replay, command_list)
+
+    return {
+        'events': len(events),
+        'commands': len(all_commands),
+        'text_length': doc.len(),
+        'state_bytes': len(json.dumps(state)),
+        'sequential': {
+            'events_per_second': len(events) / sequential_seconds,
+            'latency': latency_summary(latencies),
+            'latency_by_command': {
+                command: latency_summary(values) for command, values in by_type.items()
+            },
+            'peak_memory_bytes': peak_memory(sequential)
+        },
+        'batch': {
+            'events_per_second': len(events) / batch_seconds,
+            'seconds': batch_seconds,
+            'peak_memory_bytes': peak_memory(
+                lambda: reconstruct_doc.batch_command_list(reconstruct_doc.google_text(), all_commands)
+            )
+        },
+        'json': {
+            'to_json_seconds': to_json_seconds,
+            'from_json_seconds': from_json_seconds
+        }
+    }
+
+
+def git_commit():
+    '''
+    The commit we're benchmarking, if we can tell
+    '''
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL
+        ).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    ARGS = docopt.docopt(__doc__)
+    SIZES = [int(size) for size in ARGS['--sizes'].split(",")]
+    SEED = int(ARGS['--seed'])
+
+    results = {
+        'time': datetime.datetime.utcnow().isoformat(),
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': SEED,
+        'sizes': {}
+    }
+    for size in SIZES:
+        events = keystrokes(size * 1024, SEED)
+        result = benchmark(events)
+        results['sizes'][size] = result
+        print("{size:>4} KB: {events:>7} events | sequential {sequential:>9.0f} events/s, "
+              "p50 {p50:.1f}us, p99 {p99:.1f}us, peak {memory:.1f} MB | "
+              "batch {batch:>9.0f} events/s | json {to_json:.1f}ms / {from_json:.1f}ms".format(
+                  size=size,
+                  events=result['events'],
+                  sequential=result['sequential']['events_per_second'],
+                  p50=result['sequential']['latency']['p50_us'],
+                  p99=result['sequential']['latency']['p99_us'],
+                  memory=result['sequential']['peak_memory_bytes'] / 1e6,
+                  batch=result['batch']['events_per_second'],
+                  to_json=result['json']['to_json_seconds'] * 1000,
+                  from_json=result['json']['from_json_seconds'] * 1000
+              ))
+
+    with open(ARGS['--output'], "w") as fp:
+        json.dump(results, fp, indent=2)
+    print("Results written to", ARGS['--output'])
@@ -0,0 +1,181 @@
+'''
+Benchmark per-message overhead on student websockets
+
+Usage:
+    benchmark_ws_session.py [--students=n] [--events=n] [--seed=n] [--config-file=filename] [--output=filename]
+
+Options:
+    --students=n             Students sending events at once [default: 10]
+    --events=n               Events per student [default: 500]
+    --seed=n                 Random seed, so runs are comparable [default: 0]
+    --config-file=filename   Learning Observer settings file, if not the usual one
+    --output=filename        Where to write results [default: benchmark_ws_session.json]
+
+Overview:
+    Send Google Docs keystroke events (as in `benchmark_reconstruct.py`)
+    through the Writing Observer reducers, as the websocket handler
+    does, two ways:
+
+    * `per_message`: build the event pipeline (and every reducer) for
+      each message, as we used to
+    * `ingestion`: build it once per connection, with a
+      `StudentSession`, and queue events up for the `Ingestion`
+      workers, which run them through the pipeline in batches (as the
+      websocket handler does now)
+
+    Both run the same reducers on the same events against whichever
+    KVS the settings file sets up. We report events per second, and
+    p50 / p99 latency per event. For `ingestion`, an event's latency
+    is from when its batch from the client arrives to when the whole
+    batch has been through the reducers.
+
+    This needs `writing_observer` installed (e.g. `pip install -e` in
+    `modules/writing_observer`), and a settings file (as the server
+    uses).
+'''
+
+import asyncio
+import datetime
+import json
+import platform
+import statistics
+import sys
+import time
+
+import docopt
+
+ARGS = docopt.docopt(__doc__)
+
+# `learning_observer.settings` reads the command line, so we hand it
+# only what it understands.
+sys.argv = sys.argv[:1]
+if ARGS['--config-file']:
+    sys.argv.extend(['--config-file', ARGS['--config-file']])
+
+import benchmark_reconstruct  # noqa: E402
+import learning_observer.incoming_student_event as incoming_student_event  # noqa: E402
+
+SOURCE = "org.mitros.writing-analytics"
+
+# How many events the client sends at once, for `ingestion`
+CLIENT_BATCH = 10
+
+
+class Request(object):
+    '''
+    Just enough of an `aiohttp` request for `compile_server_data`
+    '''
+    headers = {
+        'Origin': 'chrome-extension://benchmark',
+        'User-Agent': 'benchmark_ws_session.py',
+        'X-Real-IP': '127.0.0.1'
+    }
+
+
+def metadata(method, number):
+    '''
+    Event metadata for one simulated student, as after authentication
+    '''
+    return {
+        'headers': {},
+        'source': SOURCE,
+        'auth': {
+            'safe_user_id': "bench-{method}-{number}".format(method=method.__name__, number=number),
+            'providence': 'benchmark'
+        }
+    }
+
+
+async def per_message(metadata, events, latencies):
+    '''
+    The old path: a new pipeline for every message
+    '''
+    request = Request()
+    for event in events:
+        start = time.perf_counter()
+        handler = await incoming_student_event.handle_incoming_client_event(metadata=metadata)
+        await handler(request, event)
+        latencies.append(time.perf_counter() - start)
+
+
+async def ingestion(metadata, events, latencies):
+    '''
+    The new path: one pipeline per connection, with events going
+    through the ingestion queue. We count opening the session against
+    the first batch.
+    '''
+    request = Request()
+    queue = incoming_student_event.ingestion()
+    start = time.perf_counter()
+    student = incoming_student_event.StudentSession(metadata)
+    await student.open()
+    try:
+        for offset in range(0, len(events), CLIENT_BATCH):
+            batch = events[offset:offset + CLIENT_BATCH]
+            for event in batch:
+                await queue.put(student, request, event)
+            await queue.drain(student)
+            latencies.extend([time.perf_counter() - start] * len(batch))
+            start = time.perf_counter()
+    finally:
+        await student.close()
+
+
+def percentile(values, fraction):
+    '''
+    The `fraction` percentile of a sorted list
+    '''
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def benchmark(method, students, events):
+    '''
+    Run all the students at once
+    '''
+    latencies = []
+    start = time.perf_counter()
+    await asyncio.gather(*[
+        method(metadata(method, number), events, latencies) for number in range(students)
+    ])
+    seconds = time.perf_counter() - start
+    latencies.sort()
+    return {
+        'events_per_second': students * len(events) / seconds,
+        'p50_us': percentile(latencies, 0.5) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6,
+        'mean_us': statistics.mean(latencies) * 1e6
+    }
+
+
+async def main():
+    students = int(ARGS['--students'])
+    seed = int(ARGS['--seed'])
+    events = benchmark_reconstruct.keystrokes(10 * 1024, seed)[:int(ARGS['--events'])]
+
+    results = {
+        'time': datetime.datetime.utcnow().isoformat(),
+        'commit': benchmark_reconstruct.git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'students': students,
+        'events': len(events),
+        'seed': seed,
+        'methods': {}
+    }
+    for method in [per_message, ingestion]:
+        result = await benchmark(method, students, events)
+        results['methods'][method.__name__] = result
+        print("{method:>11}: {rate:>9.0f} events/s, p50 {p50:.0f}us, p99 {p99:.0f}us".format(
+            method=method.__name__,
+            rate=result['events_per_second'],
+            p50=result['p50_us'],
+            p99=result['p99_us']
+        ))
+
+    with open(ARGS['--output'], "w") as fp:
+        json.dump(results, fp, indent=2)
+    print("Results written to", ARGS['--output'])
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
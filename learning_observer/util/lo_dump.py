@@ -15,24 +15,34 @@ similar functionality in production, `redis` has built-in persistance:
 
 https://redis.io/topics/persistence
 
-To do: We should make this script abstract:
-* Use LO's KVS abstraction, rather than redis directly
-* As a correlary to the above, use the config file to authenticated
-  if redis is e.g. non-local
-* Take semantic arguments (e.g. course, users, etc.) rather than a
-  query string
-
-Until at least the last one (so API is fixed), we should not build
+This goes through LO's KVS abstraction (so it works with whichever
+KVS the config file sets up), and reads keys in bulk with `mget`.
+
+Each key is on one line, and its data (as JSON) on the next. Lists
+(e.g. op-logs) and sets (e.g. indexes) don't come back from `mget`,
+so we read those one at a time, and put their type after the key,
+with a tab in between:
+
+    Oplog:writing_observer.writing_analysis.reconstruct:s1:doc\tlist
+    [{"ops": ...}, ...]
+
+To do: We should take semantic arguments (e.g. course, users, etc.)
+rather than a query string.
+
+Until then (so API is fixed), we should not build
 dependencies around this script. A one-off hack is fine in
 development, but nothing committed to the repo which calls this with a
 query string.
 '''
 
 import argparse
+import asyncio
 import json
-import redis
 import sys
 
+# How many keys we read per `mget`
+CHUNK = 1000
+
 parser = argparse.ArgumentParser(
     description=__doc__.strip(),
     formatter_class=argparse.RawTextHelpFormatter
@@ -45,22 +55,58 @@ parser.add_argument(
     '--out', type=argparse.FileType('x', encoding='UTF-8'),
     help="Output filename"
 )
+parser.add_argument(
+    '--config-file',
+    help="Learning Observer settings file, if not the usual one"
+)
 
 args = parser.parse_args()
 
+# `learning_observer.settings` reads the command line, so we hand it
+# only what it understands.
+sys.argv = sys.argv[:1]
+if args.config_file:
+    sys.argv.extend(['--config-file', args.config_file])
+
+import learning_observer.kvs  # noqa: E402
+
 if args.out is None:
     out = sys.stdout
 else:
     out = args.out
 
-r = redis.Redis()
-keys = r.keys(args.query_string)
-
-# For now, we alternate keys and data per line
-for key in keys:
-    out.write(key.decode('utf-8'))
-    out.write('\n')
-    # We do a load-and-dump to avoid new lines, in case of data
-    # corruption or similar. It's really not necessary.
-    out.write(json.dumps(json.loads(r.get(key))))
-    out.write('\n')
+
+async def dump():
+    kvs = learning_observer.kvs.KVS()
+    keys = [key async for key in kvs.scan(args.query_string)]
+    skipped = 0
+
+    # For now, we alternate keys and data per line
+    for start in range(0, len(keys), CHUNK):
+        chunk = keys[start:start + CHUNK]
+        for key, value in zip(chunk, await kvs.mget(chunk)):
+            key_type = None
+            if value is None:
+                key_type = await kvs.key_type(key)
+                if key_type == 'list':
+                    value = await kvs.get_list(key)
+                elif key_type == 'set':
+                    value = await kvs.get_set(key)
+                else:
+                    # Gone since we scanned, or nothing we store
+                    skipped += 1
+                    continue
+            out.write(key)
+            if key_type is not None:
+                out.write('\t')
+                out.write(key_type)
+            out.write('\n')
+            # We dump on one line, so newlines in the data can't
+            # confuse `lo_load`.
+            out.write(json.dumps(value))
+            out.write('\n')
+    if skipped:
+        print("Skipped {skipped} keys we couldn't read".format(skipped=skipped), file=sys.stderr)
+
+
+asyncio.run(dump())
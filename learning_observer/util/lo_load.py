@@ -1,7 +1,9 @@
 '''
 This is a short script to write data to redis.
 
-It reads data from `lo_load`. See `lo_load` documentation for details.
+It reads data from `lo_dump`. See `lo_dump` documentation for details.
+Lists replace whatever list was in their key; sets are added to
+whatever set was there.
 
 It is **not** intended for production use, or even for use within
 archival scripts. Data formats, command line interfaces, etc. may and
@@ -9,10 +11,13 @@ probably will change.
 '''
 
 import argparse
+import asyncio
 import json
-import redis
 import sys
 
+# How many keys we write per `mset`
+CHUNK = 1000
+
 parser = argparse.ArgumentParser(
     description=__doc__.strip(),
     formatter_class=argparse.RawTextHelpFormatter
@@ -23,22 +28,61 @@ parser.add_argument(
     dest="filename",
     help="Input filename"
 )
+parser.add_argument(
+    '--config-file',
+    help="Learning Observer settings file, if not the usual one"
+)
 
 args = parser.parse_args()
 
 if args.filename is None:
     parser.print_usage()
+    sys.exit(-1)
 
-r = redis.Redis()
+# `learning_observer.settings` reads the command line, so we hand it
+# only what it understands.
+sys.argv = sys.argv[:1]
+if args.config_file:
+    sys.argv.extend(['--config-file', args.config_file])
 
-odd = True
+import learning_observer.kvs  # noqa: E402
 
-# For now, we alternate keys and data per line
-for line in args.filename:
-    if odd:
-        odd = False
-        key = line.strip()
+
+async def load_collection(kvs, key, key_type, value):
+    '''
+    Write a list or set from the dump
+    '''
+    if key_type == 'list':
+        await kvs.trim_list(key, len(await kvs.get_list(key)))
+        for item in value:
+            await kvs.append(key, item)
+    elif key_type == 'set':
+        await kvs.add_to_set(key, value)
     else:
-        odd = True
-        value = line.strip()
-        r.set(key, value)
+        print("Unknown type {key_type} for {key}".format(key_type=key_type, key=key), file=sys.stderr)
+
+
+async def load():
+    kvs = learning_observer.kvs.KVS()
+    odd = True
+    chunk = {}
+
+    # For now, we alternate keys and data per line. Lists and sets
+    # have their type after the key.
+    for line in args.filename:
+        if odd:
+            odd = False
+            key, _, key_type = line.strip().partition('\t')
+        else:
+            odd = True
+            if key_type:
+                await load_collection(kvs, key, key_type, json.loads(line))
+                continue
+            chunk[key] = json.loads(line)
+            if len(chunk) >= CHUNK:
+                await kvs.mset(chunk)
+                chunk = {}
+    await kvs.mset(chunk)
+
+
+asyncio.run(load())
@@ -30,41 +30,6 @@ import sys
 import aiohttp
 import docopt
 
-import loremipsum
-
-ARGS = docopt.docopt(__doc__)
-print(ARGS)
-
-STREAMS = int(ARGS["--streams"])
-
-if ARGS['--source'] == []:
-    TEXT = ["\n".join(loremipsum.get_paragraphs(5))] * STREAMS
-else:
-    filenames = ARGS['--source']
-    if len(filenames) == 1:
-        filenames = filenames * STREAMS
-    TEXT = [open(filename).read() for filename in filenames]
-
-if len(ARGS['--ici']) == 1:
-    ICI = ARGS['--ici'] * STREAMS
-else:
-    ICI = ARGS['--ici']
-
-if ARGS['--users'] == []:
-    USERS = ["test-user-{n}".format(n=i) for i in range(STREAMS)]
-else:
-    USERS = ARGS['--users']
-
-if ARGS["--gdids"] == []:
-    DOC_IDS = ["fake-google-doc-id-{n}".format(n=i) for i in range(STREAMS)]
-else:
-    DOC_IDS = ARGS["--gdids"]
-
-assert len(TEXT) == STREAMS, "len(filenames) != STREAMS."
-assert len(ICI) == STREAMS, "len(ICIs) != STREAMS."
-assert len(USERS) == STREAMS, "len(users) != STREAMS."
-assert len(DOC_IDS) == STREAMS, "len(document IDs) != STREAMS."
-
 
 def insert(index, text, doc_id):
     '''
@@ -81,6 +46,21 @@ def insert(index, text, doc_id):
     }
 
 
+def delete(start, end, doc_id):
+    '''
+    Generate a minimal 'delete' event, as with `insert`. Google's
+    indexes are 1-based and inclusive, so a backspace over the
+    character at `index` is `delete(index, index, doc_id)`.
+    '''
+    return {
+        "bundles": [{'commands': [{"si": start, "ei": end, "ty": "ds"}]}],
+        "event": "google_docs_save",
+        "source": "org.mitros.writing-analytics",
+        "doc_id": doc_id,
+        "origin": "stream-test-script"
+    }
+
+
 def identify(user):
     '''
     Send a token identifying user.
@@ -132,8 +112,47 @@ async def run():
         await streamer
     print(streamers)
 
-try:
-    asyncio.run(run())
-except aiohttp.client_exceptions.ServerDisconnectedError:
-    print("Could not connect to server")
-    sys.exit(-1)
+
+# We only stream when run as a script, so other scripts (e.g. benchmarks)
+# can import the event generators above.
+if __name__ == '__main__':
+    import loremipsum
+
+    ARGS = docopt.docopt(__doc__)
+    print(ARGS)
+
+    STREAMS = int(ARGS["--streams"])
+
+    if ARGS['--source'] == []:
+        TEXT = ["\n".join(loremipsum.get_paragraphs(5))] * STREAMS
+    else:
+        filenames = ARGS['--source']
+        if len(filenames) == 1:
+            filenames = filenames * STREAMS
+        TEXT = [open(filename).read() for filename in filenames]
+
+    if len(ARGS['--ici']) == 1:
+        ICI = ARGS['--ici'] * STREAMS
+    else:
+        ICI = ARGS['--ici']
+
+    if ARGS['--users'] == []:
+        USERS = ["test-user-{n}".format(n=i) for i in range(STREAMS)]
+    else:
+        USERS = ARGS['--users']
+
+    if ARGS["--gdids"] == []:
+        DOC_IDS = ["fake-google-doc-id-{n}".format(n=i) for i in range(STREAMS)]
+    else:
+        DOC_IDS = ARGS["--gdids"]
+
+    assert len(TEXT) == STREAMS, "len(filenames) != STREAMS."
+    assert len(ICI) == STREAMS, "len(ICIs) != STREAMS."
+    assert len(USERS) == STREAMS, "len(users) != STREAMS."
+    assert len(DOC_IDS) == STREAMS, "len(document IDs) != STREAMS."
+
+    try:
+        asyncio.run(run())
+    except aiohttp.client_exceptions.ServerDisconnectedError:
+        print("Could not connect to server")
+        sys.exit(-1)
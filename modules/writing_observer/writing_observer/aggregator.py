@@ -1,6 +1,12 @@
 import time
 import learning_observer.util
 
+import writing_observer.deane
+import writing_observer.formatting
+
+# Points in the Deane graph we send for each student's dashboard tile
+DEANE_TILE_POINTS = 50
+
 
 def sanitize_and_shrink_per_student_data(student_data):
     '''
@@ -10,6 +16,7 @@ def sanitize_and_shrink_per_student_data(student_data):
     * Compute text length
     * Cut down the text to just what the client needs to receive (we
       don't want to send 30 full essays)
+    * Compute an outline from the formatting (for `ux/outline.js`)
     '''
     text = student_data['writing_observer.writing_analysis.reconstruct'].get('text', None)
     if text is None:
@@ -44,14 +51,21 @@ def sanitize_and_shrink_per_student_data(student_data):
     clipped_text = text[start:cursor_position - 1] + "❙" + text[max(cursor_position - 1, 0):end]
     # Yes, this does mutate the input. No, we should. No, it doesn't matter, since the
     # code needs to move out of here. Shoo, shoo.
+    reconstruct = student_data['writing_observer.writing_analysis.reconstruct']
     student_data['writing-observer-compiled'] = {
         "text": clipped_text,
-        "character-count": character_count
+        "character-count": character_count,
+        "outline": writing_observer.formatting.outline(text, reconstruct.get('formatting'))
     }
-    # Remove things which are too big to send back. Note: Not benchmarked, so perhaps not too big
-    del student_data['writing_observer.writing_analysis.reconstruct']['text']
-    # We should downsample, rather than removing
-    del student_data['writing_observer.writing_analysis.reconstruct']['edit_metadata']
+    # Remove things which are too big to send back, and downsample the
+    # Deane graph to something a dashboard tile can draw.
+    reconstruct['edit_metadata'] = writing_observer.deane.deane_series(
+        reconstruct,
+        cache_key=student_data.get('userId'),
+        points=DEANE_TILE_POINTS
+    )
+    del reconstruct['text']
+    reconstruct.pop('formatting', None)
     return student_data
 
 
@@ -0,0 +1,205 @@
+'''
+Deane graphs, served from reducer state.
+
+A Deane graph plots essay length and cursor position against edit
+number. The raw series have one point per keystroke, which is far
+more than a dashboard tile (or a network link to 30 of them) can use,
+so we downsample on the server.
+
+We use min-max bucketing: we cut the series into buckets, and keep the
+points where each series reaches its minimum and maximum in each
+bucket. Unlike striding, this keeps spikes (e.g. a big paste or
+delete) visible. Both series share the kept edit numbers, so the
+result plugs straight into `ux/deane.js`.
+
+Dashboards poll every half-second, but most students haven't typed
+since the last poll, so we cache results by state version.
+'''
+
+import collections
+
+import aiohttp.web
+import numpy
+
+import learning_observer.auth
+import learning_observer.kvs
+import learning_observer.rosters as rosters
+import learning_observer.stream_analytics.helpers as sa_helpers
+
+import writing_observer.packed_series
+import writing_observer.writing_analysis
+
+# Default number of points in a downsampled graph, and the most a
+# client may ask for.
+DEFAULT_POINTS = 100
+MAX_POINTS = 2000
+
+# How many downsampled graphs we keep around
+CACHE_SIZE = 10000
+
+_CACHE = collections.OrderedDict()
+
+
+def downsample(cursor, length, points=DEFAULT_POINTS):
+    '''
+    Downsample cursor / length series to roughly `points` points. We
+    return a dictionary of lists: `edit` (1-based edit numbers, for
+    the X axis), `cursor`, and `length`.
+    '''
+    cursor = numpy.asarray(cursor)
+    length = numpy.asarray(length)
+    count = len(cursor)
+    if count <= points:
+        edits = numpy.arange(count)
+    else:
+        # Four points per bucket (min and max of each series), plus
+        # the first and last edits.
+        buckets = max(1, (points - 2) // 4)
+        size = -(-count // buckets)
+        offsets = numpy.arange(buckets) * size
+
+        def extrema(series):
+            '''
+            Indexes of the minimum and maximum of `series` in each bucket
+            '''
+            padded = numpy.pad(series, (0, buckets * size - count), mode='edge')
+            padded = padded.reshape(buckets, size)
+            return offsets + padded.argmin(axis=1), offsets + padded.argmax(axis=1)
+
+        edits = numpy.concatenate(extrema(cursor) + extrema(length) + ([0, count - 1],))
+        edits = numpy.unique(numpy.minimum(edits, count - 1))
+    return {
+        'edit': (edits + 1).tolist(),
+        'cursor': cursor[edits].tolist(),
+        'length': length[edits].tolist()
+    }
+
+
+def _version(edit_metadata):
+    '''
+    A cheap version for a reconstruct state: the number of edits, and
+    the last value of each series. This changes on every edit, and we
+    can compute it without decoding the series.
+    '''
+    version = []
+    for key in ['cursor', 'length']:
+        series = edit_metadata.get(key, [])
+        if isinstance(series, dict):
+            version.extend([series['count'], series['last']])
+        else:
+            version.extend([len(series), series[-1] if series else None])
+    return tuple(version)
+
+
+def deane_series(reconstruct_state, cache_key=None, points=DEFAULT_POINTS):
+    '''
+    Downsampled Deane graph for the state of the `reconstruct` reducer
+    (either packed or plain lists).
+
+    If we're given a `cache_key` (e.g. the student), we cache the result
+    until the state changes.
+    '''
+    edit_metadata = (reconstruct_state or {}).get('edit_metadata') or {}
+    version = _version(edit_metadata)
+    if cache_key is not None:
+        cached = _CACHE.get((cache_key, points))
+        if cached is not None and cached[0] == version:
+            _CACHE.move_to_end((cache_key, points))
+            return cached[1]
+
+    series = {
+        key: writing_observer.packed_series.PackedSeries.from_json(
+            edit_metadata.get(key)
+        ).values
+        for key in ['cursor', 'length']
+    }
+    result = downsample(
+        numpy.frombuffer(series['cursor'], dtype=series['cursor'].typecode),
+        numpy.frombuffer(series['length'], dtype=series['length'].typecode),
+        points
+    )
+
+    if cache_key is not None:
+        _CACHE[(cache_key, points)] = (version, result)
+        _CACHE.move_to_end((cache_key, points))
+        while len(_CACHE) > CACHE_SIZE:
+            _CACHE.popitem(last=False)
+    return result
+
+
+def _points(request):
+    '''
+    Number of points a client asked for, within reason.
+    '''
+    try:
+        points = int(request.query.get('points', DEFAULT_POINTS))
+    except ValueError:
+        raise aiohttp.web.HTTPBadRequest(text="points should be an integer")
+    return min(max(points, 2), MAX_POINTS)
+
+
+def _reconstruct_key(student_id):
+    '''
+    Where the `reconstruct` reducer keeps a student's external state
+    '''
+    return sa_helpers.make_key(
+        writing_observer.writing_analysis.reconstruct,
+        student_id,
+        sa_helpers.KeyStateType.EXTERNAL
+    )
+
+
+def _user_id(student):
+    '''
+    The user ID we keep a roster entry's data under
+    '''
+    # TODO/HACK: As in the dashboard, only Google IDs are numeric
+    student_id = student['userId']
+    if student_id.isnumeric():
+        student_id = learning_observer.auth.google_id_to_user_id(student_id)
+    return student_id
+
+
+async def _on_roster(request, student_id):
+    '''
+    Is a student in one of the requesting teacher's courses?
+    '''
+    for course in await rosters.courselist(request):
+        roster = await rosters.courseroster(request, course['id'])
+        if any(_user_id(student) == student_id for student in roster):
+            return True
+    return False
+
+
+@learning_observer.auth.teacher
+async def student_deane_view(request):
+    '''
+    Downsampled Deane graph for one student. We take an optional
+    `points` query parameter. Teachers only see their own students.
+    '''
+    student_id = request.match_info['student_id']
+    points = _points(request)
+    if not await _on_roster(request, student_id):
+        raise aiohttp.web.HTTPForbidden(text="Student is not in any of your courses")
+    state = await sa_helpers.get_external(learning_observer.kvs.KVS(), _reconstruct_key(student_id))
+    return aiohttp.web.json_response(deane_series(state, cache_key=student_id, points=points))
+
+
+@learning_observer.auth.teacher
+async def course_deane_view(request):
+    '''
+    Downsampled Deane graphs for every student in a course, by user ID.
+    We read every student's state at once (see `get_externals`).
+    '''
+    course_id = int(request.match_info['course_id'])
+    points = _points(request)
+    roster = await rosters.courseroster(request, course_id)
+    student_ids = [_user_id(student) for student in roster]
+    states = await sa_helpers.get_externals(
+        learning_observer.kvs.KVS(),
+        [_reconstruct_key(student_id) for student_id in student_ids]
+    )
+    graphs = {}
+    for student, student_id, state in zip(roster, student_ids, states):
+        graphs[student['userId']] = deane_series(state, cache_key=student_id, points=points)
+    return aiohttp.web.json_response(graphs)
@@ -0,0 +1,220 @@
+'''
+Formatting for reconstructed Google Docs.
+
+Google tells us about formatting with `as` (alter) commands, which
+set style properties (bold, font, heading level, ...) on a range of
+characters. Keeping a dictionary of properties per character would
+multiply the size of our state by the length of the document, so we
+keep a list of runs instead: "10 characters of plain text, then 25
+characters of heading 1, then ..."
+
+The runs live in the same treap as the text in `rope`, so typing
+shifts the formatting after it in O(log n). Typed text picks up the
+formatting of the character before it, as in most editors.
+
+We serialize to a table of distinct styles, and a flat list of
+(run length, style number) pairs:
+
+    {"styles": [{}, {"ps_hd": 1}], "runs": [12, 1, 300, 0]}
+
+From the runs, we can compute an outline of the document (headings,
+and how much is written under each), without per-character storage.
+'''
+
+import json
+
+import writing_observer.rope as rope
+
+# Google's paragraph style property for heading level
+HEADING = 'ps_hd'
+
+
+class _Run(object):
+    '''
+    A run of characters with the same style. This acts like a piece of
+    text for the treap: it has a length, and slicing gives a shorter run
+    with the same style.
+
+    Styles are shared between runs, so we never change one in place.
+    '''
+    __slots__ = ['length', 'style']
+
+    def __init__(self, length, style):
+        self.length = length
+        self.style = style
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, item):
+        start, stop, step = item.indices(self.length)
+        return _Run(max(0, stop - start), self.style)
+
+
+class Formatting(object):
+    '''
+    Formatting for a document of a given length. Positions are 0-based.
+    '''
+    def __init__(self, length=0):
+        self._root = rope.build([_Run(length, {})] if length else [])
+
+    def from_json(json_rep, length):
+        '''
+        Class method to deserialize from JSON. If we have no formatting,
+        or it doesn't match the length of the text, we start from plain
+        text.
+        '''
+        if json_rep is None:
+            return Formatting(length)
+        styles = json_rep['styles']
+        runs = json_rep['runs']
+        pieces = [_Run(runs[i], styles[runs[i + 1]]) for i in range(0, len(runs), 2)]
+        if sum(len(piece) for piece in pieces) != length:
+            print("Formatting doesn't match text length. Dropping formatting.")
+            return Formatting(length)
+        formatting = Formatting()
+        formatting._root = rope.build(pieces)
+        return formatting
+
+    def __len__(self):
+        return rope._size(self._root)
+
+    def insert(self, position, count):
+        '''
+        Make room for `count` characters typed at `position`. They get
+        the style of the character before them (or after, at the start
+        of the document).
+
+        We grow that character's run in place, so typing doesn't add
+        nodes to the tree.
+        '''
+        if count <= 0:
+            return
+        if self._root is None:
+            self._root = rope.build([_Run(count, {})])
+            return
+        target = max(position - 1, 0)
+        path = []
+        node = self._root
+        while node is not None:
+            path.append(node)
+            left_size = rope._size(node.left)
+            if target < left_size:
+                node = node.left
+            elif target < left_size + len(node.piece):
+                node.piece.length += count
+                for parent in path:
+                    parent.size += count
+                return
+            else:
+                target -= left_size + len(node.piece)
+                node = node.right
+        raise IndexError("Formatting insert out of range")
+
+    def delete(self, start, end):
+        '''
+        Drop the formatting from `start` up to (but not including) `end`
+        '''
+        if end <= start:
+            return
+        left, rest = rope.split(self._root, start)
+        _, right = rope.split(rest, end - start)
+        self._root = rope.merge(left, right)
+
+    def alter(self, start, end, changes):
+        '''
+        Apply style `changes` (a dictionary of properties) from `start`
+        up to (but not including) `end`
+        '''
+        if end <= start or not changes:
+            return
+        left, rest = rope.split(self._root, start)
+        middle, right = rope.split(rest, end - start)
+        restyled = []
+        for run in rope.pieces(middle):
+            style = dict(run.style)
+            style.update(changes)
+            if restyled and restyled[-1].style == style:
+                restyled[-1].length += run.length
+            else:
+                restyled.append(_Run(run.length, style))
+        self._root = rope.merge(rope.merge(left, rope.build(restyled)), right)
+
+    def runs(self):
+        '''
+        Iterate through (length, style) pairs, merging neighbouring runs
+        with the same style.
+        '''
+        length = 0
+        style = None
+        for run in rope.pieces(self._root):
+            if not run.length:
+                continue
+            if length and run.style == style:
+                length += run.length
+                continue
+            if length:
+                yield length, style
+            length, style = run.length, run.style
+        if length:
+            yield length, style
+
+    def json(self):
+        '''
+        Serialize to JSON, as a table of styles and a flat list of runs
+        '''
+        styles = []
+        style_numbers = {}
+        runs = []
+        for length, style in self.runs():
+            key = json.dumps(style, sort_keys=True)
+            if key not in style_numbers:
+                style_numbers[key] = len(styles)
+                styles.append(style)
+            runs.extend([length, style_numbers[key]])
+        return {'styles': styles, 'runs': runs}
+
+
+def outline(text, formatting_json):
+    '''
+    Compute an outline of a document from its text and (serialized)
+    formatting: a list of headings, in order, with how much text is
+    under each. This is the format `ux/outline.js` expects:
+
+        [{'section': 'Introduction', 'level': 1, 'length': 300}, ...]
+
+    A paragraph is a heading if any of it (including the newline which
+    ends it, which is where Google puts paragraph styles) has a heading
+    level. We work straight from the JSON, so dashboards don't need to
+    rebuild the tree.
+    '''
+    if not formatting_json:
+        return []
+    styles = formatting_json['styles']
+    runs = formatting_json['runs']
+    headings = {}
+    position = 0
+    for i in range(0, len(runs), 2):
+        length, style = runs[i], styles[runs[i + 1]]
+        level = style.get(HEADING)
+        paragraph = position
+        while level and paragraph < position + length:
+            start = text.rfind('\n', 0, paragraph) + 1
+            end = text.find('\n', paragraph)
+            if end == -1:
+                end = len(text)
+            headings[start] = (end, level)
+            paragraph = end + 1
+        position += length
+
+    sections = []
+    starts = sorted(headings)
+    for i, start in enumerate(starts):
+        end, level = headings[start]
+        next_start = starts[i + 1] if i + 1 < len(starts) else len(text)
+        sections.append({
+            'section': text[start:end],
+            'level': level,
+            'length': max(0, next_start - end - 1)
+        })
+    return sections
@@ -12,6 +12,7 @@ NAME = "The Writing Observer"
 # files.
 
 import writing_observer.aggregator
+import writing_observer.deane
 import writing_observer.writing_analysis
 
 
@@ -46,6 +47,18 @@ COURSE_AGGREGATORS = {
 STUDENT_AGGREGATORS = {
 }
 
+# JSON APIs, served under `/views/<module>/`
+EXTRA_VIEWS = {
+    "student-deane": {
+        "url": "deane/student/{student_id}",
+        "function": writing_observer.deane.student_deane_view
+    },
+    "course-deane": {
+        "url": "deane/course/{course_id}",
+        "function": writing_observer.deane.course_deane_view
+    }
+}
+
 # Incoming event APIs
 REDUCERS = [{
     'context': "org.mitros.writing-analytics",
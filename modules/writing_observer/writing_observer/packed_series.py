@@ -0,0 +1,144 @@
+'''
+Compact storage for the cursor / length arrays behind Deane graphs.
+
+These arrays get one more element on every keystroke, and are written
+back to the KVS on every event. As JSON number arrays, a long essay
+turns into hundreds of kilobytes of digits and commas.
+
+Successive values are close together (the cursor usually moves by one
+character), so we store them as deltas, zigzag-encoded so small
+negative numbers stay small, packed into varints (7 bits per byte),
+and base64-encoded so the result is still a JSON string:
+
+    {"count": 3, "last": 12, "data": "FAIC"}
+
+The series is append-only, so we keep the encoded bytes around and
+only encode new values. We only decode back into an array if someone
+actually asks for the values.
+
+We read the old (plain list) format too.
+'''
+
+import array
+import base64
+
+# Signed, since out-of-range Google commands can give us negative
+# cursor positions.
+ARRAY_TYPE = 'i'
+
+
+def _zigzag(number):
+    '''
+    Map signed integers to unsigned: 0, -1, 1, -2, 2, ... becomes
+    0, 1, 2, 3, 4, ...
+    '''
+    return (number << 1) if number >= 0 else ((-number << 1) - 1)
+
+
+def _unzigzag(number):
+    '''
+    Inverse of `_zigzag`
+    '''
+    return (number >> 1) if not number & 1 else -((number + 1) >> 1)
+
+
+def _encode_varint(number, buffer):
+    '''
+    Append an unsigned integer to `buffer`, 7 bits at a time, low bits
+    first. The high bit of each byte means "more to come."
+    '''
+    while number > 0x7f:
+        buffer.append((number & 0x7f) | 0x80)
+        number >>= 7
+    buffer.append(number)
+
+
+def _decode(buffer, count):
+    '''
+    Decode `count` delta/zigzag/varint values from `buffer`
+    '''
+    values = array.array(ARRAY_TYPE)
+    number = 0
+    shift = 0
+    last = 0
+    for byte in buffer:
+        number |= (byte & 0x7f) << shift
+        if byte & 0x80:
+            shift += 7
+            continue
+        last += _unzigzag(number)
+        values.append(last)
+        number = 0
+        shift = 0
+    if len(values) != count:
+        raise ValueError("Corrupt packed series: expected {count} items, got {items}".format(
+            count=count, items=len(values)
+        ))
+    return values
+
+
+class PackedSeries(object):
+    '''
+    An append-only series of integers, stored packed.
+    '''
+    def __init__(self, values=()):
+        self._encoded = bytearray()
+        self._count = 0
+        self._last = 0
+        self._values = array.array(ARRAY_TYPE)
+        self.extend(values)
+
+    def from_json(json_rep):
+        '''
+        Class method to deserialize from JSON. We take either a list of
+        numbers (old format) or a packed dictionary (new format).
+        '''
+        if json_rep is None or isinstance(json_rep, list):
+            return PackedSeries(json_rep or ())
+        series = PackedSeries()
+        series._encoded = bytearray(base64.b64decode(json_rep['data']))
+        series._count = json_rep['count']
+        series._last = json_rep['last']
+        series._values = None  # Decoded lazily
+        return series
+
+    def append(self, value):
+        '''
+        Add a value to the end of the series
+        '''
+        _encode_varint(_zigzag(value - self._last), self._encoded)
+        self._last = value
+        self._count += 1
+        if self._values is not None:
+            self._values.append(value)
+
+    def extend(self, values):
+        '''
+        Add several values to the end of the series
+        '''
+        for value in values:
+            self.append(value)
+
+    def __len__(self):
+        return self._count
+
+    @property
+    def values(self):
+        '''
+        The series, as an `array`
+        '''
+        if self._values is None:
+            self._values = _decode(self._encoded, self._count)
+        return self._values
+
+    def json(self, packed=True):
+        '''
+        Serialize to JSON, either packed or as a plain list.
+        '''
+        if not packed:
+            return self.values.tolist()
+        return {
+            'count': self._count,
+            'last': self._last,
+            'data': base64.b64encode(self._encoded).decode('ascii')
+        }
@@ -9,19 +9,30 @@ See: `http://features.jsomers.net/how-i-reverse-engineered-google-docs/`
 
 import json
 
+import writing_observer.formatting
+import writing_observer.packed_series
+import writing_observer.rope
+
+# Do we store edit metadata packed (see `packed_series`) or as plain
+# JSON lists? We read both.
+PACK_EDIT_METADATA = True
+
 
 class google_text(object):
     '''
     We encapsulate a string object to support a Google Doc snapshot at a
-    point in time. Right now, this adds cursor position. In the future,
-    we might annotate formatting and similar properties.
+    point in time. Right now, this adds cursor position and formatting.
+
+    The text is kept in a rope, so edits don't copy the whole document.
+    Formatting is kept as runs alongside it (see `formatting`).
     '''
     def __new__(cls):
         '''
         Constructor. We create a blank document to be populated.
         '''
         new_object = object.__new__(cls)
-        new_object._text = ""
+        new_object._rope = writing_observer.rope.Rope()
+        new_object._formatting = writing_observer.formatting.Formatting()
         new_object._position = 0
         new_object._edit_metadata = {}
         new_object.fix_validity()
@@ -30,7 +41,7 @@ class google_text(object):
     def assert_validity(self):
         '''
         We do integrity checks. We store cursor length and text length in
-        two lists for efficiency, and for now, this just confirms they're
+        two packed series for efficiency, and for now, this just confirms they're
         the same length.
         '''
         cursor_array_length = len(self._edit_metadata["cursor"])
@@ -49,10 +60,10 @@ class google_text(object):
         errors_found = []
 
         if "cursor" not in self._edit_metadata:
-            self._edit_metadata["cursor"] = []
+            self._edit_metadata["cursor"] = writing_observer.packed_series.PackedSeries()
             errors_found.append("No cursor array")
         if "length" not in self._edit_metadata:
-            self._edit_metadata["length"] = []
+            self._edit_metadata["length"] = writing_observer.packed_series.PackedSeries()
             errors_found.append("No length array")
 
         # We expect edit metadata to be the same length. We went
@@ -64,11 +75,11 @@ class google_text(object):
         length_difference = cursor_array_length - textlength_array_length
         if length_difference > 0:
             print("Mismatching lengths. This should never happen!")
-            self._edit_metadata["length"] += [0] * length_difference
+            self._edit_metadata["length"].extend([0] * length_difference)
             errors_found.append("Mismatching lengths")
         if length_difference < 0:
             print("Mismatching lengths. This should never happen!")
-            self._edit_metadata["cursor"] += [0] * -length_difference
+            self._edit_metadata["cursor"].extend([0] * -length_difference)
             errors_found.append("Mismatching lengths")
         return errors_found
 
@@ -76,14 +87,21 @@ class google_text(object):
         '''
         Class method to deserialize from JSON
 
-        For null objects, it will create a new Google Doc.
+        For null objects, it will create a new Google Doc. Edit metadata
+        may be either packed or plain lists.
         '''
         new_object = google_text.__new__(google_text)
         if json_rep is None:
             json_rep = {}
-        new_object._text = json_rep.get('text', '')
+        new_object._rope = writing_observer.rope.Rope(json_rep.get('text', ''))
+        new_object._formatting = writing_observer.formatting.Formatting.from_json(
+            json_rep.get('formatting'), len(new_object._rope)
+        )
         new_object._position = json_rep.get('position', 0)
-        new_object._edit_metadata = json_rep.get('edit_metadata', {})
+        new_object._edit_metadata = {
+            key: writing_observer.packed_series.PackedSeries.from_json(value)
+            for key, value in json_rep.get('edit_metadata', {}).items()
+        }
         new_object.fix_validity()
         return new_object
 
@@ -93,13 +111,40 @@ class google_text(object):
         with updating the cursor position, since if text updates,
         the cursor should always update too.
         '''
-        self._text = text
+        self._rope = writing_observer.rope.Rope(text)
+        self._formatting = writing_observer.formatting.Formatting(len(text))
+
+    def splice(self, start, end, text, shift_formatting=True):
+        '''
+        Replace the text from `start` to `end` with `text`. This has the
+        same result as:
+
+        `str(doc)[:start] + text + str(doc)[end:]`
+
+        including Python's handling of negative and out-of-range
+        indexes, but runs in O(log n) rather than copying the document.
+
+        Formatting moves with the text, unless the caller has already
+        taken care of it (`shift_formatting=False`).
+        '''
+        length = len(self._rope)
+        start = _slice_index(start, length)
+        end = _slice_index(end, length)
+        if end < start:
+            # Python slicing would repeat the overlap. We do too.
+            text = text + self._rope.substring(end, start)
+            end = start
+        self._rope.delete(start, end)
+        self._rope.insert(start, text)
+        if shift_formatting:
+            self._formatting.delete(start, end)
+            self._formatting.insert(start, len(text))
 
     def len(self):
         '''
         Length of the string
         '''
-        return len(self._text)
+        return len(self._rope)
 
     @property
     def position(self):
@@ -115,37 +160,83 @@ class google_text(object):
 
         Side effect: Update Deane arrays.
         '''
-        self._edit_metadata['length'].append(len(self._text))
-        self._edit_metadata['cursor'].append(p)
-        self._position = p
+        self.record_edit(p, len(self._rope))
+
+    def record_edit(self, cursor, length):
+        '''
+        Update cursor position, given the length of the document after
+        the edit. This lets the batch interpreter log an edit without
+        having applied it to the text yet.
+
+        Side effect: Update Deane arrays.
+        '''
+        self._edit_metadata['length'].append(length)
+        self._edit_metadata['cursor'].append(cursor)
+        self._position = cursor
 
     @property
     def edit_metadata(self):
         '''
         Return edit metadata. For now, this is length / cursor position
         arrays, but perhaps we should rename this as we expect more
-        analytics.
+        analytics. These are plain lists (so they're JSON); we keep
+        them packed internally.
         '''
-        return self._edit_metadata
+        return {key: series.values.tolist() for key, series in self._edit_metadata.items()}
+
+    @property
+    def formatting(self):
+        '''
+        Formatting runs (see `formatting.Formatting`)
+        '''
+        return self._formatting
+
+    def outline(self):
+        '''
+        Headings in the document, with how much text is under each
+        '''
+        return writing_observer.formatting.outline(str(self), self._formatting.json())
 
     def __str__(self):
         '''
         This returns __just__ the text of the document (no metadata)
         '''
-        return self._text
+        return str(self._rope)
 
     @property
     def json(self):
         '''
         This serializes to JSON.
         '''
+        return self.to_json()
+
+    def to_json(self, packed=None):
+        '''
+        This serializes to JSON, with edit metadata either packed or as
+        plain lists. By default, we follow `PACK_EDIT_METADATA`.
+        '''
+        if packed is None:
+            packed = PACK_EDIT_METADATA
         return {
-            'text': self._text,
+            'text': str(self._rope),
             'position': self._position,
-            'edit_metadata': self._edit_metadata
+            'formatting': self._formatting.json(),
+            'edit_metadata': {
+                key: series.json(packed)
+                for key, series in self._edit_metadata.items()
+            }
         }
 
 
+def _slice_index(index, length):
+    '''
+    Clamp an index the way Python does for `text[index:]`
+    '''
+    if index < 0:
+        index = max(0, length + index)
+    return min(index, length)
+
+
 def command_list(doc, commands):
     '''
     This will process a list of commands. It is helpful either when
@@ -179,11 +270,7 @@ def insert(doc, ty, ibi, s):
     * `ibi` is where the insert happens
     * `s` is the string to insert
     '''
-    doc.update("{start}{insert}{end}".format(
-        start=doc._text[0:ibi - 1],
-        insert=s,
-        end=doc._text[ibi - 1:]
-    ))
+    doc.splice(ibi - 1, ibi - 1, s)
 
     doc.position = ibi + len(s)
 
@@ -197,10 +284,7 @@ def delete(doc, ty, si, ei):
     * `si` is the index of the start of deletion
     * `ei` is the end
     '''
-    doc.update("{start}{end}".format(
-        start=doc._text[0:si - 1],
-        end=doc._text[ei:]
-    ))
+    doc.splice(si - 1, ei, "")
 
     doc.position = si
 
@@ -210,9 +294,12 @@ def delete(doc, ty, si, ei):
 def alter(doc, si, ei, st, sm, ty):
     '''
     Alter commands change formatting.
-
-    We ignore these for now.
+    * `si` and `ei` are the (inclusive) range to format
+    * `st` is the type of style (`text`, `paragraph`, ...)
+    * `sm` are the style properties to set
     '''
+    length = doc.len()
+    doc.formatting.alter(_slice_index(si - 1, length), _slice_index(ei, length), sm)
     return doc
 
 
@@ -245,6 +332,153 @@ dispatch = {
     'null': null
 }
 
+# Longest run of text we'll coalesce before applying it. Runs are
+# built with string concatenation, so we don't want these to grow
+# without bound when replaying a long history.
+MAX_SPLICE_LENGTH = 4096
+
+
+def flatten(commands):
+    '''
+    Iterate through a list of commands, expanding (arbitrarily nested)
+    `mlti` batches in place.
+    '''
+    pending = [iter(commands)]
+    while pending:
+        for item in pending[-1]:
+            if item['ty'] == 'mlti':
+                pending.append(iter(item['mts']))
+                break
+            yield item
+        else:
+            pending.pop()
+
+
+class _Splice(object):
+    '''
+    A net edit which hasn't been applied to the document yet. The
+    document we're describing is:
+
+    `text[:start] + insert + text[end:]`
+
+    where `text` is the document before the edit. Positions passed to
+    `insert` and `delete` are in the coordinates of the edited
+    document.
+    '''
+    def __init__(self, position):
+        self.start = position
+        self.end = position
+        self.insert = ""
+
+    def add_insert(self, position, text):
+        '''
+        Fold in an insert. Returns `False` if the insert isn't next to
+        (or inside of) our edit, or if our edit is already large.
+        '''
+        offset = position - self.start
+        if offset < 0 or offset > len(self.insert) or len(self.insert) > MAX_SPLICE_LENGTH:
+            return False
+        self.insert = self.insert[:offset] + text + self.insert[offset:]
+        return True
+
+    def add_delete(self, start, end):
+        '''
+        Fold in a delete. Returns `False` if the deleted range doesn't
+        touch our edit.
+        '''
+        insert_end = self.start + len(self.insert)
+        if start > insert_end or end < self.start:
+            return False
+        self.insert = self.insert[:max(start, self.start) - self.start] + \
+            self.insert[min(end, insert_end) - self.start:]
+        self.end += max(0, end - insert_end)
+        self.start = min(start, self.start)
+        return True
+
+    def apply(self, doc):
+        '''
+        Apply the edit to the text of a document. The batch interpreter
+        keeps formatting up-to-date itself.
+        '''
+        if self.start != self.end or self.insert:
+            doc.splice(self.start, self.end, self.insert, shift_formatting=False)
+
+
+def batch_command_list(doc, commands):
+    '''
+    Equivalent to `command_list`, but faster for long lists of commands.
+
+    A `google_docs_save` bundle is mostly single-character inserts and
+    deletes next to each other (someone typing, or backspacing). We
+    flatten `mlti` batches, merge runs of adjacent inserts and deletes
+    into one net edit, and apply that edit to the text once.
+
+    Cursor and length metadata only depend on the document length, so
+    we log those per command, exactly as sequential application would.
+    Typed text picks up formatting from wherever it was typed, so we
+    shift formatting per command too, except that we merge runs of
+    typing (each character continuing the last).
+
+    Anything unusual (indexes Python would clamp, formatting, unknown
+    commands) flushes the run and goes through `dispatch` as usual.
+    '''
+    splice = None
+    typed = None  # Formatting for a run of typing: [position, count]
+    length = doc.len()
+    for item in flatten(commands):
+        command = item['ty']
+        if command == 'is':
+            position = item['ibi'] - 1
+            if 0 <= position <= length:
+                if splice is None or not splice.add_insert(position, item['s']):
+                    if splice is not None:
+                        splice.apply(doc)
+                    splice = _Splice(position)
+                    splice.add_insert(position, item['s'])
+                length += len(item['s'])
+                if typed is not None and typed[0] + typed[1] == position:
+                    typed[1] += len(item['s'])
+                else:
+                    if typed is not None:
+                        doc.formatting.insert(*typed)
+                    typed = [position, len(item['s'])]
+                doc.record_edit(item['ibi'] + len(item['s']), length)
+                continue
+        elif command == 'ds':
+            start = item['si'] - 1
+            end = item['ei']
+            if 0 <= start <= end <= length:
+                if splice is None or not splice.add_delete(start, end):
+                    if splice is not None:
+                        splice.apply(doc)
+                    splice = _Splice(start)
+                    splice.add_delete(start, end)
+                length -= end - start
+                if typed is not None:
+                    doc.formatting.insert(*typed)
+                    typed = None
+                doc.formatting.delete(start, end)
+                doc.record_edit(item['si'], length)
+                continue
+        elif dispatch.get(command) is null:
+            continue
+
+        # Slow path
+        if typed is not None:
+            doc.formatting.insert(*typed)
+            typed = None
+        if splice is not None:
+            splice.apply(doc)
+            splice = None
+        doc = command_list(doc, [item])
+        length = doc.len()
+    if typed is not None:
+        doc.formatting.insert(*typed)
+    if splice is not None:
+        splice.apply(doc)
+    return doc
+
+
 if __name__ == '__main__':
     google_json = json.load(open("sample3.json"))
     docs_history = google_json['client']['history']['changelog']
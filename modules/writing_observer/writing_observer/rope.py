@@ -0,0 +1,256 @@
+'''
+A rope: a string which supports cheap inserts and deletes.
+
+Python strings are immutable, so changing one character of an essay
+copies the whole essay. When a student types a 5,000 word document
+one keystroke at a time, that adds up.
+
+We store text as a sequence of short chunks in an implicit treap (a
+randomized balanced binary tree, ordered by position rather than by
+key). Each node holds one chunk, and knows the total length of its
+subtree. Inserts and deletes touch O(log n) nodes, plus up to one
+chunk's worth of copying.
+
+The tree code only relies on chunks supporting `len()` and slicing,
+so the same machinery can hold other run-length data which shifts
+with the text (e.g. formatting).
+
+See: `https://en.wikipedia.org/wiki/Rope_(data_structure)` and
+`https://en.wikipedia.org/wiki/Treap`
+'''
+
+import random
+
+# Maximum size of a chunk of text. Smaller chunks mean less copying per
+# keystroke; bigger chunks mean fewer nodes (and less memory). A few
+# hundred characters is a paragraph or so.
+CHUNK_SIZE = 512
+
+
+class _Node(object):
+    '''
+    One node of the treap. `size` is the total length of the pieces in
+    this subtree.
+    '''
+    __slots__ = ['piece', 'priority', 'left', 'right', 'size']
+
+    def __init__(self, piece, priority=None):
+        self.piece = piece
+        if priority is None:
+            priority = random.random()
+        self.priority = priority
+        self.left = None
+        self.right = None
+        self.size = len(piece)
+
+
+def _size(node):
+    '''
+    Length of a subtree, including empty subtrees
+    '''
+    if node is None:
+        return 0
+    return node.size
+
+
+def _update(node):
+    '''
+    Recompute the size of a node after its children changed.
+    '''
+    node.size = _size(node.left) + len(node.piece) + _size(node.right)
+    return node
+
+
+def merge(left, right):
+    '''
+    Concatenate two treaps. Everything in `left` comes before everything
+    in `right`.
+    '''
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = merge(left.right, right)
+        return _update(left)
+    right.left = merge(left, right.left)
+    return _update(right)
+
+
+def split(node, position):
+    '''
+    Split a treap into two: the first `position` items, and the rest.
+
+    If the split point falls inside of a piece, we cut the piece in
+    two. The new right-hand node inherits the priority of the original,
+    which keeps the heap invariant intact.
+    '''
+    if node is None:
+        return None, None
+    left_size = _size(node.left)
+    if position <= left_size:
+        left, node.left = split(node.left, position)
+        return left, _update(node)
+    piece_end = left_size + len(node.piece)
+    if position >= piece_end:
+        node.right, right = split(node.right, position - piece_end)
+        return _update(node), right
+    offset = position - left_size
+    right = _Node(node.piece[offset:], priority=node.priority)
+    right.right = node.right
+    node.piece = node.piece[:offset]
+    node.right = None
+    return _update(node), _update(right)
+
+
+def build(pieces):
+    '''
+    Build a treap out of a list of pieces, in O(n).
+
+    We use the standard stack-based construction of a Cartesian tree,
+    and then fix up the sizes.
+    '''
+    stack = []
+    for piece in pieces:
+        node = _Node(piece)
+        last = None
+        while stack and stack[-1].priority < node.priority:
+            last = stack.pop()
+        node.left = last
+        if stack:
+            stack[-1].right = node
+        stack.append(node)
+    if not stack:
+        return None
+    root = stack[0]
+    _fix_sizes(root)
+    return root
+
+
+def _fix_sizes(root):
+    '''
+    Recompute sizes bottom-up. We do this iteratively, since a freshly
+    built tree is only balanced in expectation.
+    '''
+    order = []
+    pending = [root]
+    while pending:
+        node = pending.pop()
+        order.append(node)
+        if node.left is not None:
+            pending.append(node.left)
+        if node.right is not None:
+            pending.append(node.right)
+    for node in reversed(order):
+        _update(node)
+
+
+def pieces(node):
+    '''
+    Iterate through the pieces of a treap, in order.
+    '''
+    pending = []
+    while pending or node is not None:
+        while node is not None:
+            pending.append(node)
+            node = node.left
+        node = pending.pop()
+        yield node.piece
+        node = node.right
+
+
+def _chunks(text, chunk_size=CHUNK_SIZE):
+    '''
+    Cut a string into chunks of at most `chunk_size` characters.
+    '''
+    return [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+
+
+class Rope(object):
+    '''
+    A mutable string.
+
+    Positions are 0-based, as with Python strings. `str(rope)` gives
+    back the full text. We cache that, so repeated calls between edits
+    are free.
+    '''
+    def __init__(self, text=""):
+        self._root = build(_chunks(text))
+        self._text = text
+
+    def __len__(self):
+        return _size(self._root)
+
+    def __str__(self):
+        if self._text is None:
+            self._text = "".join(pieces(self._root))
+        return self._text
+
+    def insert(self, position, text):
+        '''
+        Insert `text` before `position`.
+        '''
+        if not text:
+            return
+        self._text = None
+        if self._insert_in_place(position, text):
+            return
+        left, right = split(self._root, position)
+        self._root = merge(merge(left, build(_chunks(text))), right)
+
+    def _insert_in_place(self, position, text):
+        '''
+        Fast path for typing: if the insert lands in (or at the end of)
+        a chunk with room to spare, we grow that chunk rather than
+        adding a node. Otherwise, every keystroke would be its own node.
+
+        Returns `False` if there was no room.
+        '''
+        path = []
+        node = self._root
+        while node is not None:
+            path.append(node)
+            left_size = _size(node.left)
+            if position < left_size:
+                node = node.left
+            elif position <= left_size + len(node.piece):
+                offset = position - left_size
+                if len(node.piece) + len(text) > CHUNK_SIZE:
+                    return False
+                node.piece = node.piece[:offset] + text + node.piece[offset:]
+                for parent in path:
+                    parent.size += len(text)
+                return True
+            else:
+                position -= left_size + len(node.piece)
+                node = node.right
+        return False
+
+    def delete(self, start, end):
+        '''
+        Remove the text from `start` up to (but not including) `end`.
+        '''
+        if end <= start:
+            return
+        self._text = None
+        left, rest = split(self._root, start)
+        _, right = split(rest, end - start)
+        self._root = merge(left, right)
+
+    def substring(self, start, end):
+        '''
+        Equivalent to `str(rope)[start:end]`, for 0 <= start <= end, but
+        without building the full string if we don't have it cached.
+        '''
+        if self._text is not None:
+            return self._text[start:end]
+        result = []
+        position = 0
+        for piece in pieces(self._root):
+            piece_end = position + len(piece)
+            if piece_end > start and position < end:
+                result.append(piece[max(start - position, 0):end - position])
+            if piece_end >= end:
+                break
+            position = piece_end
+        return "".join(result)
@@ -0,0 +1,92 @@
+'''
+Tests for `formatting`. Run with `pytest`, or directly:
+
+>>> python test_formatting.py
+'''
+
+import random
+
+import writing_observer.formatting as formatting
+
+
+def _expand(runs):
+    '''
+    Per-character styles, from (length, style) runs
+    '''
+    styles = []
+    for length, style in runs:
+        styles.extend([style] * length)
+    return styles
+
+
+def test_matches_per_character(trials=200):
+    '''
+    Differential test: runs should give the same styles as keeping a
+    style per character.
+    '''
+    for seed in range(trials):
+        rng = random.Random(seed)
+        length = rng.randint(0, 50)
+        runs = formatting.Formatting(length)
+        styles = [{}] * length
+        for i in range(50):
+            roll = rng.random()
+            if roll < 0.5:
+                position = rng.randint(0, len(styles))
+                count = rng.choice([1, 1, 3])
+                runs.insert(position, count)
+                if styles:
+                    style = styles[max(position - 1, 0)]
+                else:
+                    style = {}
+                styles[position:position] = [style] * count
+            elif roll < 0.75:
+                start = rng.randint(0, len(styles))
+                end = start + rng.randint(0, 5)
+                runs.delete(start, end)
+                del styles[start:end]
+            else:
+                start = rng.randint(0, len(styles))
+                end = start + rng.randint(0, 10)
+                changes = rng.choice([{'ts_bd': True}, {'ts_bd': False}, {formatting.HEADING: 1}])
+                runs.alter(start, end, changes)
+                styles[start:end] = [dict(style, **changes) for style in styles[start:end]]
+            assert len(runs) == len(styles), seed
+            assert _expand(runs.runs()) == styles, seed
+        restored = formatting.Formatting.from_json(runs.json(), len(styles))
+        assert _expand(restored.runs()) == styles, seed
+        assert restored.json() == runs.json(), seed
+
+
+def test_json():
+    runs = formatting.Formatting(10)
+    runs.alter(2, 4, {'ts_bd': True})
+    runs.alter(6, 8, {'ts_bd': True})
+    assert runs.json() == {'styles': [{}, {'ts_bd': True}], 'runs': [2, 0, 2, 1, 2, 0, 2, 1, 2, 0]}
+    # Formatting which doesn't match the text is dropped
+    assert formatting.Formatting.from_json(runs.json(), 11).json() == {'styles': [{}], 'runs': [11, 0]}
+    assert formatting.Formatting.from_json(None, 0).json() == {'styles': [], 'runs': []}
+
+
+def test_outline():
+    text = "Title\nSome text.\nPart one\nMore text here.\nPart two\n"
+    runs = formatting.Formatting(len(text))
+    assert formatting.outline(text, runs.json()) == []
+    assert formatting.outline(text, None) == []
+    # Google puts paragraph styles on the newline at the end
+    runs.alter(5, 6, {formatting.HEADING: 1})
+    # ... but a heading style anywhere in a paragraph counts
+    runs.alter(17, 21, {formatting.HEADING: 2})
+    runs.alter(len(text) - 1, len(text), {formatting.HEADING: 2})
+    assert formatting.outline(text, runs.json()) == [
+        {'section': 'Title', 'level': 1, 'length': 11},
+        {'section': 'Part one', 'level': 2, 'length': 16},
+        {'section': 'Part two', 'level': 2, 'length': 0}
+    ]
+
+
+if __name__ == '__main__':
+    test_matches_per_character()
+    test_json()
+    test_outline()
+    print("Test successful")
@@ -0,0 +1,84 @@
+'''
+Tests for `packed_series`. Run with `pytest`, or directly:
+
+>>> python test_packed_series.py
+'''
+
+import random
+
+import pytest
+
+import writing_observer.packed_series as packed_series
+
+
+def _random_values(rng, count):
+    '''
+    A cursor-like series: mostly small steps, with the odd jump, and
+    negative values (from out-of-range commands)
+    '''
+    values = []
+    value = 0
+    for i in range(count):
+        value += rng.choice([1, 1, 1, 0, -1, rng.randint(-100000, 100000)])
+        values.append(value)
+    return values
+
+
+def test_zigzag():
+    for number in list(range(-300, 300)) + [2 ** 31 - 1, -2 ** 31]:
+        assert packed_series._zigzag(number) >= 0
+        assert packed_series._unzigzag(packed_series._zigzag(number)) == number
+
+
+def test_round_trip(trials=100):
+    '''
+    Values survive the packed (new) format, and we can keep appending
+    to a series we read back.
+    '''
+    for seed in range(trials):
+        rng = random.Random(seed)
+        values = _random_values(rng, rng.randint(0, 500))
+        series = packed_series.PackedSeries(values[:len(values) // 2])
+        series.extend(values[len(values) // 2:])
+        assert len(series) == len(values), seed
+        assert series.values.tolist() == values, seed
+        assert series.json(packed=False) == values, seed
+
+        json_rep = series.json()
+        assert isinstance(json_rep['data'], str), seed
+        restored = packed_series.PackedSeries.from_json(json_rep)
+        assert len(restored) == len(values), seed
+        assert restored.values.tolist() == values, seed
+
+        restored = packed_series.PackedSeries.from_json(json_rep)
+        restored.append(7)
+        assert restored.json() == packed_series.PackedSeries(values + [7]).json(), seed
+        assert restored.values.tolist() == values + [7], seed
+
+
+def test_old_format():
+    '''
+    We read plain lists, from before we packed series, and write them
+    back packed.
+    '''
+    values = [0, 1, 2, 3, 2, 50, -3]
+    series = packed_series.PackedSeries.from_json(values)
+    assert series.values.tolist() == values
+    assert packed_series.PackedSeries.from_json(series.json()).values.tolist() == values
+    assert len(packed_series.PackedSeries.from_json(None)) == 0
+    assert len(packed_series.PackedSeries.from_json([])) == 0
+
+
+def test_corrupt():
+    json_rep = packed_series.PackedSeries([1, 2, 3]).json()
+    json_rep['count'] = 4
+    with pytest.raises(ValueError):
+        packed_series.PackedSeries.from_json(json_rep).values
+
+
+if __name__ == '__main__':
+    test_zigzag()
+    test_round_trip()
+    test_old_format()
+    test_corrupt()
+    print("Test successful")
@@ -0,0 +1,74 @@
+'''
+Tests for `reconstruct_doc`. Run with `pytest`, or directly:
+
+>>> python test_reconstruct_doc.py
+'''
+
+import random
+
+import writing_observer.reconstruct_doc as reconstruct_doc
+
+
+def _random_commands(rng, count, length=0, depth=0):
+    '''
+    Generate a random list of Google Docs commands, for testing, from
+    `rng` (a `random.Random`). We mostly type and backspace near the
+    cursor, but we also jump around, nest `mlti` batches, and send
+    out-of-range indexes.
+    '''
+    commands = []
+    cursor = 0
+    for i in range(count):
+        roll = rng.random()
+        if roll < 0.05:
+            cursor = rng.randint(-2, length + 2)
+        if roll < 0.55:
+            text = "".join(rng.choice("ab \n") for i in range(rng.choice([1, 1, 1, 5])))
+            commands.append({'ty': 'is', 'ibi': cursor + 1, 's': text})
+            cursor += len(text)
+            length += len(text)
+        elif roll < 0.85:
+            size = rng.choice([1, 1, 1, 3])
+            if rng.random() < 0.8:  # Backspace
+                cursor = max(0, cursor - size)
+            commands.append({'ty': 'ds', 'si': cursor + 1, 'ei': cursor + size})
+            length = max(0, length - size)
+        elif roll < 0.92 and depth < 3:
+            commands.append({'ty': 'mlti', 'mts': _random_commands(rng, 5, length, depth + 1)})
+        elif roll < 0.96:
+            start = rng.randint(-1, length + 1)
+            commands.append({
+                'ty': 'as', 'si': start, 'ei': start + rng.randint(-1, 5),
+                'st': rng.choice(['text', 'paragraph']),
+                'sm': rng.choice([{}, {'ts_bd': True}, {'ts_bd': False}, {'ps_hd': 1}])
+            })
+        else:
+            commands.append({'ty': rng.choice(['null', 'ae', 'ds'])})
+            if commands[-1]['ty'] == 'ds':
+                commands[-1].update({'si': cursor + 3, 'ei': cursor})
+    return commands
+
+
+def test_batch_command_list(trials=1000):
+    '''
+    Differential test: the batch interpreter should give exactly the same
+    text, position, formatting, and edit metadata as applying commands
+    one-by-one.
+
+    Each trial has its own seed, so a failure can be replayed with
+    `_random_commands(random.Random(seed), ...)`.
+    '''
+    for seed in range(trials):
+        rng = random.Random(seed)
+        text = "".join(rng.choice("xyz ") for i in range(seed % 50))
+        initial = reconstruct_doc.google_text.from_json({'text': text})
+        commands = _random_commands(rng, rng.randint(1, 100), length=initial.len())
+        expected = reconstruct_doc.command_list(reconstruct_doc.google_text.from_json(initial.json), commands)
+        actual = reconstruct_doc.batch_command_list(reconstruct_doc.google_text.from_json(initial.json), commands)
+        assert expected.json == actual.json, (seed, commands, expected.json, actual.json)
+        assert len(actual.formatting) == actual.len(), (seed, commands, actual.json)
+    print("Test successful")
+
+
+if __name__ == '__main__':
+    test_batch_command_list()
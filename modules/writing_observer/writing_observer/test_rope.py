@@ -0,0 +1,103 @@
+'''
+Tests for `rope`: the treap underneath, and the rope on top of it. Run
+with `pytest`, or directly:
+
+>>> python test_rope.py
+'''
+
+import random
+
+import writing_observer.rope as rope
+
+
+def _check_treap(node):
+    '''
+    Check sizes and the heap order of priorities in a treap, and
+    return its size
+    '''
+    if node is None:
+        return 0
+    for child in [node.left, node.right]:
+        if child is not None:
+            assert child.priority <= node.priority
+    size = _check_treap(node.left) + len(node.piece) + _check_treap(node.right)
+    assert node.size == size
+    return size
+
+
+def test_treap_split_merge(trials=50):
+    '''
+    Splitting a treap anywhere, and merging it back, gives back the
+    same pieces, and keeps the tree valid.
+    '''
+    for seed in range(trials):
+        rng = random.Random(seed)
+        text = "".join(rng.choice("abc") for i in range(rng.randint(0, 200)))
+        chunks = rope._chunks(text, rng.randint(1, 20))
+        root = rope.build(chunks)
+        assert list(rope.pieces(root)) == chunks, seed
+        assert _check_treap(root) == len(text), seed
+        position = rng.randint(0, len(text))
+        left, right = rope.split(root, position)
+        assert "".join(rope.pieces(left)) == text[:position], seed
+        assert "".join(rope.pieces(right)) == text[position:], seed
+        _check_treap(left)
+        _check_treap(right)
+        root = rope.merge(left, right)
+        assert "".join(rope.pieces(root)) == text, seed
+        assert _check_treap(root) == len(text), seed
+
+
+def test_rope_matches_str(trials=200):
+    '''
+    Differential test: a rope should act like a plain string, whatever
+    we do to it.
+    '''
+    for seed in range(trials):
+        rng = random.Random(seed)
+        text = "".join(rng.choice("xyz\n") for i in range(rng.randint(0, 2000)))
+        string = rope.Rope(text)
+        for i in range(100):
+            roll = rng.random()
+            if roll < 0.6:
+                position = rng.randint(0, len(text))
+                # Mostly keystrokes, sometimes a paste
+                insert = "a" * rng.choice([1, 1, 1, 5, rope.CHUNK_SIZE + 1])
+                string.insert(position, insert)
+                text = text[:position] + insert + text[position:]
+            elif roll < 0.9:
+                start = rng.randint(0, len(text))
+                end = start + rng.randint(-1, 10)
+                string.delete(start, end)
+                if end > start:
+                    text = text[:start] + text[end:]
+            else:
+                # Between edits, we don't have the text cached
+                start = rng.randint(0, len(text))
+                end = rng.randint(start, len(text))
+                assert string.substring(start, end) == text[start:end], seed
+            assert len(string) == len(text), seed
+        assert str(string) == text, seed
+        assert string.substring(0, len(text)) == text, seed
+        _check_treap(string._root)
+
+
+def test_typing_grows_chunks():
+    '''
+    Typing one character at a time fills up chunks, rather than adding
+    a node per keystroke.
+    '''
+    string = rope.Rope()
+    for i in range(10 * rope.CHUNK_SIZE):
+        string.insert(len(string), "a")
+    chunks = list(rope.pieces(string._root))
+    assert str(string) == "a" * 10 * rope.CHUNK_SIZE
+    assert all(len(chunk) <= rope.CHUNK_SIZE for chunk in chunks)
+    assert len(chunks) <= 20
+
+
+if __name__ == '__main__':
+    test_treap_split_merge()
+    test_rope_matches_str()
+    test_typing_grows_chunks()
+    print("Test successful")
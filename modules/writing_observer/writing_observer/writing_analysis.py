@@ -5,8 +5,13 @@ It just routes to smaller pipelines. Currently that's:
 1) Time-on-task
 2) Reconstruct text (+Deane graphs, etc.)
 '''
+import asyncio
+import hashlib
+import json
+
 import writing_observer.reconstruct_doc
 
+import learning_observer.exceptions
 from learning_observer.stream_analytics.helpers import kvs_pipeline
 
 # How do we count the last action in a document? If a student steps away
@@ -27,14 +32,28 @@ from learning_observer.stream_analytics.helpers import kvs_pipeline
 # Should be 60-300 in prod. 5 seconds is nice for debugging
 TIME_ON_TASK_THRESHOLD = 5
 
+# Document reconstruction stores an op-log of Google's commands, and
+# only rebuilds the full text every so many events, or so many seconds
+# (see `kvs_pipeline`). Dashboards lag by up to this many seconds.
+RECONSTRUCT_COMPACT_OPS = 50
+RECONSTRUCT_COMPACT_SECONDS = 1
+
+# Replaying this many commands (e.g. a long document history) takes
+# long enough that we do it in a worker process, rather than stalling
+# the event loop.
+RECONSTRUCT_OFFLOAD_COMMANDS = 5000
+
 
-@kvs_pipeline()
+@kvs_pipeline(write_behind=True)
 async def time_on_task(event, internal_state):
     '''
     This adds up time intervals between successive timestamps. If the interval
     goes above some threshold, it adds that threshold instead (so if a student
     goes away for 2 hours without typing, we only add e.g. 5 minutes if
     `time_threshold` is set to 300.
+
+    This runs on every keystroke, and the state is tiny, so we keep it
+    in memory and write it back every few seconds.
     '''
     if internal_state is None:
         internal_state = {
@@ -56,30 +75,123 @@ async def time_on_task(event, internal_state):
     return internal_state, internal_state
 
 
-@kvs_pipeline()
-async def reconstruct(event, internal_state):
+def reconstruct_delta(event):
     '''
-    This is a thin layer to route events to `reconstruct_doc` which compiles
-    Google's deltas into a document. It also adds a bit of metadata e.g. for
-    Deane plots.
+    What we log for each event for `reconstruct`: just Google's commands.
+    Saves give us commands to apply, while a document history replaces
+    the document.
     '''
-    print(internal_state)
-    internal_state = writing_observer.reconstruct_doc.google_text.from_json(
-        json_rep=internal_state)
     if event['client']['event'] == "google_docs_save":
         bundles = event['client']['bundles']
-        for bundle in bundles:
-            internal_state = writing_observer.reconstruct_doc.command_list(
-                internal_state, bundle['commands']
-            )
+        return {
+            'commands': [command for bundle in bundles for command in bundle['commands']]
+        }
     elif event['client']['event'] == "document_history":
-        change_list = [
-            i[0] for i in event['client']['history']['changelog']
-        ]
-        internal_state = writing_observer.reconstruct_doc.command_list(
-            writing_observer.reconstruct_doc.google_text(), change_list
-        )
-    state = internal_state.json
+        return {
+            'history': [i[0] for i in event['client']['history']['changelog']]
+        }
+    return None
+
+
+def _command_hash(command):
+    '''
+    Fingerprint of one Google command
+    '''
+    return hashlib.md5(json.dumps(command, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def _applied_prefix(history, pending, changelog):
+    '''
+    How much of a document history we've already applied, or `None` if
+    we can't tell and need to rebuild the document.
+
+    `history` is what we know about the commands behind our state:
+    how many there were, and a fingerprint of the last one. `pending`
+    are commands we've accepted since then, but not yet applied.
+
+    We only track this once we've built the document from a full
+    history. If we started from the middle of a document (e.g. saves
+    before the first history), our command count doesn't line up
+    with Google's changelog.
+    '''
+    if history is None:
+        return None
+    applied = history['length'] + len(pending)
+    if applied > len(changelog):
+        return None
+    if applied == 0:
+        return 0
+    last = _command_hash(pending[-1]) if pending else history['last']
+    if _command_hash(changelog[applied - 1]) != last:
+        return None
+    return applied
+
+
+def reconstruct_is_cpu_bound(deltas):
+    '''
+    Is a `reconstruct` compaction big enough to run in a worker process?
+    '''
+    commands = sum(len(delta.get('history', delta.get('commands', []))) for delta in deltas)
+    return commands >= RECONSTRUCT_OFFLOAD_COMMANDS
+
+
+@kvs_pipeline(
+    op_log=reconstruct_delta,
+    compact_ops=RECONSTRUCT_COMPACT_OPS,
+    compact_seconds=RECONSTRUCT_COMPACT_SECONDS,
+    per_document=True,
+    cpu_bound=reconstruct_is_cpu_bound
+)
+async def reconstruct(deltas, internal_state):
+    '''
+    This is a thin layer to route events to `reconstruct_doc` which compiles
+    Google's deltas into a document. It also adds a bit of metadata e.g. for
+    Deane plots.
+
+    We're an op-log reducer, so we get a list of deltas (from
+    `reconstruct_delta`) since the last snapshot. We run consecutive
+    saves through the batch interpreter together.
+
+    The extension sends the full document history whenever a document
+    is loaded, so we see the same history over and over (e.g. when a
+    whole class reconnects at once). If our document was built from
+    the start of that history, we only apply the commands we haven't
+    seen yet, and if there aren't any, we do nothing at all.
+
+    We keep one document per Google Doc, so students can switch
+    between documents without us rebuilding them.
+    '''
+    history = (internal_state or {}).get('history')
+    rebuild = False
+    commands = []
+    for delta in deltas:
+        if 'history' in delta:
+            changelog = delta['history']
+            applied = _applied_prefix(history, commands, changelog)
+            if applied is None:
+                rebuild = True
+                history = {'length': 0, 'last': None}
+                commands = list(changelog)
+            else:
+                commands.extend(changelog[applied:])
+        else:
+            commands.extend(delta['commands'])
+
+    if not commands and not rebuild and internal_state is not None:
+        return internal_state, internal_state
+
+    if rebuild:
+        document = writing_observer.reconstruct_doc.google_text()
+    else:
+        document = writing_observer.reconstruct_doc.google_text.from_json(
+            json_rep=internal_state)
+    document = writing_observer.reconstruct_doc.batch_command_list(document, commands)
+    state = document.json
+    if history is not None:
+        state['history'] = {
+            'length': history['length'] + len(commands),
+            'last': _command_hash(commands[-1]) if commands else history['last']
+        }
     return state, state
 
 
@@ -88,12 +200,27 @@ async def pipeline(metadata):
     We pass the event through all of our analytic pipelines, and
     combine the results into a common state-of-the-universe to return
     for display in the dashboard.
+
+    The pipelines run concurrently. If one fails, we still return what
+    the others gave us, inside of a `ReducerErrors`.
     '''
     processors = [time_on_task(metadata), reconstruct(metadata)]
 
     async def process(event):
+        results = await asyncio.gather(
+            *[processor(event) for processor in processors],
+            return_exceptions=True
+        )
         external_state = {}
-        for processor in processors:
-            external_state.update(await processor(event))
+        errors = []
+        for result in results:
+            if isinstance(result, Exception):
+                errors.append(result)
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                external_state.update(result)
+        if errors:
+            raise learning_observer.exceptions.ReducerErrors(errors, external_state)
         return external_state
     return process
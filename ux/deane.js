@@ -130,8 +130,11 @@ export function setup_deane_graph(div) {
 
 export function populate_deane_graph_data(div, data, max_x=null, max_y=null) {
     var svg = div.select('svg');
+    // Downsampled data from the server comes with edit numbers. Raw
+    // data has one point per edit.
+    var x_edit = data['edit'] || consecutive_array(data['length'].length);
     if(max_x === null) {
-	max_x = data['length'].length;
+	max_x = x_edit.length ? x_edit[x_edit.length - 1] : 0;
     }
     if(max_y === null) {
 	max_y = Math.max(...data['length']);
@@ -142,8 +145,6 @@ export function populate_deane_graph_data(div, data, max_x=null, max_y=null) {
 
     var lines = d3.line();
 
-    var x_edit = consecutive_array(data['length'].length);
-
     var length_data = zip(x_edit.map(xScale), data['length'].map(yScale));
     var cursor_data = zip(x_edit.map(xScale), data['cursor'].map(yScale));
     